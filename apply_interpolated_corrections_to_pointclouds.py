@@ -2,63 +2,233 @@
 # Can be used to align overlapping point clouds.
 # Measure the shifts and note down the timestamps at intersections using point cloud visualization tool (e.g. CloudCompare).
 # There can be more than 2 corrections. Just add more columns.
+# For many control points, set "corrections_file" to a CSV (or whitespace separated trajectory) file with a header row
+# and the columns timestamp, x_shift, y_shift and z_shift. Other columns are ignored.
+# estimate_strip_corrections.py writes such a file from the overlaps of the strips, instead of measuring them by hand.
+# "interpolation" can be 'linear', or 'cubic', 'pchip' or 'akima' for smooth corrections between the control points.
+# Points are processed in chunks of "chunk_size" points. Files with sorted gps_time only scan the control points that
+# fall inside the current chunk, instead of searching all of them for every point.
+# Per-file stage timings are written as JSON lines when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
+# With "incremental" set, only new or changed files and files corrected with other corrections are processed, "watch"
+# keeps processing new files as they arrive and rereads "corrections_file" for every pass, see incremental_processing.py.
+# With "in_place" set, uncompressed .las inputs are corrected inside the input file instead of being copied to
+# "output_dir", see las_inplace.py. The corrections are rounded to whole scale steps. Files interrupted while being
+# corrected are resumed or rolled back on the next run ("in_place_recovery"). The manifest of processed files is always
+# kept in this mode, so a rerun does not correct the same files twice.
 
 import laspy
 import numpy as np
 import os
-from scipy.interpolate import interp1d
+from scipy.interpolate import CubicSpline, PchipInterpolator, Akima1DInterpolator
+
+from processing_metrics import FileMetrics
+from laz_io import open_las, read_las, write_las
+from incremental_processing import ProcessingManifest, watch as watch_inputs
+from las_inplace import can_edit_in_place, has_journal, edit_in_place, rollback_in_place, get_step_deltas
 
 
 input_dir = 'laz_in'
 output_dir = 'laz_out'
+corrections_file = None  # E.g. 'corrections.csv', None uses the corrections below
+interpolation = 'linear'  # 'linear', 'cubic', 'pchip' or 'akima'
+chunk_size = 1_000_000  # Points per chunk, None reads the whole file at once
+incremental = False  # Skip files that were already corrected with the same corrections
+watch = False  # Keep running and correct new files every "watch_interval" seconds
+watch_interval = 60
+in_place = False  # Correct uncompressed .las files in place instead of writing copies
+in_place_recovery = 'resume'  # 'resume' or 'rollback' files left unfinished by an interrupted in-place run
 corrections = {
-    'timestamps': [1706468131, 1706468603],  
-    'x_shifts': [0.40, 0.38], 
-    'y_shifts': [0.32, 3.17],  
-    'z_shifts': [-0.75, -2.15],  
+    'timestamps': [1706468131, 1706468603],
+    'x_shifts': [0.40, 0.38],
+    'y_shifts': [0.32, 3.17],
+    'z_shifts': [-0.75, -2.15],
+}
+
+SPLINE_INTERPOLATORS = {
+    'cubic': CubicSpline,
+    'pchip': PchipInterpolator,
+    'akima': Akima1DInterpolator,
 }
 
-def interpolate_shifts(gps_times, corrections):
-    timestamps = corrections['timestamps']
-    x_shifts = corrections['x_shifts']
-    y_shifts = corrections['y_shifts']
-    z_shifts = corrections['z_shifts']
-    
-    interpolate_x = interp1d(timestamps, x_shifts, fill_value="extrapolate")
-    interpolate_y = interp1d(timestamps, y_shifts, fill_value="extrapolate")
-    interpolate_z = interp1d(timestamps, z_shifts, fill_value="extrapolate")
-    
-    x_corrections = interpolate_x(gps_times)
-    y_corrections = interpolate_y(gps_times)
-    z_corrections = interpolate_z(gps_times)
-    
-    return x_corrections, y_corrections, z_corrections
+
+def load_corrections(corrections_file):
+    delimiter = ',' if corrections_file.lower().endswith('.csv') else None
+    table = np.genfromtxt(corrections_file, delimiter=delimiter, names=True, dtype=None, encoding='utf-8')
+    table = np.atleast_1d(table)
+    time_column = next((name for name in ('timestamp', 'timestamps', 'gps_time') if name in table.dtype.names), None)
+    if time_column is None:
+        raise ValueError(f"No timestamp column found in {corrections_file}")
+    return {
+        'timestamps': table[time_column].astype(np.float64),
+        'x_shifts': table['x_shift'].astype(np.float64),
+        'y_shifts': table['y_shift'].astype(np.float64),
+        'z_shifts': table['z_shift'].astype(np.float64),
+    }
+
+
+def build_correction_model(corrections, interpolation):
+    # The model is a piecewise polynomial: the breakpoints and a (order, pieces, 3) array of xyz coefficients
+    timestamps = np.asarray(corrections['timestamps'], dtype=np.float64)
+    shifts = np.column_stack([corrections['x_shifts'], corrections['y_shifts'], corrections['z_shifts']]).astype(np.float64)
+    if len(timestamps) < 2:
+        raise ValueError("At least two corrections are needed for interpolation")
+
+    order = np.argsort(timestamps, kind='stable')
+    timestamps = timestamps[order]
+    shifts = shifts[order]
+    if np.any(np.diff(timestamps) <= 0):
+        raise ValueError("Correction timestamps must be unique")
+
+    if interpolation == 'linear':
+        slopes = np.diff(shifts, axis=0) / np.diff(timestamps)[:, None]
+        coefficients = np.stack([slopes, shifts[:-1]])
+    elif interpolation in SPLINE_INTERPOLATORS:
+        spline = SPLINE_INTERPOLATORS[interpolation](timestamps, shifts, axis=0)
+        coefficients = spline.c
+    else:
+        raise ValueError(f"Unknown interpolation '{interpolation}'")
+
+    return timestamps, coefficients
+
+
+def find_intervals(breakpoints, gps_times):
+    # Times outside the corrections use the first or last piece, which extrapolates it
+    return np.clip(np.searchsorted(breakpoints, gps_times, side='right') - 1, 0, len(breakpoints) - 2)
+
+
+def find_intervals_sorted(breakpoints, gps_times, first_interval):
+    # For sorted times only the breakpoints inside the chunk are searched for in the times, instead of
+    # searching every time in all breakpoints. "first_interval" is the interval of the previous chunk's last time.
+    candidates = breakpoints[first_interval + 1:len(breakpoints) - 1]
+    candidates = candidates[:np.searchsorted(candidates, gps_times[-1], side='right')]
+    starts = np.searchsorted(gps_times, candidates, side='left')
+    return first_interval + np.cumsum(np.bincount(starts, minlength=len(gps_times)))
+
+
+def interpolate_shifts(model, gps_times, intervals):
+    breakpoints, coefficients = model
+    dt = (gps_times - breakpoints[intervals])[:, None]
+    shifts = coefficients[0, intervals]
+    for power in range(1, coefficients.shape[0]):
+        shifts *= dt
+        shifts += coefficients[power, intervals]
+    return shifts
+
+
+def correct_points_chunked(input_file, output_file, model, chunk_size, metrics):
+    breakpoints = model[0]
+    with open_las(input_file) as reader:
+        with open_las(output_file, mode='w', header=reader.header) as writer:
+            interval = 0
+            last_time = -np.inf
+            for points in metrics.timed(reader.chunk_iterator(chunk_size)):
+                with metrics.stage('transform'):
+                    gps_times = np.asarray(points.gps_time)
+                    if gps_times[0] >= last_time and np.all(gps_times[1:] >= gps_times[:-1]):
+                        intervals = find_intervals_sorted(breakpoints, gps_times, interval)
+                    else:
+                        intervals = find_intervals(breakpoints, gps_times)
+                    interval = intervals[-1]
+                    last_time = gps_times[-1]
+
+                    shifts = interpolate_shifts(model, gps_times, intervals)
+                    points.x += shifts[:, 0]
+                    points.y += shifts[:, 1]
+                    points.z += shifts[:, 2]
+                with metrics.stage('write'):
+                    writer.write_points(points)
+                metrics.count(points=len(points))
+
+
+def correct_file_in_place(input_file, model, settings, manifest):
+    with laspy.open(input_file) as reader:
+        header = reader.header
+    if 'gps_time' not in header.point_format.dimension_names:
+        print(f"'gps_time' dimension not found in {os.path.basename(input_file)}. Skipping file.")
+        return
+
+    def get_deltas(points):
+        # Depends on gps_time only, which is not changed, so the same steps are found again for a rollback
+        gps_times = np.asarray(points['gps_time'])
+        return get_step_deltas(interpolate_shifts(model, gps_times, find_intervals(model[0], gps_times)), header.scales)
+
+    if has_journal(input_file):
+        if in_place_recovery == 'rollback':
+            rollback_in_place(input_file, get_deltas)
+            return
+    elif not manifest.needs_processing(input_file):
+        return
+
+    print(f"Correcting {os.path.basename(input_file)} in place...")
+    metrics = FileMetrics(__file__, input_file, input_file)
+    edit_in_place(input_file, __file__, settings, get_deltas, chunk_size or max(header.point_count, 1), metrics)
+    metrics.finish(interpolation=interpolation, mode='in_place')
+    manifest.record(input_file, [input_file])
+    print(f"Corrected {input_file} in place.")
+
 
 def apply_corrections(input_dir, output_dir, corrections):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    model = build_correction_model(corrections, interpolation)
+    settings = {'corrections': {key: np.asarray(values).tolist() for key, values in corrections.items()},
+                'interpolation': interpolation, 'in_place': in_place}
+    manifest = ProcessingManifest(output_dir, __file__, settings, incremental or watch or in_place)
+
     for filename in os.listdir(input_dir):
         if filename.endswith('.las') or filename.endswith('.laz'):
             input_file = os.path.join(input_dir, filename)
             output_file = os.path.join(output_dir, filename)
-            
+            if in_place and can_edit_in_place(input_file):
+                correct_file_in_place(input_file, model, settings, manifest)
+                continue
+            if not manifest.needs_processing(input_file):
+                continue
+
             print(f"Processing {filename}...")
-            las = laspy.read(input_file)
-            
-            if 'gps_time' not in las.point_format.dimension_names:
+            with laspy.open(input_file) as reader:
+                dimension_names = reader.header.point_format.dimension_names
+
+            if 'gps_time' not in dimension_names:
                 print(f"'gps_time' dimension not found in {filename}. Skipping file.")
                 continue
-            
-            gps_times = las.gps_time
-            x_corrections, y_corrections, z_corrections = interpolate_shifts(gps_times, corrections)
-            
-            las.x += x_corrections
-            las.y += y_corrections
-            las.z += z_corrections
-            
-            las.write(output_file)
+
+            metrics = FileMetrics(__file__, input_file, output_file)
+            if chunk_size is not None:
+                correct_points_chunked(input_file, output_file, model, chunk_size, metrics)
+                metrics.finish(interpolation=interpolation)
+                manifest.record(input_file, [output_file])
+                print(f"Modified point cloud saved to {output_file}.")
+                continue
+
+            with metrics.stage('read'):
+                las = read_las(input_file)
+            with metrics.stage('transform'):
+                gps_times = np.asarray(las.gps_time)
+                shifts = interpolate_shifts(model, gps_times, find_intervals(model[0], gps_times))
+
+                las.x += shifts[:, 0]
+                las.y += shifts[:, 1]
+                las.z += shifts[:, 2]
+
+            with metrics.stage('write'):
+                write_las(las, output_file)
+            metrics.count(points=len(las.points))
+            metrics.finish(interpolation=interpolation)
+            manifest.record(input_file, [output_file])
             print(f"Modified point cloud saved to {output_file}.")
 
 
-apply_corrections(input_dir, output_dir, corrections)
+def run_corrections():
+    if corrections_file is not None:
+        apply_corrections(input_dir, output_dir, load_corrections(corrections_file))
+    else:
+        apply_corrections(input_dir, output_dir, corrections)
+
+
+if __name__ == '__main__':
+    if watch:
+        watch_inputs(run_corrections, watch_interval)
+    else:
+        run_corrections()
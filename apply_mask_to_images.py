@@ -1,39 +1,118 @@
-# Applies a mask to images. 
-# The mask.png file should be black and white where the black areas will be masked out and white areas will remain visible. 
+# Applies a mask to images.
+# The mask.png file should be black and white where the black areas will be masked out and white areas will remain visible.
 # Ensure the image and the mask have the same dimensions.
+# For mixed camera rigs, "masks" maps image sizes (width, height) or camera IDs to further mask files. The camera ID is
+# taken from the image name with "camera_id_pattern". A camera ID mask is used before a size mask, then "mask_file_path".
+# Masks are loaded once and applied to the decoded pixels in place. Images are processed by "worker_count" threads.
+# Per-image stage timings are written as JSON lines when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
+# With "incremental" set, only new or changed images and images masked with other masks are processed, "watch" keeps
+# masking new images as they arrive, see incremental_processing.py.
 
 import os
+import re
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
+from processing_metrics import FileMetrics
+from incremental_processing import ProcessingManifest, get_fingerprint, watch as watch_inputs
+
 image_directory = 'images'
 mask_file_path = 'mask.png'
 output_directory = 'masked'
+masks = {}  # E.g. {(8192, 4096): 'mask_8k.png', 'cam2': 'mask_cam2.png'}
+camera_id_pattern = None  # E.g. r'^(cam\d+)_', the first group is the camera ID
+worker_count = 4
+incremental = False  # Skip images that were already masked with the same masks
+watch = False  # Keep running and mask new images every "watch_interval" seconds
+watch_interval = 60
+
+
+def load_mask(mask_path):
+    mask = np.array(Image.open(mask_path).convert("L"))
+    # Pure black and white masks are stored as the pixels to clear, other masks as blending weights
+    if np.all((mask == 0) | (mask == 255)):
+        return mask == 0
+    return mask
+
+
+def apply_mask_array(pixels, mask):
+    if mask.dtype == bool:
+        pixels[mask] = 0
+        return pixels
+    # Same rounding as compositing the image over a transparent background with Image.composite
+    blended = pixels.astype(np.uint16)
+    blended *= mask[..., None]
+    blended += 128
+    blended += blended >> 8
+    blended >>= 8
+    pixels[...] = blended
+    return pixels
+
+
+def select_mask(image_name, image_size, loaded_masks):
+    if camera_id_pattern is not None:
+        match = re.search(camera_id_pattern, image_name)
+        if match and match.group(1) in loaded_masks:
+            return loaded_masks[match.group(1)]
+    return loaded_masks.get(image_size)
+
+
+def mask_image(image_path, output_dir, loaded_masks, manifest):
+    image_name = os.path.basename(image_path)
+    masked_image_path = os.path.join(output_dir, image_name)
+    metrics = FileMetrics(__file__, image_path, masked_image_path)
+    with Image.open(image_path) as image:
+        mask = select_mask(image_name, image.size, loaded_masks)
+        if mask is None or mask.shape != (image.size[1], image.size[0]):
+            return f"Skipping {image_name}: Image and mask sizes do not match."
+
+        # PNGs keep the masked areas transparent, other formats get black
+        mode = 'RGBA' if image_path.lower().endswith('.png') else 'RGB'
+        with metrics.stage('read'):
+            pixels = np.array(image if image.mode == mode else image.convert(mode))
+
+    with metrics.stage('transform'):
+        apply_mask_array(pixels, mask)
+
+    with metrics.stage('write'):
+        # The mode follows from the uint8 array's channel count: RGB or RGBA
+        Image.fromarray(pixels).save(masked_image_path)
+    metrics.count(pixels=pixels.shape[0] * pixels.shape[1])
+    metrics.finish()
+    manifest.record(image_path, [masked_image_path])
+    return f"Mask applied to {image_name}, saved to {masked_image_path}"
+
 
 def apply_mask_to_images(image_dir, mask_path, output_dir):
-    mask = Image.open(mask_path).convert("L")
+    default_mask = load_mask(mask_path)
+    loaded_masks = {(default_mask.shape[1], default_mask.shape[0]): default_mask}
+    for key, path in masks.items():
+        loaded_masks[tuple(key) if isinstance(key, (list, tuple)) else key] = load_mask(path)
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for image_name in os.listdir(image_dir):
-        image_path = os.path.join(image_dir, image_name)
-
-        if image_path.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-            with Image.open(image_path) as image:
-                if image.size != mask.size:
-                    print(f"Skipping {image_name}: Image and mask sizes do not match.")
-                    continue
-
-                if image.mode != 'RGBA':
-                    image = image.convert("RGBA")
+    # Editing a mask file changes the output as much as switching to another one
+    settings = {
+        'masks': [[str(key), path, get_fingerprint(path)] for key, path in [('default', mask_path)] + list(masks.items())],
+        'camera_id_pattern': camera_id_pattern,
+    }
+    manifest = ProcessingManifest(output_dir, __file__, settings, incremental or watch)
 
-                masked_image = Image.composite(image, Image.new("RGBA", image.size, (0, 0, 0, 0)), mask)
+    image_paths = [
+        os.path.join(image_dir, image_name) for image_name in os.listdir(image_dir)
+        if image_name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))
+    ]
+    image_paths = [image_path for image_path in image_paths if manifest.needs_processing(image_path)]
 
-                if not image_path.lower().endswith('.png'):
-                    masked_image = masked_image.convert("RGB")
+    with ThreadPoolExecutor(max_workers=max(worker_count, 1)) as executor:
+        for message in executor.map(lambda image_path: mask_image(image_path, output_dir, loaded_masks, manifest), image_paths):
+            print(message)
 
-                masked_image_path = os.path.join(output_dir, image_name)
-                masked_image.save(masked_image_path)
-                print(f"Mask applied to {image_name}, saved to {masked_image_path}")
 
-apply_mask_to_images(image_directory, mask_file_path, output_directory)
+if __name__ == '__main__':
+    if watch:
+        watch_inputs(lambda: apply_mask_to_images(image_directory, mask_file_path, output_directory), watch_interval)
+    else:
+        apply_mask_to_images(image_directory, mask_file_path, output_directory)
@@ -1,36 +1,161 @@
 # Applies a xyz shift to all LAS/LAZ point clouds in a directory.
+# Points are processed in chunks of "chunk_size" points, so memory use does not depend on the file size.
+# Set "chunk_size" to None to read each file into memory at once instead.
+# If every shift is a whole number of scale steps, the shift is applied to the header offsets only:
+# the file is copied and its header patched without decoding or re-encoding any points.
+# Per-file stage timings are written as JSON lines when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
+# With "incremental" set, only new or changed files and files processed with other shifts are processed, "watch" keeps
+# processing new files as they arrive, see incremental_processing.py.
+# With "in_place" set, uncompressed .las inputs are shifted inside the input file instead of being copied to
+# "output_dir", see las_inplace.py. The shifts are rounded to whole scale steps. Files interrupted while being shifted
+# are resumed or rolled back on the next run ("in_place_recovery"). The manifest of processed files is always kept in
+# this mode, so a rerun does not shift the same files twice.
 
 import laspy
+import numpy as np
 import os
+import shutil
+import struct
+
+from processing_metrics import FileMetrics
+from laz_io import open_las, read_las, write_las
+from incremental_processing import ProcessingManifest, watch as watch_inputs
+from las_inplace import HEADER_OFFSETS_POSITION, can_edit_in_place, has_journal, edit_in_place, rollback_in_place, get_step_deltas
 
 # Configuration
-input_dir = 'laz'  
-output_dir = 'laz_shifted'  
-x_shift = -0.1  
-y_shift = -0.8 
-z_shift = 1.7 
+input_dir = 'laz'
+output_dir = 'laz_shifted'
+x_shift = -0.1
+y_shift = -0.8
+z_shift = 1.7
+chunk_size = 1_000_000  # Points per chunk, None reads the whole file at once
+header_offset_fast_path = True
+incremental = False  # Skip files that were already shifted with the same shifts
+watch = False  # Keep running and shift new files every "watch_interval" seconds
+watch_interval = 60
+in_place = False  # Shift uncompressed .las files in place instead of writing copies
+in_place_recovery = 'resume'  # 'resume' or 'rollback' files left unfinished by an interrupted in-place run
+
+
+def is_exact_header_shift(header, shifts):
+    # Shifting the offsets gives the same coordinates as rewriting the points only when
+    # the shift moves the points by a whole number of scale steps
+    steps = np.asarray(shifts) / header.scales
+    if not np.allclose(steps, np.round(steps), rtol=0, atol=1e-6):
+        return False
+    # COPC files store the octree bounds in their own VLR, which would no longer match the points
+    return not any(vlr.user_id == 'copc' for vlr in header.vlrs)
+
+
+def shift_header_offsets(input_file, output_file, header, shifts, metrics):
+    offsets = header.offsets + shifts
+    mins = header.mins + shifts
+    maxs = header.maxs + shifts
+
+    with metrics.stage('write'):
+        shutil.copyfile(input_file, output_file)
+        with open(output_file, 'r+b') as f:
+            f.seek(HEADER_OFFSETS_POSITION)
+            f.write(struct.pack('<9d', *offsets, maxs[0], mins[0], maxs[1], mins[1], maxs[2], mins[2]))
+    metrics.count(points=header.point_count)
+
+
+def shift_points_chunked(input_file, output_file, shifts, chunk_size, metrics):
+    with open_las(input_file) as reader:
+        with open_las(output_file, mode='w', header=reader.header) as writer:
+            for points in metrics.timed(reader.chunk_iterator(chunk_size)):
+                with metrics.stage('transform'):
+                    points.x += shifts[0]
+                    points.y += shifts[1]
+                    points.z += shifts[2]
+                with metrics.stage('write'):
+                    writer.write_points(points)
+                metrics.count(points=len(points))
+
+
+def shift_file_in_place(input_file, shifts, settings, manifest):
+    with laspy.open(input_file) as reader:
+        header = reader.header
+    deltas = get_step_deltas(shifts, header.scales)
+
+    def get_deltas(points):
+        return np.broadcast_to(deltas, (len(points), 3))
+
+    if has_journal(input_file):
+        if in_place_recovery == 'rollback':
+            rollback_in_place(input_file, get_deltas)
+            return
+    elif not manifest.needs_processing(input_file):
+        return
+
+    print(f"Shifting {os.path.basename(input_file)} in place...")
+    metrics = FileMetrics(__file__, input_file, input_file)
+    header_shifts = shifts if header_offset_fast_path and is_exact_header_shift(header, shifts) else None
+    edit_in_place(input_file, __file__, settings, get_deltas, chunk_size or max(header.point_count, 1), metrics,
+                  header_shifts)
+    metrics.finish(mode='in_place')
+    manifest.record(input_file, [input_file])
+    print(f"Shifted {input_file} in place.")
+
 
 def apply_xyz_shift(input_dir, output_dir, x_shift, y_shift, z_shift):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    
+
+    shifts = np.array([x_shift, y_shift, z_shift], dtype=np.float64)
+    settings = {'shifts': shifts.tolist(), 'in_place': in_place}
+    manifest = ProcessingManifest(output_dir, __file__, settings, incremental or watch or in_place)
+
     for filename in os.listdir(input_dir):
         if filename.endswith('.las') or filename.endswith('.laz'):
             input_file = os.path.join(input_dir, filename)
             output_file = os.path.join(output_dir, filename)
-            
+            if in_place and can_edit_in_place(input_file):
+                shift_file_in_place(input_file, shifts, settings, manifest)
+                continue
+            if not manifest.needs_processing(input_file):
+                continue
+
             print(f"Processing {filename}...")
-            
-            las = laspy.read(input_file)
-            
+            metrics = FileMetrics(__file__, input_file, output_file)
+
+            if header_offset_fast_path:
+                with laspy.open(input_file) as reader:
+                    header = reader.header
+                if is_exact_header_shift(header, shifts):
+                    shift_header_offsets(input_file, output_file, header, shifts, metrics)
+                    metrics.finish(mode='header')
+                    manifest.record(input_file, [output_file])
+                    print(f"Shifted header offsets, saved to {output_file}.")
+                    continue
+
+            if chunk_size is not None:
+                shift_points_chunked(input_file, output_file, shifts, chunk_size, metrics)
+                metrics.finish(mode='chunked')
+                manifest.record(input_file, [output_file])
+                print(f"Modified point cloud saved to {output_file}.")
+                continue
+
+            with metrics.stage('read'):
+                las = read_las(input_file)
+
             # Apply shifts
-            las.x += x_shift
-            las.y += y_shift
-            las.z += z_shift
-         
-            las.write(output_file)
-            
+            with metrics.stage('transform'):
+                las.x += x_shift
+                las.y += y_shift
+                las.z += z_shift
+
+            with metrics.stage('write'):
+                write_las(las, output_file)
+            metrics.count(points=len(las.points))
+            metrics.finish(mode='in_memory')
+            manifest.record(input_file, [output_file])
+
             print(f"Modified point cloud saved to {output_file}.")
 
 
-apply_xyz_shift(input_dir, output_dir, x_shift, y_shift, z_shift)
+if __name__ == '__main__':
+    if watch:
+        watch_inputs(lambda: apply_xyz_shift(input_dir, output_dir, x_shift, y_shift, z_shift), watch_interval)
+    else:
+        apply_xyz_shift(input_dir, output_dir, x_shift, y_shift, z_shift)
@@ -0,0 +1,191 @@
+# Generates synthetic input data for the benchmarks in run_benchmarks.py.
+# Writes overlapping LAZ flight strips in EPSG:3301 with gps_time and an extra "Distance" dimension (the range from the
+# scanner), a corrections CSV for the strips, equirectangular JPEG frames, 2:1 and wider panoramas, black and white
+# and feathered masks, a DEM GeoTIFF (only when GDAL is installed) and polyline shapefiles.
+# Every strip has a small systematic offset, so overlapping strips don't match exactly.
+# The amounts below are for "scale" 1, "--scale" multiplies the point, frame and pixel counts.
+# Usage: python generate_synthetic_data.py [--data-dir benchmark_data] [--scale 1.0]
+
+import argparse
+import os
+import numpy as np
+import cv2
+import laspy
+import pyproj
+import geopandas as gpd
+from shapely.geometry import LineString
+
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    gdal = None
+
+data_dir = 'benchmark_data'
+strip_count = 4
+points_per_strip = 2_000_000
+strip_length = 2000
+strip_width = 400
+strip_spacing = 300  # Distance between the strip centre lines, less than "strip_width" so the strips overlap
+flying_height = 80
+flying_speed = 50  # Meters per second, sets the gps_time span of a strip
+strip_origin = (540000, 6580000)
+frame_count = 24
+frame_size = (4096, 2048)
+panorama_size = (4096, 1400)
+dem_size = 4000
+dem_pixel_size = 1
+polyline_length = 300_000  # The long route for the polyline tiler
+polyline_vertex_spacing = 20
+write_chunk_size = 1_000_000
+seed = 0
+
+
+def terrain_height(x, y):
+    return 30 + 5 * np.sin(x / 150) + 4 * np.cos(y / 120)
+
+
+def get_strip_offsets(strip_index):
+    # The systematic error of a strip, which the strip adjustment is expected to find
+    return np.array([0.05, -0.03, 0.04]) * strip_index
+
+
+def generate_las_strips(output_dir, strip_count, points_per_strip):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    rng = np.random.default_rng(seed)
+    strip_duration = strip_length / flying_speed
+
+    for strip_index in range(strip_count):
+        header = laspy.LasHeader(point_format=6, version='1.4')
+        header.add_extra_dim(laspy.ExtraBytesParams(name='Distance', type=np.float32))
+        header.scales = [0.001, 0.001, 0.001]
+        header.offsets = [strip_origin[0], strip_origin[1], 0]
+        header.add_crs(pyproj.CRS.from_epsg(3301))
+
+        centre_y = strip_origin[1] + strip_index * strip_spacing
+        start_time = 1706468131 + strip_index * strip_duration * 2
+        offsets = get_strip_offsets(strip_index)
+        output_path = os.path.join(output_dir, f'strip_{strip_index:02d}.laz')
+
+        with laspy.open(output_path, mode='w', header=header) as writer:
+            for start in range(0, points_per_strip, write_chunk_size):
+                count = min(write_chunk_size, points_per_strip - start)
+                # Points in flight order, the along track position grows with the point index
+                along = (start + np.sort(rng.uniform(0, count, count))) / points_per_strip * strip_length
+                across = rng.uniform(-strip_width / 2, strip_width / 2, count)
+                x = strip_origin[0] + along
+                y = centre_y + across
+
+                points = laspy.ScaleAwarePointRecord.zeros(count, header=header)
+                points.x = x + offsets[0]
+                points.y = y + offsets[1]
+                points.z = terrain_height(x, y) + rng.normal(0, 0.02, count) + offsets[2]
+                points.gps_time = start_time + along / flying_speed
+                points.intensity = rng.integers(0, 4096, count)
+                points.point_source_id = np.full(count, strip_index + 1)
+                points.Distance = np.hypot(across, flying_height) + rng.uniform(-60, 20, count)
+                writer.write_points(points)
+        print(f"Wrote {output_path}")
+
+
+def generate_corrections(output_path, strip_count):
+    # A slowly drifting correction over the time span of all strips
+    strip_duration = strip_length / flying_speed
+    timestamps = 1706468131 + np.linspace(0, strip_count * strip_duration * 2, 20)
+    phase = np.linspace(0, np.pi, len(timestamps))
+    corrections = np.column_stack([timestamps, 0.4 * np.cos(phase), 0.3 * np.sin(phase), -0.7 + 0.2 * phase])
+    np.savetxt(output_path, corrections, delimiter=',', header='timestamp,x_shift,y_shift,z_shift', comments='', fmt='%.6f')
+    print(f"Wrote {output_path}")
+
+
+def create_test_image(width, height, frame_index):
+    # Smooth gradients with some texture, which compresses like a real image instead of noise
+    x = np.linspace(0, 8 * np.pi, width, dtype=np.float32) + frame_index * 0.1
+    y = np.linspace(0, 4 * np.pi, height, dtype=np.float32)[:, None]
+    base = 127 + 60 * np.sin(x) * np.cos(y) + 40 * np.sin(3 * x + y)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = np.clip(base, 0, 255)
+    image[..., 1] = np.clip(base[::-1], 0, 255)
+    image[..., 2] = np.clip(255 - base, 0, 255)
+    return image
+
+
+def generate_frames(output_dir, frame_count, size, prefix):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for frame_index in range(frame_count):
+        image = create_test_image(size[0], size[1], frame_index)
+        cv2.imwrite(os.path.join(output_dir, f'{prefix}_{frame_index:05d}.jpg'), image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    print(f"Wrote {frame_count} images to {output_dir}")
+
+
+def generate_masks(output_dir, size):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # The car roof at the bottom of the image is masked out
+    height = np.arange(size[1])[:, None]
+    binary = np.where(height < size[1] * 0.8, 255, 0).astype(np.uint8) * np.ones((1, size[0]), dtype=np.uint8)
+    cv2.imwrite(os.path.join(output_dir, 'mask.png'), binary)
+    # The same mask with a soft edge
+    feathered = np.clip((size[1] * 0.85 - height) / (size[1] * 0.05) * 255, 0, 255).astype(np.uint8)
+    cv2.imwrite(os.path.join(output_dir, 'mask_feathered.png'), feathered * np.ones((1, size[0]), dtype=np.uint8))
+    print(f"Wrote masks to {output_dir}")
+
+
+def generate_dem(output_path, size):
+    if gdal is None:
+        print("GDAL is not installed, skipping the DEM.")
+        return
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(output_path, size, size, 1, gdal.GDT_Float32, ['TILED=YES', 'COMPRESS=LZW'])
+    dataset.SetGeoTransform([strip_origin[0], dem_pixel_size, 0, strip_origin[1] + size * dem_pixel_size, 0, -dem_pixel_size])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3301)
+    dataset.SetProjection(srs.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    x = strip_origin[0] + (np.arange(size) + 0.5) * dem_pixel_size
+    for row in range(0, size, 512):
+        rows = min(512, size - row)
+        y = strip_origin[1] + (size - row - np.arange(rows)[:, None] - 0.5) * dem_pixel_size
+        band.WriteArray(terrain_height(x, y).astype(np.float32), 0, row)
+    dataset = None
+    print(f"Wrote {output_path}")
+
+
+def generate_polylines(output_dir, strip_count):
+    # A long winding route for the polyline tiler and a short corridor over the strips for the point cloud tiler
+    distances = np.arange(0, polyline_length + polyline_vertex_spacing, polyline_vertex_spacing)
+    route = LineString(np.column_stack([
+        strip_origin[0] + distances, strip_origin[1] + 3000 * np.sin(distances / 7000) + 200 * np.sin(distances / 700)
+    ]))
+    corridor_y = strip_origin[1] + (strip_count - 1) * strip_spacing / 2
+    corridor = LineString([(strip_origin[0], corridor_y), (strip_origin[0] + strip_length, corridor_y)])
+
+    for name, line in [('route.shp', route), ('corridor.shp', corridor)]:
+        output_path = os.path.join(output_dir, name)
+        gpd.GeoDataFrame({'geometry': [line]}, crs='EPSG:3301').to_file(output_path)
+        print(f"Wrote {output_path}")
+
+
+def generate_all(data_dir, scale):
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    generate_las_strips(os.path.join(data_dir, 'laz'), strip_count, max(int(points_per_strip * scale), 1000))
+    generate_corrections(os.path.join(data_dir, 'corrections.csv'), strip_count)
+    frames = max(int(frame_count * scale), 2)
+    generate_frames(os.path.join(data_dir, 'equirectangular'), frames, frame_size, 'frame')
+    generate_frames(os.path.join(data_dir, 'panoramas'), frames, panorama_size, 'panorama')
+    generate_masks(os.path.join(data_dir, 'masks'), frame_size)
+    generate_dem(os.path.join(data_dir, 'dem.tif'), max(int(dem_size * np.sqrt(scale)), 100))
+    generate_polylines(data_dir, strip_count)
+    with open(os.path.join(data_dir, 'scale.txt'), 'w') as f:
+        f.write(str(scale))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic benchmark data.')
+    parser.add_argument('--data-dir', default=data_dir)
+    parser.add_argument('--scale', type=float, default=1.0)
+    args = parser.parse_args()
+    generate_all(args.data_dir, args.scale)
@@ -0,0 +1,340 @@
+# Runs the processing scripts on the synthetic data from generate_synthetic_data.py and reports their throughput.
+# Every benchmark runs in its own child process, so the peak memory (RSS) of one does not hide another. The report
+# has the wall time, points, frames, pixels or kilometres per second, input MB per second and peak RSS.
+# Benchmarks whose dependencies (PDAL, GDAL) are not installed are reported as skipped.
+# "--save-baseline" stores the results in "baseline_path". Later runs compare against it and flag every benchmark
+# that got more than "slowdown_tolerance" slower, the exit code is then 1.
+# Usage: python run_benchmarks.py [--data-dir benchmark_data] [--work-dir benchmark_work] [--scale 1.0]
+#                                 [--repeat 1] [--save-baseline] [benchmark names...]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from processing_metrics import get_peak_rss_mb, get_size
+
+data_dir = 'benchmark_data'
+work_dir = 'benchmark_work'
+baseline_path = os.path.join(BENCHMARKS_DIR, 'baselines.json')
+slowdown_tolerance = 0.2  # Flag benchmarks more than 20 % slower than the baseline
+output_resolution = (1280, 1024)
+
+
+def get_las_totals(laz_dir):
+    import laspy
+    point_count = 0
+    for filename in os.listdir(laz_dir):
+        if filename.endswith('.las') or filename.endswith('.laz'):
+            with laspy.open(os.path.join(laz_dir, filename)) as reader:
+                point_count += reader.header.point_count
+    return {'items': point_count, 'unit': 'points', 'bytes_in': get_size(laz_dir)}
+
+
+def get_image_totals(image_dir):
+    image_count = len([name for name in os.listdir(image_dir) if name.endswith('.jpg')])
+    return {'items': image_count, 'unit': 'frames', 'bytes_in': get_size(image_dir)}
+
+
+def bench_xyz_shift(data_dir, output_dir):
+    import apply_xyz_shift_to_pointclouds as script
+    script.header_offset_fast_path = False
+    script.apply_xyz_shift(os.path.join(data_dir, 'laz'), output_dir, -0.1, -0.8, 1.7)
+    return get_las_totals(os.path.join(data_dir, 'laz'))
+
+
+def bench_xyz_shift_header(data_dir, output_dir):
+    import apply_xyz_shift_to_pointclouds as script
+    script.header_offset_fast_path = True
+    script.apply_xyz_shift(os.path.join(data_dir, 'laz'), output_dir, -0.1, -0.8, 1.7)
+    return get_las_totals(os.path.join(data_dir, 'laz'))
+
+
+def bench_corrections(interpolation):
+    def bench(data_dir, output_dir):
+        import apply_interpolated_corrections_to_pointclouds as script
+        script.interpolation = interpolation
+        corrections = script.load_corrections(os.path.join(data_dir, 'corrections.csv'))
+        script.apply_corrections(os.path.join(data_dir, 'laz'), output_dir, corrections)
+        return get_las_totals(os.path.join(data_dir, 'laz'))
+    return bench
+
+
+def bench_filter(expression):
+    def bench(data_dir, output_dir):
+        import filter_pointclouds_by_dimension as script
+        script.filter_expression = expression
+        script.filter_laz_by_dimension(os.path.join(data_dir, 'laz'), output_dir, 'Distance', 2.5, 100)
+        return get_las_totals(os.path.join(data_dir, 'laz'))
+    return bench
+
+
+def bench_reprojection(reprojection_mode):
+    def bench(data_dir, output_dir):
+        import convert_pointcloud_to_wgs as script
+        script.reprojection_mode = reprojection_mode
+        script.convert_pointclouds(os.path.join(data_dir, 'laz'), output_dir)
+        return get_las_totals(os.path.join(data_dir, 'laz'))
+    return bench
+
+
+def bench_pipeline(data_dir, output_dir):
+    import process_pointclouds_with_pipeline as script
+    script.run_pipeline({
+        'input_dir': os.path.join(data_dir, 'laz'),
+        'output_dir': output_dir,
+        'stages': [
+            {'type': 'filter', 'expression': '2.5 <= Distance <= 100'},
+            {'type': 'interpolated_corrections', 'corrections_file': os.path.join(data_dir, 'corrections.csv')},
+            {'type': 'xyz_shift', 'x_shift': -0.1, 'y_shift': -0.8, 'z_shift': 1.7},
+            {'type': 'reprojection', 'src_epsg_code': 'EPSG:3301', 'tgt_epsg_code': 'EPSG:4326'},
+        ],
+    })
+    return get_las_totals(os.path.join(data_dir, 'laz'))
+
+
+def bench_polyline_tiles(data_dir, output_dir):
+    import geopandas as gpd
+    import generate_tile_boundaries_along_a_polyline as script
+    route_path = os.path.join(data_dir, 'route.shp')
+    line = gpd.read_file(route_path).unary_union
+    tiles = script.generate_linear_tiles(line, script.buffer_width, script.distance_between_points)
+    print(f"Generated {len(tiles)} tiles")
+    return {'items': line.length / 1000, 'unit': 'km', 'bytes_in': get_size(route_path)}
+
+
+def bench_tile_pointclouds(tiling_mode):
+    def bench(data_dir, output_dir):
+        import geopandas as gpd
+        import numpy as np
+        import tile_pointclouds_based_on_SHP_boundaries as script
+        import generate_tile_boundaries_along_a_polyline as tile_boundaries
+        corridor = gpd.read_file(os.path.join(data_dir, 'corridor.shp'))
+        tiles = tile_boundaries.generate_linear_tiles(corridor.unary_union, 300, 500)
+        shp_path = os.path.join(output_dir, 'tiles.shp')
+        gpd.GeoDataFrame({'FID': np.arange(len(tiles)), 'geometry': tiles}, crs=corridor.crs).to_file(shp_path)
+
+        script.tiling_mode = tiling_mode
+        script.manifest_path = os.path.join(output_dir, 'tile_manifest.json')
+        script.tile_pointclouds(os.path.join(data_dir, 'laz'), shp_path, os.path.join(output_dir, 'laz_extent_index.json'))
+        return get_las_totals(os.path.join(data_dir, 'laz'))
+    return bench
+
+
+def bench_mask(mask_name):
+    def bench(data_dir, output_dir):
+        import apply_mask_to_images as script
+        image_dir = os.path.join(data_dir, 'equirectangular')
+        script.apply_mask_to_images(image_dir, os.path.join(data_dir, 'masks', mask_name), output_dir)
+        return get_image_totals(image_dir)
+    return bench
+
+
+def bench_panorama(padding_mode):
+    def bench(data_dir, output_dir):
+        import convert_random_panorama_to_equirectangular as script
+        script.padding_mode = padding_mode
+        image_dir = os.path.join(data_dir, 'panoramas')
+        script.process_folder(image_dir, output_dir)
+        return get_image_totals(image_dir)
+    return bench
+
+
+def bench_video(projection_mode):
+    def bench(data_dir, output_dir):
+        from PIL import Image
+        import create_video_from_equirectangular_cutout as script
+        image_dir = os.path.join(data_dir, 'equirectangular')
+        with Image.open(os.path.join(image_dir, sorted(os.listdir(image_dir))[0])) as image:
+            input_resolution = image.size
+        script.projection_mode = projection_mode
+        script.resized_images_folder = os.path.join(output_dir, 'resized')
+        script.remap_cache_folder = os.path.join(output_dir, 'remap_cache')
+        script.process_images_and_create_video(image_dir, output_dir, script.fps, script.horizontal_fov_deg,
+                                               script.vertical_fov_deg, script.horizontal_rotation_deg,
+                                               input_resolution, output_resolution)
+        return get_image_totals(image_dir)
+    return bench
+
+
+def bench_dem(data_dir, output_dir):
+    import convert_dem_to_wgs as script
+    from osgeo import gdal
+    dem_path = os.path.join(data_dir, 'dem.tif')
+    if not os.path.exists(dem_path):
+        raise ImportError("no DEM in the benchmark data, it needs GDAL to generate")
+    script.output_directory = output_dir
+    script.convert_dem(dem_path)
+    dataset = gdal.Open(dem_path)
+    return {'items': dataset.RasterXSize * dataset.RasterYSize, 'unit': 'pixels', 'bytes_in': get_size(dem_path)}
+
+
+BENCHMARKS = {
+    'xyz_shift': bench_xyz_shift,
+    'xyz_shift_header': bench_xyz_shift_header,
+    'corrections_linear': bench_corrections('linear'),
+    'corrections_cubic': bench_corrections('cubic'),
+    'filter_range': bench_filter(None),
+    'filter_expression': bench_filter('2.5 <= Distance <= 100 and intensity > 100'),
+    'reprojection_exact': bench_reprojection('exact'),
+    'reprojection_approximate': bench_reprojection('approximate'),
+    'reprojection_pdal': bench_reprojection('pdal'),
+    'pipeline': bench_pipeline,
+    'polyline_tiles': bench_polyline_tiles,
+    'tile_streaming': bench_tile_pointclouds('streaming'),
+    'tile_pipeline': bench_tile_pointclouds('pipeline'),
+    'mask_binary': bench_mask('mask.png'),
+    'mask_feathered': bench_mask('mask_feathered.png'),
+    'panorama_pixels': bench_panorama('pixels'),
+    'panorama_metadata': bench_panorama('metadata'),
+    'video_flat': bench_video('flat'),
+    'video_rectilinear': bench_video('rectilinear'),
+    'dem': bench_dem,
+}
+
+
+def run_benchmark(name, data_dir, output_dir, result_path):
+    # Runs in the child process. Scripts that write to the working directory write to the output directory.
+    os.chdir(output_dir)
+    start_time = time.perf_counter()
+    try:
+        result = BENCHMARKS[name](data_dir, output_dir)
+    except ImportError as e:
+        result = {'skipped': str(e)}
+    else:
+        result['elapsed'] = time.perf_counter() - start_time
+        result['peak_rss_mb'] = get_peak_rss_mb()
+        result['bytes_out'] = get_size(output_dir)
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+def run_in_child(name, data_dir, work_dir):
+    output_dir = os.path.join(work_dir, name)
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    result_path = os.path.join(work_dir, f'{name}_result.json')
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-one', name, '--data-dir', data_dir,
+         '--work-dir', output_dir, '--result-file', result_path],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    if process.returncode != 0 or not os.path.exists(result_path):
+        return {'failed': process.stdout[-2000:]}
+    with open(result_path) as f:
+        result = json.load(f)
+    os.remove(result_path)
+    return result
+
+
+def load_baselines(baseline_path):
+    if not os.path.exists(baseline_path):
+        return {}
+    with open(baseline_path) as f:
+        return json.load(f)
+
+
+def compare_to_baseline(result, baseline):
+    # Returns the rate change against the baseline and whether it is a slowdown
+    if baseline is None or 'rate' not in result or 'rate' not in baseline:
+        return None, False
+    change = result['rate'] / baseline['rate'] - 1
+    return change, change < -slowdown_tolerance
+
+
+def format_row(name, result, baseline):
+    if 'skipped' in result:
+        return f"{name:<26} skipped: {result['skipped']}"
+    if 'failed' in result:
+        return f"{name:<26} FAILED"
+    change, slowdown = compare_to_baseline(result, baseline)
+    peak_rss = '-' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f}"
+    row = (f"{name:<26} {result['elapsed']:>9.2f} {result['rate']:>14,.1f} {result['unit'] + '/s':<10}"
+           f" {result['mb_per_second']:>9.1f} {peak_rss:>9}")
+    if change is not None:
+        row += f" {change:>+8.1%}" + ("  SLOWER" if slowdown else "")
+    return row
+
+
+def run_benchmarks(names, data_dir, work_dir, repeat, save_baseline):
+    data_dir = os.path.abspath(data_dir)
+    work_dir = os.path.abspath(work_dir)
+    if not os.path.exists(data_dir):
+        raise FileNotFoundError(f"{data_dir} not found, run generate_synthetic_data.py or pass --scale to generate it")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    with open(os.path.join(data_dir, 'scale.txt')) as f:
+        scale = float(f.read())
+
+    baselines = load_baselines(baseline_path)
+    if baselines and baselines.get('scale') != scale:
+        print(f"Warning: the baseline was measured at scale {baselines.get('scale')}, the data has scale {scale}.")
+
+    print(f"{'benchmark':<26} {'time (s)':>9} {'rate':>14} {'':<10} {'MB/s':>9} {'RSS (MB)':>9} {'vs base':>8}")
+    results = {}
+    slowdowns = []
+    for name in names:
+        # The fastest of the repeats is the least disturbed by other load on the machine
+        runs = [run_in_child(name, data_dir, work_dir) for _ in range(max(repeat, 1))]
+        result = min(runs, key=lambda run: run.get('elapsed', float('inf')))
+        if 'elapsed' in result:
+            result['peak_rss_mb'] = max((run['peak_rss_mb'] for run in runs if run.get('peak_rss_mb') is not None), default=None)
+            result['rate'] = result['items'] / result['elapsed']
+            result['mb_per_second'] = result['bytes_in'] / (1024 * 1024) / result['elapsed']
+        results[name] = result
+
+        baseline = baselines.get('benchmarks', {}).get(name)
+        print(format_row(name, result, baseline))
+        if 'failed' in result:
+            print(result['failed'])
+        if compare_to_baseline(result, baseline)[1]:
+            slowdowns.append(name)
+
+    if save_baseline:
+        saved = baselines if baselines.get('scale') == scale else {'scale': scale, 'benchmarks': {}}
+        saved['benchmarks'].update({name: result for name, result in results.items() if 'elapsed' in result})
+        temp_path = baseline_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(saved, f, indent=2)
+        os.replace(temp_path, baseline_path)
+        print(f"Saved the baseline to {baseline_path}")
+
+    if slowdowns:
+        print(f"{len(slowdowns)} benchmarks are more than {slowdown_tolerance:.0%} slower than the baseline: {slowdowns}")
+    return slowdowns
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the processing scripts on synthetic data.')
+    parser.add_argument('names', nargs='*', help=f"Benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--data-dir', default=data_dir)
+    parser.add_argument('--work-dir', default=work_dir)
+    parser.add_argument('--scale', type=float, help='Generate the data at this scale first')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_benchmark(args.run_one, args.data_dir, args.work_dir, args.result_file)
+        sys.exit(0)
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {unknown}")
+
+    if args.scale is not None:
+        from generate_synthetic_data import generate_all
+        generate_all(args.data_dir, args.scale)
+
+    slowdowns = run_benchmarks(args.names or list(BENCHMARKS), args.data_dir, args.work_dir, args.repeat, args.save_baseline)
+    sys.exit(1 if slowdowns else 0)
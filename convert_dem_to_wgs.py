@@ -1,66 +1,250 @@
 # Converts Land Board DEM from EPSG:3301 to WGS84.
 # Run using OSGeo4WShell.
-# Does not convert EH2000 heights to ellipsoid heights!!!
+# Heights stay EH2000 heights unless "geoid_grid_path" is set to a geoid model grid (GTX), then they are converted to
+# ellipsoidal heights: the DEM is warped to a temporary tiled GeoTIFF, the interpolated geoid undulations are added block
+# by block and the result is written as the COG, see geoid_grid.py. Pixels outside the geoid model become nodata.
+# The output is written as tiled Cloud-Optimized GeoTIFFs with overviews (needs GDAL 3.1 or newer).
+# "processing_mode" 'per_file' converts each DEM file on its own, "worker_count" files in parallel.
+# 'mosaic' builds a VRT mosaic of all DEM files and warps it into a single COG.
+# Warping is multithreaded with a warp memory limit of "warp_memory_limit_mb".
+# Per-file timings are written as JSON lines when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
+# In 'per_file' mode "incremental" only converts new or changed DEM files and files converted with other settings,
+# "watch" keeps converting new files as they arrive, see incremental_processing.py.
 
 
 import os
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from osgeo import gdal, osr
 import glob
+import numpy as np
+
+from processing_metrics import FileMetrics
+from incremental_processing import ProcessingManifest, watch as watch_inputs
+from geoid_grid import load_geoid_grid, interpolate_undulation
 
 input_directory = 'dem_original'
 output_directory = 'dem_wgs84'
-
-if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
-
-dem_files = glob.glob(os.path.join(input_directory, '*.tif'))
 src_epsg_code = 3301
+processing_mode = 'per_file'  # 'per_file' or 'mosaic'
+mosaic_filename = 'dem_mosaic_wgs84.tif'
+worker_count = 1  # DEM files converted in parallel in 'per_file' mode
+warp_memory_limit_mb = 1024
+cog_block_size = 512
+edge_densify_points = 21  # Points per edge used to compute the output bounds
+incremental = False  # Skip DEM files that were already converted with the same settings
+watch = False  # Keep running and convert new DEM files every "watch_interval" seconds
+watch_interval = 60
+geoid_grid_path = None  # E.g. 'EST-GEOID2017.gtx' to convert EH2000 heights to ellipsoidal heights
 
-for dem_file in dem_files:
-    src_ds = gdal.Open(dem_file, gdal.GA_ReadOnly)
-    if src_ds is None:
-        print(f"Unable to open {dem_file}")
-        continue
-    
+
+@functools.lru_cache(maxsize=None)
+def get_transform():
+    # Created once per process and reused for every file
     src_proj = osr.SpatialReference()
     src_proj.ImportFromEPSG(src_epsg_code)
-    
+    src_proj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
     tgt_proj = osr.SpatialReference()
     tgt_proj.ImportFromEPSG(4326)
-    
-    transform = osr.CoordinateTransformation(src_proj, tgt_proj)
-    
+    tgt_proj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return tgt_proj.ExportToWkt(), osr.CoordinateTransformation(src_proj, tgt_proj)
+
+
+def get_output_bounds(src_ds):
+    # Transform points along all four edges, so rotated or curved extents are not clipped
+    _, transform = get_transform()
     gt = src_ds.GetGeoTransform()
-    minx = gt[0]
-    miny = gt[3] + gt[5] * src_ds.RasterYSize
-    maxx = gt[0] + gt[1] * src_ds.RasterXSize
-    maxy = gt[3]
-    
-    minx, miny, _ = transform.TransformPoint(minx, miny)[:3]
-    maxx, maxy, _ = transform.TransformPoint(maxx, maxy)[:3]
-    
-    output_file = os.path.join(output_directory, os.path.basename(dem_file))
-    
-    # Create WarpOptions object
+    width, height = src_ds.RasterXSize, src_ds.RasterYSize
+    steps = [i / (edge_densify_points - 1) for i in range(edge_densify_points)]
+    edge_pixels = (
+        [(width * s, 0) for s in steps] + [(width * s, height) for s in steps]
+        + [(0, height * s) for s in steps] + [(width, height * s) for s in steps]
+    )
+    edge_points = [(gt[0] + px * gt[1] + py * gt[2], gt[3] + px * gt[4] + py * gt[5]) for px, py in edge_pixels]
+    transformed = transform.TransformPoints(edge_points)
+    xs = [p[0] for p in transformed]
+    ys = [p[1] for p in transformed]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def get_cog_creation_options(warp_threads):
+    return [
+        'COMPRESS=LZW',
+        'PREDICTOR=YES',
+        f'BLOCKSIZE={cog_block_size}',
+        'OVERVIEWS=AUTO',
+        'BIGTIFF=IF_SAFER',
+        f'NUM_THREADS={warp_threads}',
+    ]
+
+
+def warp_to_cog(src_ds, output_file, output_bounds, warp_threads, metrics):
+    dst_wkt, _ = get_transform()
+    if geoid_grid_path is None:
+        output_format = 'COG'
+        creation_options = get_cog_creation_options(warp_threads)
+        warp_file = output_file
+    else:
+        # Warped to a tiled GeoTIFF first, so the heights can be converted block by block before the COG is written
+        output_format = 'GTiff'
+        creation_options = ['TILED=YES', f'BLOCKXSIZE={cog_block_size}', f'BLOCKYSIZE={cog_block_size}', 'BIGTIFF=IF_SAFER']
+        warp_file = output_file + '.warped.tif'
     warp_options = gdal.WarpOptions(
-        format='GTiff',
-        outputBounds=[minx, miny, maxx, maxy],
-        dstSRS=tgt_proj.ExportToWkt(),
+        format=output_format,
+        outputBounds=output_bounds,
+        dstSRS=dst_wkt,
         resampleAlg=gdal.GRA_Bilinear,
-        srcNodata=-9999,  
-        dstNodata=-9999,  
-        creationOptions=['COMPRESS=LZW', 'PREDICTOR=2'],  
+        srcNodata=-9999,
+        dstNodata=-9999,
+        multithread=True,
+        warpMemoryLimit=warp_memory_limit_mb * 1024 * 1024,
+        warpOptions=[f'NUM_THREADS={warp_threads}'],
+        creationOptions=creation_options,
         outputType=gdal.GDT_Float32
-        )
-    
-    result = gdal.Warp(output_file, src_ds, warpOptions=warp_options)
-    
+    )
+    with metrics.stage('warp'):
+        result = gdal.Warp(warp_file, src_ds, options=warp_options)
+    if geoid_grid_path is None or result is None:
+        return result
+
+    with metrics.stage('geoid'):
+        add_geoid_undulations(result)
+    with metrics.stage('cog'):
+        cog_ds = gdal.Translate(output_file, result, options=gdal.TranslateOptions(
+            format='COG', creationOptions=get_cog_creation_options(warp_threads)))
+    result = None
+    os.remove(warp_file)
+    return cog_ds
+
+
+def add_geoid_undulations(ds):
+    # The warped DEM is north-up in WGS84, so the pixel centre longitudes and latitudes follow from the geotransform
+    grid = load_geoid_grid(geoid_grid_path)
+    band = ds.GetRasterBand(1)
+    gt = ds.GetGeoTransform()
+    block_width, block_height = band.GetBlockSize()
+    outside_count = 0
+    for yoff in range(0, ds.RasterYSize, block_height):
+        height = min(block_height, ds.RasterYSize - yoff)
+        lat = gt[3] + (yoff + np.arange(height) + 0.5) * gt[5]
+        for xoff in range(0, ds.RasterXSize, block_width):
+            width = min(block_width, ds.RasterXSize - xoff)
+            values = band.ReadAsArray(xoff, yoff, width, height)
+            valid = values != -9999
+            if not valid.any():
+                continue
+            lon = gt[0] + (xoff + np.arange(width) + 0.5) * gt[1]
+            undulation = interpolate_undulation(grid, lon[None, :], lat[:, None])
+            outside = valid & np.isnan(undulation)
+            outside_count += int(np.count_nonzero(outside))
+            values[valid] += undulation[valid].astype(np.float32)
+            values[outside] = -9999
+            band.WriteArray(values, xoff, yoff)
+    band.FlushCache()
+    if outside_count:
+        print(f"{outside_count} pixels are outside the geoid model and were set to nodata")
+
+
+def convert_dem(dem_file, warp_threads='ALL_CPUS'):
+    src_ds = gdal.Open(dem_file, gdal.GA_ReadOnly)
+    if src_ds is None:
+        print(f"Unable to open {dem_file}")
+        return False
+
+    output_file = os.path.join(output_directory, os.path.basename(dem_file))
+    metrics = FileMetrics(__file__, dem_file, output_file)
+    # GDAL reads, warps and writes the COG in one call, unless the heights are converted in between
+    result = warp_to_cog(src_ds, output_file, get_output_bounds(src_ds), warp_threads, metrics)
+
     if result is None:
         print(f"Reprojection failed for {dem_file}")
     else:
+        metrics.count(pixels=result.RasterXSize * result.RasterYSize)
         print(f"Reprojection succeeded for {dem_file}")
 
+    success = result is not None
     src_ds = None
+    # Closing the output flushes it, so the output size is known
     result = None
+    metrics.finish(success=success)
+    return success
+
+
+def convert_dem_mosaic(dem_files):
+    if not dem_files:
+        print(f"No DEM files found in {input_directory}")
+        return
+
+    vrt_path = os.path.join(output_directory, 'dem_mosaic.vrt')
+    vrt_ds = gdal.BuildVRT(vrt_path, dem_files, srcNodata=-9999, VRTNodata=-9999)
+    if vrt_ds is None:
+        print("Unable to build the DEM mosaic")
+        return
+
+    # The mosaic extent is the union of the file extents, which is tighter than the VRT bounding box
+    # when the files do not fill a rectangle
+    file_bounds = []
+    for dem_file in dem_files:
+        src_ds = gdal.Open(dem_file, gdal.GA_ReadOnly)
+        if src_ds is not None:
+            file_bounds.append(get_output_bounds(src_ds))
+        src_ds = None
+    output_bounds = [
+        min(b[0] for b in file_bounds), min(b[1] for b in file_bounds),
+        max(b[2] for b in file_bounds), max(b[3] for b in file_bounds),
+    ]
+
+    output_file = os.path.join(output_directory, mosaic_filename)
+    metrics = FileMetrics(__file__, dem_files, output_file)
+    result = warp_to_cog(vrt_ds, output_file, output_bounds, 'ALL_CPUS', metrics)
+    if result is None:
+        print("Reprojection failed for the DEM mosaic")
+    else:
+        metrics.count(pixels=result.RasterXSize * result.RasterYSize)
+        print(f"Reprojection succeeded, mosaic saved to {output_file}")
+    success = result is not None
+    vrt_ds = None
+    result = None
+    metrics.finish(success=success)
+
 
-print("Processing complete.")
+def convert_dems(dem_files):
+    settings = {'src_epsg_code': src_epsg_code, 'cog_block_size': cog_block_size, 'edge_densify_points': edge_densify_points,
+                'geoid_grid_path': geoid_grid_path}
+    manifest = ProcessingManifest(output_directory, __file__, settings, incremental or watch)
+    dem_files = [dem_file for dem_file in dem_files if manifest.needs_processing(dem_file)]
+
+    if worker_count > 1:
+        # Split the CPU cores between the parallel files instead of every file using all of them
+        warp_threads = max((os.cpu_count() or 1) // worker_count, 1)
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            results = list(executor.map(convert_dem, dem_files, [warp_threads] * len(dem_files)))
+    else:
+        results = [convert_dem(dem_file) for dem_file in dem_files]
+
+    for dem_file, success in zip(dem_files, results):
+        if success:
+            manifest.record(dem_file, [os.path.join(output_directory, os.path.basename(dem_file))])
+
+
+def run_conversion():
+    dem_files = glob.glob(os.path.join(input_directory, '*.tif'))
+
+    if processing_mode == 'mosaic':
+        convert_dem_mosaic(dem_files)
+    else:
+        convert_dems(dem_files)
+
+    print("Processing complete.")
+
+
+if __name__ == '__main__':
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    if watch and processing_mode != 'mosaic':
+        watch_inputs(run_conversion, watch_interval)
+    else:
+        run_conversion()
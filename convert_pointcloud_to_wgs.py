@@ -1,55 +1,287 @@
 # Converts Point Clouds from EPSG:3301 to WGS84.
 # Run in an environment where PDAL is installed, e.g. Anaconda Prompt with 'conda install -c conda-forge pdal'.
-# Does not convert EH2000 heights to ellipsoid heights!!!
+# Heights stay EH2000 heights unless "geoid_grid_path" is set to a geoid model grid (GTX), then they are converted to
+# ellipsoidal heights in the 'exact' and 'approximate' modes, see geoid_grid.py. The 'pdal' mode does not support it.
+# Set "reprojection_mode" to 'exact' to transform in-process with pyproj instead of PDAL: one cached transformer is
+# reused for all files and the points are transformed in chunks of "chunk_size" as whole arrays.
+# 'approximate' evaluates the exact transform on a lattice over the file extent only and interpolates the points
+# bilinearly within it. The lattice is refined until the error at the cell centres and at random sample points is
+# below "max_error_m" and every chunk is spot-checked against the exact transform, falling back to it if needed.
+# By default "max_error_m" is half of the horizontal output scale step in metres (about 3 mm for 1e-7 degrees at
+# Estonian latitudes), the rounding of the output coordinates adds up to as much again. Smaller tolerances can't be
+# seen in the written coordinates. Refining stops, and the exact transform is used, once the lattice would have more
+# nodes than the file has points.
+# The approximation covers the horizontal coordinates, heights are passed through as in the exact transform.
+# Per-file stage timings are written as JSON lines when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
+# With "incremental" set, only new or changed files and files converted with other settings are processed, "watch"
+# keeps converting new files as they arrive, see incremental_processing.py.
+# Set "output_format" to 'copc' to write Cloud-Optimized Point Clouds (wgs84_<name>.copc.laz). This needs PDAL in every
+# mode: the 'exact' and 'approximate' modes write a LAZ file first and convert it with PDAL's writers.copc.
+# The LAZ codec used in the 'exact' and 'approximate' modes is chosen in laz_io.py.
 
+import copy
+import functools
+import laspy
 import os
 import json
 from os.path import join
-import pdal
+import numpy as np
+from processing_metrics import FileMetrics
+from laz_io import open_las, get_copc_filename, require_pdal_for_copc, create_copc_writer, convert_to_copc
+from incremental_processing import ProcessingManifest, watch as watch_inputs
+from geoid_grid import load_geoid_grid, get_ellipsoidal_heights
+try:
+    import pdal
+except ImportError:
+    pdal = None
 
 input_directory = 'laz_original'
 output_directory = 'laz_wgs84'
-src_epsg_code = 'EPSG:3301' 
-tgt_epsg_code = 'EPSG:4326'  
-
-if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
-
-laz_files = [f for f in os.listdir(input_directory) if f.endswith('.laz')]
-
-for laz_file in laz_files:
-    input_path = join(input_directory, laz_file)
-    output_path = join(output_directory, "wgs84_" + laz_file)
-    
-    pipeline_json = json.dumps(
-        {
-            "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": input_path
-                },
-                {
-                    "type": "filters.reprojection",
-                    "in_srs": src_epsg_code,
-                    "out_srs": tgt_epsg_code
-                },
-                {
-                    "type": "writers.las",
-                    "filename": output_path,
-                    "scale_x": 1e-7,
-                    "scale_y": 1e-7,
-                    "scale_z": 1e-3 
-                }
-            ]
-        }
-    )
-
-    pipeline = pdal.Pipeline(pipeline_json)
-
-    try:
-        pipeline.execute()
-        print(f"Conversion successful: {laz_file}")
-    except RuntimeError as e:
-        print(f"An error occurred: {e}")
-
-print("Processing complete.")
+src_epsg_code = 'EPSG:3301'
+tgt_epsg_code = 'EPSG:4326'
+output_scales = [1e-7, 1e-7, 1e-3]
+reprojection_mode = 'pdal'  # 'pdal', 'exact' or 'approximate'
+chunk_size = 1_000_000  # Points per chunk in the 'exact' and 'approximate' modes
+max_error_m = None  # Maximum horizontal error of the 'approximate' mode in metres, None for half the output scale step
+initial_cell_size = 200  # Lattice spacing in source CRS units that the 'approximate' mode starts refining from
+min_cell_size = 1  # The 'approximate' mode falls back to the exact transform below this lattice spacing
+check_sample_size = 1000  # Points per chunk compared against the exact transform in the 'approximate' mode
+output_format = 'laz'  # 'laz' or 'copc'
+geoid_grid_path = None  # E.g. 'EST-GEOID2017.gtx' to convert EH2000 heights to ellipsoidal heights
+incremental = False  # Skip files that were already converted with the same settings
+watch = False  # Keep running and convert new files every "watch_interval" seconds
+watch_interval = 60
+
+EARTH_RADIUS = 6371000.0
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(src_epsg_code, tgt_epsg_code):
+    # Building a transformer is expensive, so one is created per CRS pair and reused for every chunk and file
+    from pyproj import Transformer
+    return Transformer.from_crs(src_epsg_code, tgt_epsg_code, always_xy=True)
+
+
+def create_wgs84_header(source_header, tgt_epsg_code):
+    from pyproj import CRS
+    header = copy.deepcopy(source_header)
+    header.scales = np.array(output_scales, dtype=np.float64)
+    header.offsets = np.zeros(3, dtype=np.float64)
+    header.add_crs(CRS.from_user_input(tgt_epsg_code))
+    return header
+
+
+def horizontal_error(transformer, x_a, y_a, x_b, y_b):
+    # Distance between two sets of transformed coordinates, in metres for geographic targets
+    if not transformer.target_crs.is_geographic:
+        return np.hypot(x_a - x_b, y_a - y_b)
+    dx = np.radians(x_a - x_b) * EARTH_RADIUS * np.cos(np.radians(y_a))
+    dy = np.radians(y_a - y_b) * EARTH_RADIUS
+    return np.hypot(dx, dy)
+
+
+def get_error_tolerance(transformer, mins, maxs):
+    if max_error_m is not None:
+        return max_error_m
+    if not transformer.target_crs.is_geographic:
+        return min(output_scales[0], output_scales[1]) / 2
+    # A longitude step is shorter than a latitude step by the cosine of the latitude
+    _, latitude = transformer.transform((mins[0] + maxs[0]) / 2, (mins[1] + maxs[1]) / 2)
+    step_x = np.radians(output_scales[0]) * EARTH_RADIUS * np.cos(np.radians(latitude))
+    step_y = np.radians(output_scales[1]) * EARTH_RADIUS
+    return float(min(step_x, step_y)) / 2
+
+
+def get_lattice_shape(mins, maxs, cell_size):
+    nx = max(int(np.ceil((maxs[0] - mins[0]) / cell_size)), 1) + 1
+    ny = max(int(np.ceil((maxs[1] - mins[1]) / cell_size)), 1) + 1
+    return nx, ny
+
+
+def build_lattice(transformer, mins, maxs, cell_size, max_error):
+    nx, ny = get_lattice_shape(mins, maxs, cell_size)
+    grid_x, grid_y = np.meshgrid(mins[0] + np.arange(nx) * cell_size, mins[1] + np.arange(ny) * cell_size)
+    lattice_x, lattice_y = transformer.transform(grid_x, grid_y)
+    return {
+        "origin": (mins[0], mins[1]),
+        "cell_size": cell_size,
+        "max_error": max_error,
+        "x": np.asarray(lattice_x),
+        "y": np.asarray(lattice_y),
+    }
+
+
+def interpolate_lattice(lattice, x, y):
+    ny, nx = lattice["x"].shape
+    col = (x - lattice["origin"][0]) / lattice["cell_size"]
+    row = (y - lattice["origin"][1]) / lattice["cell_size"]
+    col0 = np.clip(np.floor(col).astype(np.int64), 0, nx - 2)
+    row0 = np.clip(np.floor(row).astype(np.int64), 0, ny - 2)
+    tx = col - col0
+    ty = row - row0
+
+    results = []
+    for values in (lattice["x"], lattice["y"]):
+        bottom = values[row0, col0] * (1 - tx) + values[row0, col0 + 1] * tx
+        top = values[row0 + 1, col0] * (1 - tx) + values[row0 + 1, col0 + 1] * tx
+        results.append(bottom * (1 - ty) + top * ty)
+    return results
+
+
+def build_approximation(transformer, mins, maxs, max_error, point_count):
+    rng = np.random.default_rng(0)
+    sample_x = rng.uniform(mins[0], maxs[0], check_sample_size)
+    sample_y = rng.uniform(mins[1], maxs[1], check_sample_size)
+
+    cell_size = initial_cell_size
+    while cell_size >= min_cell_size:
+        nx, ny = get_lattice_shape(mins, maxs, cell_size)
+        if nx * ny > point_count:
+            # Transforming the lattice would cost more than transforming the points exactly
+            return None
+        lattice = build_lattice(transformer, mins, maxs, cell_size, max_error)
+        # Bilinear interpolation errors are largest in the cell centres
+        centre_x, centre_y = np.meshgrid(mins[0] + (np.arange(nx - 1) + 0.5) * cell_size,
+                                         mins[1] + (np.arange(ny - 1) + 0.5) * cell_size)
+        check_x = np.concatenate([centre_x.ravel(), sample_x])
+        check_y = np.concatenate([centre_y.ravel(), sample_y])
+        exact_x, exact_y = transformer.transform(check_x, check_y)
+        approx_x, approx_y = interpolate_lattice(lattice, check_x, check_y)
+        if horizontal_error(transformer, exact_x, exact_y, approx_x, approx_y).max() <= max_error:
+            return lattice
+        cell_size /= 2
+    return None
+
+
+def reproject_chunk(transformer, lattice, x, y, z):
+    if lattice is not None:
+        approx_x, approx_y = interpolate_lattice(lattice, x, y)
+        step = max(len(x) // check_sample_size, 1)
+        exact_x, exact_y = transformer.transform(x[::step], y[::step])
+        if horizontal_error(transformer, exact_x, exact_y, approx_x[::step], approx_y[::step]).max() <= lattice["max_error"]:
+            return approx_x, approx_y, z
+        print("Approximation error exceeded in a chunk, using the exact transform for it.")
+    return transformer.transform(x, y, z)
+
+
+def convert_heights(transformer, x, y, z, source_x, source_y):
+    # The geoid model is indexed by WGS84 longitude and latitude, which are the output coordinates for geographic targets
+    if transformer.target_crs.is_geographic:
+        lon, lat = x, y
+    else:
+        lon, lat = get_transformer(src_epsg_code, 'EPSG:4326').transform(source_x, source_y)
+    return get_ellipsoidal_heights(load_geoid_grid(geoid_grid_path), lon, lat, z)
+
+
+def convert_pointcloud_in_process(input_path, output_path, transformer, metrics):
+    with open_las(input_path) as reader:
+        header = create_wgs84_header(reader.header, tgt_epsg_code)
+        lattice = None
+        if reprojection_mode == 'approximate':
+            with metrics.stage('approximation'):
+                max_error = get_error_tolerance(transformer, reader.header.mins, reader.header.maxs)
+                lattice = build_approximation(transformer, reader.header.mins, reader.header.maxs, max_error,
+                                              reader.header.point_count)
+            if lattice is None:
+                print(f"No lattice of at most {reader.header.point_count} nodes and {min_cell_size} units spacing "
+                      f"meets {max_error * 1000:.2f} mm, using the exact transform.")
+
+        with open_las(output_path, mode='w', header=header) as writer:
+            for points in metrics.timed(reader.chunk_iterator(chunk_size)):
+                with metrics.stage('transform'):
+                    source_x = np.asarray(points.x)
+                    source_y = np.asarray(points.y)
+                    x, y, z = reproject_chunk(transformer, lattice, source_x, source_y, np.asarray(points.z))
+                    if geoid_grid_path is not None:
+                        z = convert_heights(transformer, x, y, z, source_x, source_y)
+                    output_points = laspy.ScaleAwarePointRecord(points.array, points.point_format, header.scales, header.offsets)
+                    output_points.x = x
+                    output_points.y = y
+                    output_points.z = z
+                with metrics.stage('write'):
+                    writer.write_points(output_points)
+                metrics.count(points=len(points))
+
+
+def convert_pointclouds(input_directory, output_directory):
+    if reprojection_mode == 'pdal' and pdal is None:
+        raise ImportError("PDAL is needed for the conversion: 'conda install -c conda-forge pdal'")
+    if output_format == 'copc':
+        require_pdal_for_copc()
+    if geoid_grid_path is not None and reprojection_mode == 'pdal':
+        raise ValueError("Height conversion with 'geoid_grid_path' needs reprojection_mode 'exact' or 'approximate'")
+
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    laz_files = [f for f in os.listdir(input_directory) if f.endswith('.laz')]
+    settings = {
+        'src_epsg_code': src_epsg_code, 'tgt_epsg_code': tgt_epsg_code, 'output_scales': output_scales,
+        'reprojection_mode': reprojection_mode, 'max_error_m': max_error_m, 'output_format': output_format,
+        'geoid_grid_path': geoid_grid_path,
+    }
+    manifest = ProcessingManifest(output_directory, __file__, settings, incremental or watch)
+
+    for laz_file in laz_files:
+        input_path = join(input_directory, laz_file)
+        laz_output_path = join(output_directory, "wgs84_" + laz_file)
+        output_path = get_copc_filename(laz_output_path) if output_format == 'copc' else laz_output_path
+        if not manifest.needs_processing(input_path):
+            continue
+
+        metrics = FileMetrics(__file__, input_path, output_path)
+        if reprojection_mode != 'pdal':
+            convert_pointcloud_in_process(input_path, laz_output_path, get_transformer(src_epsg_code, tgt_epsg_code), metrics)
+            if output_format == 'copc':
+                with metrics.stage('copc'):
+                    convert_to_copc(laz_output_path, output_path)
+            metrics.finish(mode=reprojection_mode)
+            manifest.record(input_path, [output_path])
+            print(f"Conversion successful: {laz_file}")
+            continue
+
+        pipeline_json = json.dumps(
+            {
+                "pipeline": [
+                    {
+                        "type": "readers.las",
+                        "filename": input_path
+                    },
+                    {
+                        "type": "filters.reprojection",
+                        "in_srs": src_epsg_code,
+                        "out_srs": tgt_epsg_code
+                    },
+                    create_copc_writer(output_path, output_scales) if output_format == 'copc' else {
+                        "type": "writers.las",
+                        "filename": output_path,
+                        "scale_x": output_scales[0],
+                        "scale_y": output_scales[1],
+                        "scale_z": output_scales[2]
+                    }
+                ]
+            }
+        )
+
+        pipeline = pdal.Pipeline(pipeline_json)
+
+        try:
+            # PDAL reads, reprojects and writes in one call
+            with metrics.stage('pdal'):
+                point_count = pipeline.execute()
+            metrics.count(points=point_count)
+            metrics.finish(mode=reprojection_mode)
+            manifest.record(input_path, [output_path])
+            print(f"Conversion successful: {laz_file}")
+        except RuntimeError as e:
+            metrics.finish(mode=reprojection_mode, error=str(e))
+            print(f"An error occurred: {e}")
+
+    print("Processing complete.")
+
+
+if __name__ == '__main__':
+    if watch:
+        watch_inputs(lambda: convert_pointclouds(input_directory, output_directory), watch_interval)
+    else:
+        convert_pointclouds(input_directory, output_directory)
@@ -1,28 +1,235 @@
 # Converts panoramas with random aspect ratio to 2:1 (pseudo) equirectangular images.
+# "padding_mode" 'pixels' adds black borders to the image, 'metadata' leaves the pixels untouched and only writes
+# GPano XMP cropped area metadata (full panorama size and crop offsets) into the JPEG, so viewers add the padding.
+# The GPano properties are merged into an existing XMP packet, other metadata in it is kept.
+# In 'pixels' mode "worker_count" images are padded in parallel, as long as their estimated decoded size fits
+# in "memory_budget_mb". Pillow decodes and encodes whole images, so a panorama whose decoded source and padded canvas
+# alone don't fit in the budget is skipped with a message, use the 'metadata' mode or a larger budget for it.
+# Per-image stage timings are written as JSON lines when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
+# With "incremental" set, only new or changed panoramas and panoramas converted in another mode are processed, "watch"
+# keeps converting new panoramas as they arrive, see incremental_processing.py.
 
 from PIL import Image
 import os
 import glob
+import io
+import shutil
+import struct
+import threading
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+from processing_metrics import FileMetrics
+from incremental_processing import ProcessingManifest, watch as watch_inputs
 
 source_folder = 'panorama_original'
 output_folder = 'panorama_equirectangular'
+padding_mode = 'pixels'  # 'pixels' or 'metadata'
+worker_count = 4
+memory_budget_mb = 8000
+incremental = False  # Skip panoramas that were already converted in the same mode
+watch = False  # Keep running and convert new panoramas every "watch_interval" seconds
+watch_interval = 60
+
+# Panoramas are often far larger than Pillow's decompression bomb limit
+Image.MAX_IMAGE_PIXELS = None
+
+XMP_NAMESPACE = b'http://ns.adobe.com/xap/1.0/\x00'
+RDF_NAMESPACE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+GPANO_NAMESPACE = 'http://ns.google.com/photos/1.0/panorama/'
+GPANO_XMP = '''<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="" xmlns:GPano="http://ns.google.com/photos/1.0/panorama/">
+   <GPano:UsePanoramaViewer>True</GPano:UsePanoramaViewer>
+   <GPano:ProjectionType>equirectangular</GPano:ProjectionType>
+   <GPano:CroppedAreaImageWidthPixels>{width}</GPano:CroppedAreaImageWidthPixels>
+   <GPano:CroppedAreaImageHeightPixels>{height}</GPano:CroppedAreaImageHeightPixels>
+   <GPano:FullPanoWidthPixels>{full_width}</GPano:FullPanoWidthPixels>
+   <GPano:FullPanoHeightPixels>{full_height}</GPano:FullPanoHeightPixels>
+   <GPano:CroppedAreaLeftPixels>0</GPano:CroppedAreaLeftPixels>
+   <GPano:CroppedAreaTopPixels>{top}</GPano:CroppedAreaTopPixels>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>'''
+
+
+class MemoryBudget:
+    # Blocks until the requested amount fits in the budget. A single request larger than the whole budget
+    # raises a MemoryError, as it could never fit.
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        if amount > self.budget:
+            raise MemoryError(f"{amount / 1024 ** 2:.0f} MB needed, the memory budget is {self.budget / 1024 ** 2:.0f} MB")
+        with self.condition:
+            while self.used + amount > self.budget:
+                self.condition.wait()
+            self.used += amount
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
 
-def add_black_borders(input_image_path, output_image_path):
+
+def add_black_borders(input_image_path, output_image_path, metrics):
+    with Image.open(input_image_path) as img:
+        width, height = img.size
+        new_height = width // 2
+        with metrics.stage('read'):
+            img.load()
+        with metrics.stage('transform'):
+            new_img = Image.new("RGB", (width, new_height), "black")
+            new_img.paste(img, (0, (new_height - height) // 2))
+        with metrics.stage('write'):
+            new_img.save(output_image_path)
+    metrics.count(pixels=width * new_height)
+
+
+def merge_gpano_xmp(existing_xmp, gpano_xmp):
+    # Adds the GPano description to the RDF of an existing packet, replacing any GPano properties it had, so camera and
+    # editing metadata are kept. The namespace prefixes of both packets are registered to keep them when serialized.
+    for data in (existing_xmp, gpano_xmp):
+        for event, (prefix, uri) in ElementTree.iterparse(io.BytesIO(data), events=('start-ns',)):
+            try:
+                ElementTree.register_namespace(prefix, uri)
+            except ValueError:
+                pass
+    root = ElementTree.fromstring(existing_xmp)
+    rdf = root if root.tag == f'{{{RDF_NAMESPACE}}}RDF' else root.find(f'.//{{{RDF_NAMESPACE}}}RDF')
+    if rdf is None:
+        raise ValueError("no rdf:RDF element")
+    for description in rdf.iter(f'{{{RDF_NAMESPACE}}}Description'):
+        for child in list(description):
+            if child.tag.startswith(f'{{{GPANO_NAMESPACE}}}'):
+                description.remove(child)
+        for name in list(description.attrib):
+            if name.startswith(f'{{{GPANO_NAMESPACE}}}'):
+                del description.attrib[name]
+    rdf.append(ElementTree.fromstring(gpano_xmp).find(f'.//{{{RDF_NAMESPACE}}}Description'))
+    body = ElementTree.tostring(root, encoding='unicode')
+    return f'<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n{body}\n<?xpacket end="w"?>'.encode('utf-8')
+
+
+def write_gpano_metadata(input_image_path, output_image_path):
     with Image.open(input_image_path) as img:
         width, height = img.size
-        new_height = width // 2 
-        new_img = Image.new("RGB", (width, new_height), "black")
-        new_img.paste(img, (0, (new_height - height) // 2))
-        new_img.save(output_image_path)
+    full_width, full_height = width, width // 2
+    if height > full_height:
+        return False
+
+    xmp = GPANO_XMP.format(width=width, height=height, full_width=full_width, full_height=full_height,
+                           top=(full_height - height) // 2).encode('utf-8')
+
+    with open(input_image_path, 'rb') as src, open(output_image_path, 'wb') as dst:
+        if src.read(2) != b'\xff\xd8':
+            raise ValueError(f"{input_image_path} is not a JPEG file")
+
+        # The APPn and comment segments are read first, so an existing XMP packet is found wherever it is
+        segments = []
+        while True:
+            marker = src.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF or not (0xE0 <= marker[1] <= 0xEF or marker[1] == 0xFE):
+                break
+            length_bytes = src.read(2)
+            segments.append((marker, length_bytes, src.read(struct.unpack('>H', length_bytes)[0] - 2)))
+
+        existing = [payload[len(XMP_NAMESPACE):] for segment_marker, length_bytes, payload in segments
+                    if segment_marker == b'\xff\xe1' and payload.startswith(XMP_NAMESPACE)]
+        if existing:
+            try:
+                merged = merge_gpano_xmp(existing[0], xmp)
+                if len(XMP_NAMESPACE) + len(merged) + 2 > 0xFFFF:
+                    raise ValueError("the merged packet does not fit in a JPEG segment")
+                xmp = merged
+            except (ElementTree.ParseError, ValueError) as e:
+                print(f"Warning: the XMP packet of {os.path.basename(input_image_path)} could not be merged ({e}), "
+                      f"it is replaced by the GPano metadata.")
+        xmp_segment = b'\xff\xe1' + struct.pack('>H', len(XMP_NAMESPACE) + len(xmp) + 2) + XMP_NAMESPACE + xmp
+
+        # The XMP goes after the leading JFIF/Exif segments in place of the old packet, the compressed image data is
+        # copied unchanged
+        dst.write(b'\xff\xd8')
+        xmp_written = False
+        for segment_marker, length_bytes, payload in segments:
+            if segment_marker == b'\xff\xe1' and payload.startswith(XMP_NAMESPACE):
+                continue
+            is_leading = segment_marker == b'\xff\xe0' or (segment_marker == b'\xff\xe1' and payload.startswith(b'Exif'))
+            if not xmp_written and not is_leading:
+                dst.write(xmp_segment)
+                xmp_written = True
+            dst.write(segment_marker + length_bytes + payload)
+
+        if not xmp_written:
+            dst.write(xmp_segment)
+        dst.write(marker)
+        shutil.copyfileobj(src, dst)
+    return True
+
+
+def pad_image(file_path, output_path, memory_budget):
+    metrics = FileMetrics(__file__, file_path, output_path)
+    with Image.open(file_path) as img:
+        width, height = img.size
+    # The decoded source and the padded canvas are in memory at the same time
+    estimated_bytes = width * height * 3 + width * (width // 2) * 3
+    with metrics.stage('memory_wait'):
+        memory_budget.acquire(estimated_bytes)
+    try:
+        add_black_borders(file_path, output_path, metrics)
+    finally:
+        memory_budget.release(estimated_bytes)
+    metrics.finish(mode='pixels')
+
 
 def process_folder(source_folder, output_folder):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    
-    for file_path in glob.glob(os.path.join(source_folder, '*.jpg')):
+
+    manifest = ProcessingManifest(output_folder, __file__, {'padding_mode': padding_mode}, incremental or watch)
+    file_paths = [file_path for file_path in glob.glob(os.path.join(source_folder, '*.jpg'))
+                  if manifest.needs_processing(file_path)]
+
+    if padding_mode == 'metadata':
+        for file_path in file_paths:
+            filename = os.path.basename(file_path)
+            output_path = os.path.join(output_folder, filename)
+            metrics = FileMetrics(__file__, file_path, output_path)
+            with metrics.stage('write'):
+                written = write_gpano_metadata(file_path, output_path)
+            if written:
+                metrics.finish(mode='metadata')
+                print(f"Processed {filename}")
+            else:
+                print(f"Skipping {filename}: taller than 2:1, use the 'pixels' mode.")
+            manifest.record(file_path, [output_path] if written else [])
+        return
+
+    memory_budget = MemoryBudget(memory_budget_mb * 1024 * 1024)
+
+    def process_file(file_path):
         filename = os.path.basename(file_path)
         output_path = os.path.join(output_folder, filename)
-        add_black_borders(file_path, output_path)
-        print(f"Processed {filename}")
+        try:
+            pad_image(file_path, output_path, memory_budget)
+        except MemoryError as e:
+            return f"Skipping {filename}: {e}, use the 'metadata' mode or raise \"memory_budget_mb\"."
+        manifest.record(file_path, [output_path])
+        return f"Processed {filename}"
+
+    with ThreadPoolExecutor(max_workers=max(worker_count, 1)) as executor:
+        for message in executor.map(process_file, file_paths):
+            print(message)
+
 
-process_folder(source_folder, output_folder)
+if __name__ == '__main__':
+    if watch:
+        watch_inputs(lambda: process_folder(source_folder, output_folder), watch_interval)
+    else:
+        process_folder(source_folder, output_folder)
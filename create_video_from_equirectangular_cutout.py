@@ -1,42 +1,172 @@
 # Cut out a section of equirectangular images and create a video with specific resolution and fps based on consecutive images.
 # Change the processing settings as needed.
 # Install OpenCV in conda environment "conda install -c conda-forge opencv"
+# Frames are decoded, cut out, resized and saved by "decode_workers" threads while a separate encoder thread writes
+# the video, with up to "prefetch_frames" frames in flight. Set "decode_workers" to 0 to process frames one by one.
+# When the cutout is at least twice the output resolution, the JPEGs are decoded at reduced resolution.
+# "projection_mode" 'rectilinear' renders true perspective views instead of the flat cutout, one video per entry in
+# "views" from the same decoded frames. "horizontal_fov_deg" is the horizontal field of view of each view, the vertical
+# one follows from the output aspect ratio. Yaw turns the view right from the centre of the flat cutout, so both modes
+# share "horizontal_rotation_deg" as the forward direction, pitch turns the view up and roll clockwise.
+# The remap tables of each view are computed once, stored in "remap_cache_folder" in OpenCV's fixed-point format and
+# reused for every frame and later runs.
+# The run's stage timings (decode, transform, image writing, video encoding) are written as a JSON line when
+# PROCESSING_METRICS_PATH is set, see processing_metrics.py.
 
 import cv2
+import hashlib
 import os
 import numpy as np
 import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from processing_metrics import FileMetrics
 
 input_folder = 'equirectangular'
 output_folder = 'video'
-resized_images_folder = os.path.join(output_folder, '1280x1024') 
+resized_images_folder = os.path.join(output_folder, '1280x1024')
 fps = 6
 horizontal_fov_deg = 90
 vertical_fov_deg = 45
 horizontal_rotation_deg = 180
 input_resolution = (8192, 4096)
 output_resolution = (1280, 1024)
+decode_workers = 4
+prefetch_frames = 16
+projection_mode = 'flat'  # 'flat' or 'rectilinear'
+views = [
+    {'name': 'front', 'yaw_deg': 0, 'pitch_deg': 0, 'roll_deg': 0},
+    {'name': 'right', 'yaw_deg': 90, 'pitch_deg': 0, 'roll_deg': 0},
+    {'name': 'back', 'yaw_deg': 180, 'pitch_deg': 0, 'roll_deg': 0},
+    {'name': 'left', 'yaw_deg': -90, 'pitch_deg': 0, 'roll_deg': 0},
+]
+remap_cache_folder = os.path.join(output_folder, 'remap_cache')
 
-def rotate_and_extract_fov(image, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution):
+REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+def get_cutout_size(width, height, horizontal_fov_deg, vertical_fov_deg, input_resolution, output_resolution):
     output_aspect_ratio = output_resolution[0] / output_resolution[1]
     input_aspect_ratio = input_resolution[0] / input_resolution[1]
     horizontal_fov_deg_adjusted = horizontal_fov_deg * (output_aspect_ratio / input_aspect_ratio)
 
-    rotation_shift = int((horizontal_rotation_deg / 360.0) * image.shape[1])
-    rotated_image = np.roll(image, shift=rotation_shift, axis=1)
-
-    width, height = image.shape[1], image.shape[0]
     horizontal_fov_rad = np.radians(horizontal_fov_deg_adjusted)
     vertical_fov_rad = np.radians(vertical_fov_deg)
 
     cutout_width = int(width * (horizontal_fov_rad / (2 * np.pi)))
     cutout_height = int(height * (vertical_fov_rad / np.pi))
+    return cutout_width, cutout_height
+
+
+def rotate_and_extract_fov(image, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution):
+    width, height = image.shape[1], image.shape[0]
+    cutout_width, cutout_height = get_cutout_size(width, height, horizontal_fov_deg, vertical_fov_deg, input_resolution, output_resolution)
 
     start_x = (width - cutout_width) // 2
     start_y = (height - cutout_height) // 2
 
-    cutout = rotated_image[start_y:start_y+cutout_height, start_x:start_x+cutout_width]
-    return cutout
+    # Same window as rolling the image by the rotation, but only the window's columns are read.
+    # Without wrapping around the image edge the cutout is a view, otherwise only the window is copied.
+    rotation_shift = int((horizontal_rotation_deg / 360.0) * width)
+    source_x = (start_x - rotation_shift) % width
+    rows = image[start_y:start_y+cutout_height]
+    if source_x + cutout_width <= width:
+        return rows[:, source_x:source_x+cutout_width]
+    return np.concatenate((rows[:, source_x:], rows[:, :source_x + cutout_width - width]), axis=1)
+
+
+def get_decode_flag(horizontal_fov_deg, vertical_fov_deg, input_resolution, output_resolution):
+    # The largest JPEG reduction factor that still leaves the cutout at least as large as the output
+    cutout_width, cutout_height = get_cutout_size(input_resolution[0], input_resolution[1], horizontal_fov_deg, vertical_fov_deg, input_resolution, output_resolution)
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if cutout_width // factor >= output_resolution[0] and cutout_height // factor >= output_resolution[1]:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def get_rectilinear_decode_flag(horizontal_fov_deg, input_resolution, output_resolution):
+    # The perspective views need the most source pixels in their centre: output pixels per radian there
+    pixels_per_radian = (output_resolution[0] / 2) / np.tan(np.radians(horizontal_fov_deg) / 2)
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if input_resolution[0] / factor >= 2 * np.pi * pixels_per_radian:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def build_rectilinear_maps(view, horizontal_fov_deg, output_resolution, source_size):
+    width, height = output_resolution
+    source_width, source_height = source_size
+    focal_length = (width / 2) / np.tan(np.radians(horizontal_fov_deg) / 2)
+
+    # Camera rays with x to the right, y down and z forward
+    u, v = np.meshgrid(np.arange(width) - (width - 1) / 2, np.arange(height) - (height - 1) / 2)
+    rays = np.stack([u, v, np.full_like(u, focal_length)], axis=-1)
+    rays /= np.linalg.norm(rays, axis=-1, keepdims=True)
+
+    yaw, pitch, roll = np.radians([view['yaw_deg'], view['pitch_deg'], view['roll_deg']])
+    rotation_roll = np.array([[np.cos(roll), -np.sin(roll), 0], [np.sin(roll), np.cos(roll), 0], [0, 0, 1]])
+    rotation_pitch = np.array([[1, 0, 0], [0, np.cos(pitch), -np.sin(pitch)], [0, np.sin(pitch), np.cos(pitch)]])
+    rotation_yaw = np.array([[np.cos(yaw), 0, np.sin(yaw)], [0, 1, 0], [-np.sin(yaw), 0, np.cos(yaw)]])
+    rays = rays @ (rotation_yaw @ rotation_pitch @ rotation_roll).T
+
+    longitude = np.arctan2(rays[..., 0], rays[..., 2])
+    latitude = np.arcsin(np.clip(-rays[..., 1], -1, 1))
+    map_x = ((longitude / (2 * np.pi) + 0.5) * source_width - 0.5).astype(np.float32)
+    map_y = ((0.5 - latitude / np.pi) * source_height - 0.5).astype(np.float32)
+
+    # Fixed-point maps are half the size of float maps and faster to remap with
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+
+remap_tables = {}
+remap_tables_lock = threading.Lock()
+
+def get_remap_tables(view, horizontal_fov_deg, output_resolution, source_size):
+    view_key = (view['yaw_deg'], view['pitch_deg'], view['roll_deg'], horizontal_fov_deg, tuple(output_resolution), tuple(source_size))
+    with remap_tables_lock:
+        if view_key in remap_tables:
+            return remap_tables[view_key]
+
+        digest = hashlib.sha1(repr(view_key).encode()).hexdigest()[:16]
+        cache_path = os.path.join(remap_cache_folder, f"remap_{view['name']}_{digest}.npz")
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                tables = (cached['map_xy'], cached['map_interpolation'])
+        else:
+            print(f"Computing remap tables for view {view['name']}...")
+            tables = build_rectilinear_maps(view, horizontal_fov_deg, output_resolution, source_size)
+            if not os.path.exists(remap_cache_folder):
+                os.makedirs(remap_cache_folder)
+            np.savez(cache_path, map_xy=tables[0], map_interpolation=tables[1])
+        remap_tables[view_key] = tables
+        return tables
+
+
+def extract_rectilinear_views(image, horizontal_fov_deg, horizontal_rotation_deg, output_resolution):
+    source_size = (image.shape[1], image.shape[0])
+    frames = []
+    for view in views:
+        # The flat cutout rolls the image right by the rotation, so its centre is the source longitude -rotation
+        view = dict(view, yaw_deg=view['yaw_deg'] - horizontal_rotation_deg)
+        map_xy, map_interpolation = get_remap_tables(view, horizontal_fov_deg, output_resolution, source_size)
+        frames.append(cv2.remap(image, map_xy, map_interpolation, cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP))
+    return frames
+
+
+def get_output_targets(output_folder, output_resolution):
+    # The video path and the folder for the resized images of every output view
+    resolution_name = f"{output_resolution[0]}x{output_resolution[1]}"
+    if projection_mode == 'rectilinear':
+        return [
+            (os.path.join(output_folder, f"Video_{view['name']}_{resolution_name}.mp4"),
+             os.path.join(output_folder, f"{resolution_name}_{view['name']}"))
+            for view in views
+        ]
+    return [(os.path.join(output_folder, f"Video_{resolution_name}.mp4"), resized_images_folder)]
+
 
 def resize_image(image, output_resolution):
     return cv2.resize(image, output_resolution, interpolation=cv2.INTER_LINEAR)
@@ -44,43 +174,132 @@ def resize_image(image, output_resolution):
 def save_resized_image(image, name, folder):
     cv2.imwrite(os.path.join(folder, name), image)
 
+def process_frame(input_folder, image_name, image_folders, decode_flag, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution, metrics):
+    image_path = os.path.join(input_folder, image_name)
+    with metrics.stage('read'):
+        image = cv2.imread(image_path, decode_flag)
+    if image is None:
+        print(f"Skipping file: {image_name}")
+        return None
+
+    with metrics.stage('transform'):
+        if projection_mode == 'rectilinear':
+            frames = extract_rectilinear_views(image, horizontal_fov_deg, horizontal_rotation_deg, output_resolution)
+        else:
+            cutout = rotate_and_extract_fov(image, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution)
+            frames = [resize_image(cutout, output_resolution)]
+
+    with metrics.stage('write'):
+        for frame, folder in zip(frames, image_folders):
+            save_resized_image(frame, image_name, folder)
+    metrics.count(frames=1, pixels=image.shape[0] * image.shape[1])
+    return frames
+
+def encode_frames(frames, video_paths, fps, output_resolution, result, metrics):
+    # An error is stored in "result" for the main thread, which stops feeding frames once this thread has ended
+    video_writers = None
+    try:
+        while True:
+            view_frames = frames.get()
+            if view_frames is None:
+                break
+            if video_writers is None:
+                print("Initializing video creation...")
+                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                video_writers = [cv2.VideoWriter(video_path, fourcc, fps, output_resolution) for video_path in video_paths]
+                for video_writer, video_path in zip(video_writers, video_paths):
+                    if not video_writer.isOpened():
+                        raise IOError(f"Could not open {video_path} for writing")
+            with metrics.stage('encode'):
+                for video_writer, frame in zip(video_writers, view_frames):
+                    video_writer.write(frame)
+            result['frames'] += 1
+    except Exception as e:
+        result['error'] = e
+    finally:
+        if video_writers:
+            with metrics.stage('encode'):
+                for video_writer in video_writers:
+                    video_writer.release()
+
+def put_frame(frames, view_frames, encoder, result):
+    # Waits for room in the queue only as long as the encoder is still taking frames
+    while True:
+        try:
+            frames.put(view_frames, timeout=1)
+            return
+        except queue.Full:
+            if not encoder.is_alive():
+                raise result.get('error') or RuntimeError("The video encoder stopped")
+
+def stop_encoder(frames, encoder):
+    # The end marker can't be queued once the encoder has stopped, so it is only waited for while the encoder runs
+    while encoder.is_alive():
+        try:
+            frames.put(None, timeout=1)
+            break
+        except queue.Full:
+            pass
+    encoder.join()
+
 def process_images_and_create_video(input_folder, output_folder, fps, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution):
-    if not os.path.exists(resized_images_folder):
-        os.makedirs(resized_images_folder)
+    output_targets = get_output_targets(output_folder, output_resolution)
+    video_paths = [video_path for video_path, image_folder in output_targets]
+    image_folders = [image_folder for video_path, image_folder in output_targets]
+    for image_folder in image_folders:
+        if not os.path.exists(image_folder):
+            os.makedirs(image_folder)
 
     start_process_time = time.time()
     images = sorted([img for img in os.listdir(input_folder) if img.endswith(".jpg")])
     print(f"Found {len(images)} images to process.")
 
-    video_writer = None
-    video_path = os.path.join(output_folder, f"Video_{output_resolution[0]}x{output_resolution[1]}.mp4")
-
-    processed_count = 0
-    for image_name in images:
-        image_path = os.path.join(input_folder, image_name)
-        image = cv2.imread(image_path)
-        if image is None:
-            print(f"Skipping file: {image_name}")
-            continue
-
-        cutout = rotate_and_extract_fov(image, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution)
-        resized_cutout = resize_image(cutout, output_resolution)
-        save_resized_image(resized_cutout, image_name, resized_images_folder)
-        processed_count += 1
+    if projection_mode == 'rectilinear':
+        decode_flag = get_rectilinear_decode_flag(horizontal_fov_deg, input_resolution, output_resolution)
+    else:
+        decode_flag = get_decode_flag(horizontal_fov_deg, vertical_fov_deg, input_resolution, output_resolution)
+    metrics = FileMetrics(__file__, input_folder, video_paths)
+    frame_settings = (image_folders, decode_flag, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution, metrics)
 
-        if video_writer is None:
-            print("Initializing video creation...")
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            video_writer = cv2.VideoWriter(video_path, fourcc, fps, output_resolution)
+    # The encoder runs on its own thread and receives the frames in order, None marks the end
+    frames = queue.Queue(maxsize=prefetch_frames)
+    result = {'frames': 0}
+    encoder = threading.Thread(target=encode_frames, args=(frames, video_paths, fps, output_resolution, result, metrics))
+    encoder.start()
 
-        video_writer.write(resized_cutout)
+    try:
+        if decode_workers > 0:
+            with ThreadPoolExecutor(max_workers=decode_workers) as executor:
+                pending = deque()
+                for image_name in images:
+                    pending.append(executor.submit(process_frame, input_folder, image_name, *frame_settings))
+                    if len(pending) >= prefetch_frames:
+                        view_frames = pending.popleft().result()
+                        if view_frames is not None:
+                            put_frame(frames, view_frames, encoder, result)
+                while pending:
+                    view_frames = pending.popleft().result()
+                    if view_frames is not None:
+                        put_frame(frames, view_frames, encoder, result)
+        else:
+            for image_name in images:
+                view_frames = process_frame(input_folder, image_name, *frame_settings)
+                if view_frames is not None:
+                    put_frame(frames, view_frames, encoder, result)
+    finally:
+        stop_encoder(frames, encoder)
+    if 'error' in result:
+        raise result['error']
 
-    if video_writer:
-        video_writer.release()
-        print(f"Video saved to {video_path} with {processed_count} frames.")
+    # The per-stage times are summed over the decode threads, so together they can exceed the wall time
+    metrics.finish(projection_mode=projection_mode, decode_workers=decode_workers)
+    if result['frames']:
+        for video_path in video_paths:
+            print(f"Video saved to {video_path} with {result['frames']} frames.")
     print(f"Processing completed in {time.time() - start_process_time:.2f} seconds.")
 
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
+if __name__ == '__main__':
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
 
-process_images_and_create_video(input_folder, output_folder, fps, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution)
+    process_images_and_create_video(input_folder, output_folder, fps, horizontal_fov_deg, vertical_fov_deg, horizontal_rotation_deg, input_resolution, output_resolution)
@@ -0,0 +1,322 @@
+# Estimates XYZ corrections of overlapping point cloud strips and writes them as a corrections table for
+# apply_interpolated_corrections_to_pointclouds.py ("corrections_file"), instead of measuring the shifts by hand.
+# Overlapping strips are found from the LAS header bounds. Each overlap is split into square regions of "region_size",
+# so long overlaps give several corrections along the strip. Both strips are voxel-downsampled to the voxel centroids
+# in every region while they are read, every file only once and in chunks of "chunk_size" points.
+# The shift of the later strip (by median gps_time) against the earlier one is estimated per region with
+# point-to-plane ICP for a translation only: the reference normals come from its "normal_neighbours" nearest voxels
+# and the target voxels are matched to the reference with a KD-tree. Outlying residuals are downweighted (Huber).
+# Directions the region does not constrain (e.g. horizontal shifts on flat ground) are found from the eigenvalues of
+# the normal matrix and left unshifted, the "constrained" column gives the number of constrained directions. Shifts
+# larger than "max_correspondence_distance" are rejected.
+# The correction of a region is its shift added to the correction of the reference strip at the reference's time, so
+# the earliest strip stays fixed and the corrections chain along the later strips. The timestamp of a correction is
+# the median gps_time of the matched target voxels.
+# Files are read and regions matched in "worker_count" processes in parallel.
+# Per-file read timings are written as JSON lines when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
+
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.spatial import cKDTree
+
+from processing_metrics import FileMetrics
+from laz_io import open_las
+
+input_dir = 'laz_in'
+output_path = 'corrections.csv'
+chunk_size = 1_000_000  # Points read per chunk
+region_size = 100  # Edge length of the overlap regions that get a correction each, in coordinate units
+min_overlap_size = 10  # Overlaps narrower than this in x or y are ignored
+voxel_size = 0.2  # Voxel edge length of the downsampled strips
+min_region_voxels = 500  # Regions with fewer voxels in either strip are skipped
+normal_neighbours = 10  # Reference voxels used to estimate each normal
+max_correspondence_distance = 1.0  # Target voxels further from the reference are not matched
+max_iterations = 30
+min_correction_interval = 1.0  # Corrections closer in time than this (seconds) are merged into one
+convergence_tolerance = 0.0005  # ICP stops when the translation changes less than this
+min_constraint = 0.02  # Directions whose normal matrix eigenvalue is below this share of the matches are not shifted
+huber_threshold = 1.345  # Residuals beyond this many robust standard deviations are downweighted
+worker_count = os.cpu_count() or 1
+
+CSV_COLUMNS = ['timestamp', 'x_shift', 'y_shift', 'z_shift', 'reference', 'target', 'rmse', 'matches', 'constrained']
+
+
+def read_strip_bounds(laz_dir):
+    strips = {}
+    for laz_file in sorted(os.listdir(laz_dir)):
+        if not (laz_file.endswith('.las') or laz_file.endswith('.laz')):
+            continue
+        with open_las(os.path.join(laz_dir, laz_file)) as reader:
+            header = reader.header
+            if 'gps_time' not in header.point_format.dimension_names:
+                print(f"'gps_time' dimension not found in {laz_file}. Skipping file.")
+                continue
+            strips[laz_file] = (header.mins, header.maxs)
+    return strips
+
+
+def find_overlaps(strips):
+    # The bounding box intersection of every pair of strips that overlap by at least "min_overlap_size"
+    overlaps = []
+    names = list(strips)
+    for i, first in enumerate(names):
+        for second in names[i + 1:]:
+            mins = np.maximum(strips[first][0][:2], strips[second][0][:2])
+            maxs = np.minimum(strips[first][1][:2], strips[second][1][:2])
+            if np.all(maxs - mins >= min_overlap_size):
+                overlaps.append((first, second, mins, maxs))
+    return overlaps
+
+
+def get_region_shape(overlap_mins, overlap_maxs):
+    # The remainder at the far edges is added to the last regions, instead of thin regions that constrain little
+    return np.maximum(np.floor((overlap_maxs - overlap_mins) / region_size).astype(np.int64), 1)
+
+
+def get_group_starts(sorted_keys):
+    changed = np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+    return np.flatnonzero(np.concatenate([[True], changed]))
+
+
+def reduce_voxels(keys, sums, counts):
+    # Merges the sums of the rows with the same key, e.g. the partial voxel sums of several chunks. The keys are
+    # returned sorted, so the voxels of a region are consecutive.
+    order = np.lexsort(keys.T[::-1])
+    keys = keys[order]
+    starts = get_group_starts(keys)
+    return keys[starts], np.add.reduceat(sums[order], starts, axis=0), np.add.reduceat(counts[order], starts)
+
+
+def read_overlap_voxels(laz_path, overlaps):
+    # Returns the voxel centroids (x, y, z, gps_time) of the strip per overlap index and region, coordinates relative to
+    # the overlap minimum. "overlaps" are (overlap index, mins, maxs) tuples.
+    metrics = FileMetrics(__file__, laz_path)
+    partials = {index: [] for index, mins, maxs in overlaps}
+    with open_las(laz_path) as reader:
+        for points in metrics.timed(reader.chunk_iterator(chunk_size)):
+            with metrics.stage('voxels'):
+                x = np.asarray(points.x)
+                y = np.asarray(points.y)
+                for index, mins, maxs in overlaps:
+                    inside = np.flatnonzero((x >= mins[0]) & (x <= maxs[0]) & (y >= mins[1]) & (y <= maxs[1]))
+                    if len(inside) == 0:
+                        continue
+                    values = np.column_stack([x[inside] - mins[0], y[inside] - mins[1], np.asarray(points.z)[inside],
+                                              np.asarray(points.gps_time)[inside]])
+                    regions = np.minimum(np.floor(values[:, :2] / region_size).astype(np.int64),
+                                         get_region_shape(mins, maxs) - 1)
+                    voxels = np.floor(values[:, :3] / voxel_size).astype(np.int64)
+                    partials[index].append(reduce_voxels(np.column_stack([regions, voxels]), values,
+                                                         np.ones(len(values))))
+            metrics.count(points=len(points))
+
+    result = {}
+    for index, parts in partials.items():
+        if not parts:
+            continue
+        keys, sums, counts = reduce_voxels(*(np.concatenate(arrays) for arrays in zip(*parts)))
+        centroids = sums / counts[:, None]
+        starts = get_group_starts(keys[:, :2])
+        stops = np.append(starts[1:], len(keys))
+        result[index] = {tuple(int(value) for value in keys[start, :2]): centroids[start:stop]
+                         for start, stop in zip(starts, stops)}
+    metrics.finish(mode='overlap_voxels', overlaps=len(overlaps))
+    return result
+
+
+def estimate_normals(tree, xyz):
+    _, neighbours = tree.query(xyz, k=min(normal_neighbours, len(xyz)))
+    neighbour_xyz = xyz[neighbours]
+    centred = neighbour_xyz - neighbour_xyz.mean(axis=1, keepdims=True)
+    covariances = np.einsum('nki,nkj->nij', centred, centred)
+    # The eigenvector of the smallest eigenvalue is the normal of the local plane
+    return np.linalg.eigh(covariances)[1][:, :, 0]
+
+
+def get_huber_weights(residuals):
+    # Residuals beyond "huber_threshold" robust standard deviations (from the median absolute residual) get weights
+    # that fall with their size, so outliers such as vegetation or moved objects pull the solution less. The standard
+    # deviation is at least a hundredth of the voxel size, so exactly matching surfaces don't make the rest outliers.
+    sigma = max(1.4826 * float(np.median(np.abs(residuals))), voxel_size / 100)
+    return np.minimum(1.0, huber_threshold * sigma / np.maximum(np.abs(residuals), 1e-12))
+
+
+def get_constrained_directions(normals):
+    # The eigenvectors of the normal matrix whose eigenvalue is at least "min_constraint" of the number of matches,
+    # e.g. only the vertical on flat ground, where the normals give no grip on horizontal shifts
+    eigenvalues, eigenvectors = np.linalg.eigh(normals.T @ normals)
+    return eigenvectors[:, eigenvalues >= min_constraint * len(normals)]
+
+
+def match_voxels(tree, normals, reference_xyz, target_xyz, translation):
+    # The target voxels within "max_correspondence_distance" of the reference and their point-to-plane residuals
+    distances, indices = tree.query(target_xyz + translation, distance_upper_bound=max_correspondence_distance)
+    matched = np.isfinite(distances)
+    if np.count_nonzero(matched) < min_region_voxels:
+        return None
+    match_normals = normals[indices[matched]]
+    residuals = np.einsum('ni,ni->n', match_normals, target_xyz[matched] + translation - reference_xyz[indices[matched]])
+    return matched, match_normals, residuals
+
+
+def estimate_translation(reference, target):
+    # Point-to-plane ICP for a translation only. Returns the shift to add to the target, the RMS point-to-plane
+    # residual, the number of matched target voxels, their median gps_time and the number of constrained directions,
+    # or None without enough matches.
+    reference_xyz = reference[:, :3]
+    target_xyz = target[:, :3]
+    tree = cKDTree(reference_xyz)
+    normals = estimate_normals(tree, reference_xyz)
+
+    translation = np.zeros(3)
+    directions = np.eye(3)
+    for iteration in range(max_iterations):
+        matches = match_voxels(tree, normals, reference_xyz, target_xyz, translation)
+        if matches is None:
+            return None
+        matched, match_normals, residuals = matches
+        # Weighted least squares of n . (p + t + delta - q) = 0, solved in the constrained directions only
+        weights = get_huber_weights(residuals)
+        directions = get_constrained_directions(match_normals)
+        projected_normals = match_normals @ directions
+        delta = directions @ np.linalg.lstsq(projected_normals * weights[:, None] ** 0.5,
+                                             -residuals * weights ** 0.5, rcond=None)[0]
+        translation += delta
+        if np.linalg.norm(delta) < convergence_tolerance:
+            break
+
+    # Earlier iterations may have moved along directions that turned out unconstrained
+    translation = directions @ (directions.T @ translation)
+    matches = match_voxels(tree, normals, reference_xyz, target_xyz, translation)
+    if matches is None:
+        return None
+    matched, match_normals, residuals = matches
+    rmse = float(np.sqrt(np.mean(residuals ** 2)))
+    return (translation, rmse, int(np.count_nonzero(matched)), float(np.median(target[matched, 3])),
+            get_constrained_directions(match_normals).shape[1])
+
+
+def run_parallel(function, jobs):
+    if worker_count > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            return list(executor.map(function, *zip(*jobs)))
+    return [function(*job) for job in jobs]
+
+
+def merge_rows(row, other):
+    # Averages "other" into "row", weighted by the last column, the merge weight
+    weights = np.array([row[9], other[9]], dtype=np.float64)
+    for column in (0, 1, 2, 3, 6):
+        row[column] = float(np.average([row[column], other[column]], weights=weights))
+    row[7] += other[7]
+    row[8] = min(row[8], other[8])
+    row[9] += other[9]
+
+
+def chain_corrections(results):
+    # "results" are (reference time, target time, shift, reference, target, rmse, matches, constrained) tuples. Taken in
+    # target time order, each shift is added to the correction of the reference strip at the reference time,
+    # interpolated from the corrections found so far. The first reference is anchored with a zero correction.
+    # Along the unconstrained directions of a region the target keeps the reference's correction, the "constrained"
+    # column flags such rows. Regions that constrain no direction are skipped, they would only copy the reference.
+    # Corrections closer in time than "min_correction_interval" are merged, weighted by their matches, as the correction
+    # step extrapolates the steep slopes between nearly simultaneous corrections and needs strictly increasing
+    # timestamps. The anchor has no matches of its own and is weighted like the first pair it anchors. Merging can move
+    # a row's time towards another one, so the sorted rows are merged once more at the end.
+    # The rows end with the merge weight, which is not written.
+    rows = []
+    for reference_time, target_time, shift, reference, target, rmse, matches, constrained in sorted(results, key=lambda r: r[1]):
+        if constrained == 0:
+            continue
+        if not rows:
+            rows.append([reference_time, 0.0, 0.0, 0.0, reference, reference, 0.0, 0, 3, matches])
+        times = np.array([row[0] for row in rows])
+        order = np.argsort(times)
+        reference_correction = [np.interp(reference_time, times[order], np.array([row[column] for row in rows])[order])
+                                for column in (1, 2, 3)]
+        correction = [target_time, *(shift + reference_correction), reference, target, rmse, matches, constrained, matches]
+
+        close = [row for row in rows if abs(row[0] - target_time) < min_correction_interval]
+        if close:
+            merge_rows(close[0], correction)
+        else:
+            rows.append(correction)
+
+    merged = []
+    for row in sorted(rows, key=lambda row: row[0]):
+        if merged and row[0] - merged[-1][0] < min_correction_interval:
+            merge_rows(merged[-1], row)
+        else:
+            merged.append(row)
+    return merged
+
+
+def estimate_strip_corrections(input_dir, output_path):
+    strips = read_strip_bounds(input_dir)
+    overlaps = find_overlaps(strips)
+    print(f"Found {len(overlaps)} overlapping strip pairs in {len(strips)} files.")
+    if not overlaps:
+        return
+
+    file_overlaps = {}
+    for index, (first, second, mins, maxs) in enumerate(overlaps):
+        file_overlaps.setdefault(first, []).append((index, mins, maxs))
+        file_overlaps.setdefault(second, []).append((index, mins, maxs))
+    laz_files = list(file_overlaps)
+    voxels = dict(zip(laz_files, run_parallel(
+        read_overlap_voxels, [(os.path.join(input_dir, laz_file), file_overlaps[laz_file]) for laz_file in laz_files])))
+
+    jobs = []
+    job_strips = []
+    for index, (first, second, mins, maxs) in enumerate(overlaps):
+        first_regions = voxels[first].get(index, {})
+        second_regions = voxels[second].get(index, {})
+        common = [region for region in first_regions if region in second_regions]
+        if not common:
+            continue
+        # The strip with the earlier median time in the overlap is the reference
+        first_time = np.median(np.concatenate([first_regions[region][:, 3] for region in common]))
+        second_time = np.median(np.concatenate([second_regions[region][:, 3] for region in common]))
+        reference, target = (first, second) if first_time <= second_time else (second, first)
+        for region in common:
+            reference_voxels = voxels[reference][index][region]
+            target_voxels = voxels[target][index][region]
+            if min(len(reference_voxels), len(target_voxels)) < min_region_voxels:
+                continue
+            jobs.append((reference_voxels, target_voxels))
+            job_strips.append((reference, target, float(np.median(reference_voxels[:, 3]))))
+
+    print(f"Matching {len(jobs)} overlap regions...")
+    results = []
+    rejected = 0
+    for (reference, target, reference_time), result in zip(job_strips, run_parallel(estimate_translation, jobs)):
+        if result is None:
+            continue
+        shift, rmse, matches, target_time, constrained = result
+        # A shift beyond the matching distance ran away from the matches it started from
+        if np.linalg.norm(shift) > max_correspondence_distance:
+            print(f"Rejected the shift {np.round(shift, 3)} of {target} against {reference} at {target_time:.1f}, "
+                  f"it is larger than the max correspondence distance.")
+            rejected += 1
+            continue
+        results.append((reference_time, target_time, shift, reference, target, rmse, matches, constrained))
+    weak = sum(1 for result in results if result[7] < 3)
+    if weak:
+        print(f"{weak} regions constrain fewer than 3 directions, their unconstrained directions are not shifted.")
+
+    rows = chain_corrections(results)
+    if np.any(np.diff([row[0] for row in rows]) <= 0):
+        raise ValueError("The correction timestamps are not strictly increasing")
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_COLUMNS)
+        for row in rows:
+            writer.writerow([f"{row[0]:.6f}", f"{row[1]:.4f}", f"{row[2]:.4f}", f"{row[3]:.4f}", row[4], row[5],
+                             f"{row[6]:.4f}", row[7], row[8]])
+    print(f"Wrote {len(rows)} corrections from {len(results)} matched regions to {output_path}, rejected {rejected}.")
+
+
+if __name__ == '__main__':
+    estimate_strip_corrections(input_dir, output_path)
@@ -1,45 +1,442 @@
 # Filters point clouds based on custom dimensions. In this case "Distance".
+# For several conditions set "filter_expression", e.g.
+# "2.5 <= Distance <= 100 and classification in (2, 6) and return_number in (1, 2)".
+# Comparisons, chained ranges, 'in'/'not in' sets and 'and', 'or', 'not' are supported on any dimension.
+# The expression is compiled once and evaluated as one boolean mask per chunk of "chunk_size" points.
+# Kept points are streamed straight to the output file.
+# Per-file stage timings are written as JSON lines when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
+# With "incremental" set, only new or changed files and files filtered with another expression are processed, "watch"
+# keeps processing new files as they arrive, see incremental_processing.py.
+# Set "thinning" to thin the points that pass the filter:
+#   'voxel'       - keeps one point per cube of "voxel_size": the first one, the one closest to the centroid of the
+#                   voxel's points or the one with the highest "voxel_keep_dimension" value ("voxel_keep")
+#   'min_spacing' - keeps points so that no two kept points are closer than "min_spacing". Cells of "min_spacing" are
+#                   processed in 8 rounds, one per parity of the cell x/y/z, so the cells of a round are independent.
+#                   Within a cell the earliest point is kept first and the points too close to it dropped.
+# Large files are thinned out of core: the passing points are written to temporary files per XY bucket of about
+# "bucket_size", each bucket is thinned on its own (with the kept points near its edges from the neighbouring buckets
+# in 'min_spacing' mode) and the kept points are then streamed to the output in their original order. The result is
+# the same as thinning the whole file in memory ("chunk_size" None). Only the largest bucket has to fit in memory.
 
+import ast
 import laspy
 import numpy as np
 import os
+import tempfile
+
+from processing_metrics import FileMetrics
+from laz_io import open_las, read_las, write_las
+from incremental_processing import ProcessingManifest, watch as watch_inputs
 
 input_dir = 'laz_original'
 output_dir = 'laz_filtered'
-dimension_name = 'Distance'  
-min_value = 2.5  
-max_value = 100  
+dimension_name = 'Distance'
+min_value = 2.5
+max_value = 100
+filter_expression = None  # None filters "dimension_name" between "min_value" and "max_value"
+chunk_size = 1_000_000  # Points per chunk, None reads the whole file at once
+incremental = False  # Skip files that were already filtered with the same expression
+watch = False  # Keep running and filter new files every "watch_interval" seconds
+watch_interval = 60
+thinning = None  # None, 'voxel' or 'min_spacing'
+voxel_size = 0.05  # Voxel edge length in coordinate units
+voxel_keep = 'first'  # 'first', 'centroid' or 'max'
+voxel_keep_dimension = 'intensity'  # Dimension whose highest value is kept with voxel_keep 'max'
+min_spacing = 0.05  # Minimum distance between kept points in 'min_spacing' mode
+bucket_size = 100  # XY bucket edge length in coordinate units for out-of-core thinning
+temp_dir = None  # Directory for the temporary bucket files, None uses the system temp directory
+
+COMPARISON_OPERATORS = {
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+
+# Passing points written to the bucket files, coordinates relative to the file minimum
+THINNING_RECORD = np.dtype([('index', '<i8'), ('x', '<f8'), ('y', '<f8'), ('z', '<f8'), ('value', '<f8')])
+# Points kept in 'min_spacing' mode and the round they were kept in, per bucket including its neighbours' edges
+KEPT_RECORD = np.dtype([('x', '<f8'), ('y', '<f8'), ('z', '<f8'), ('round', '<i8')])
+COLOR_WEIGHTS = np.array([1, 2, 4])
+
+
+def compile_value(node, dimension_names):
+    if isinstance(node, ast.Name):
+        dimension_names.add(node.id)
+        return lambda points: np.asarray(getattr(points, node.id))
+    try:
+        value = ast.literal_eval(node)
+    except ValueError:
+        raise ValueError(f"Unsupported value in filter expression: {ast.unparse(node)}")
+    return lambda points: value
+
+
+def compile_comparison(node, dimension_names):
+    operands = [compile_value(node.left, dimension_names)]
+    for comparator in node.comparators:
+        if isinstance(comparator, (ast.Tuple, ast.List, ast.Set)):
+            operands.append(np.array(sorted(ast.literal_eval(comparator))))
+        else:
+            operands.append(compile_value(comparator, dimension_names))
+    operators = node.ops
+
+    for op, right in zip(operators, operands[1:]):
+        if isinstance(op, (ast.In, ast.NotIn)) != isinstance(right, np.ndarray):
+            raise ValueError("'in' and 'not in' need a list of values on the right side")
+        if not isinstance(op, (ast.In, ast.NotIn)) and type(op) not in COMPARISON_OPERATORS:
+            raise ValueError(f"Unsupported comparison '{type(op).__name__}'")
+
+    def evaluate(points):
+        mask = None
+        left = operands[0](points)
+        for op, operand in zip(operators, operands[1:]):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                result = np.isin(left, operand, invert=isinstance(op, ast.NotIn))
+            else:
+                right = operand(points)
+                result = COMPARISON_OPERATORS[type(op)](left, right)
+                left = right
+            if mask is None:
+                mask = result
+            else:
+                mask &= result
+        return mask
+
+    return evaluate
+
+
+def compile_node(node, dimension_names):
+    if isinstance(node, ast.Compare):
+        return compile_comparison(node, dimension_names)
+
+    if isinstance(node, ast.BoolOp):
+        parts = [compile_node(value, dimension_names) for value in node.values]
+        is_and = isinstance(node.op, ast.And)
+
+        def evaluate(points):
+            mask = parts[0](points)
+            for part in parts[1:]:
+                if is_and:
+                    mask &= part(points)
+                else:
+                    mask |= part(points)
+            return mask
+
+        return evaluate
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        operand = compile_node(node.operand, dimension_names)
+        return lambda points: ~operand(points)
+
+    raise ValueError(f"Unsupported filter expression: {ast.unparse(node)}")
+
+
+def compile_filter_expression(expression):
+    dimension_names = set()
+    evaluate_node = compile_node(ast.parse(expression, mode='eval').body, dimension_names)
+
+    def evaluate(points):
+        return np.broadcast_to(np.asarray(evaluate_node(points), dtype=bool), (len(points),))
+
+    return evaluate, dimension_names
+
+
+def filter_points_chunked(input_file, output_file, evaluate, chunk_size, metrics):
+    kept_count = 0
+    dropped_count = 0
+    writer = None
+    with open_las(input_file) as reader:
+        try:
+            for points in metrics.timed(reader.chunk_iterator(chunk_size)):
+                with metrics.stage('transform'):
+                    mask = evaluate(points)
+                chunk_kept = int(np.count_nonzero(mask))
+                kept_count += chunk_kept
+                dropped_count += len(points) - chunk_kept
+                if chunk_kept == 0:
+                    continue
+                # The output file is only created once there is something to write
+                with metrics.stage('write'):
+                    if writer is None:
+                        writer = open_las(output_file, mode='w', header=reader.header)
+                    writer.write_points(points[mask])
+        finally:
+            if writer is not None:
+                with metrics.stage('write'):
+                    writer.close()
+    metrics.count(points=kept_count + dropped_count, points_kept=kept_count)
+    return kept_count, dropped_count
+
+
+def get_cell_size():
+    return voxel_size if thinning == 'voxel' else min_spacing
+
+
+def make_thinning_records(points, mask, start, origin):
+    indices = np.flatnonzero(mask)
+    records = np.empty(len(indices), dtype=THINNING_RECORD)
+    records['index'] = start + indices
+    records['x'] = np.asarray(points.x)[indices] - origin[0]
+    records['y'] = np.asarray(points.y)[indices] - origin[1]
+    records['z'] = np.asarray(points.z)[indices] - origin[2]
+    records['value'] = np.asarray(points[voxel_keep_dimension])[indices] if voxel_keep == 'max' else 0
+    return records
+
+
+def get_cells(records, cell_size):
+    return np.floor(np.column_stack([records['x'], records['y'], records['z']]) / cell_size).astype(np.int64)
+
+
+def get_group_starts(sorted_cells):
+    changed = np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1)
+    return np.flatnonzero(np.concatenate([[True], changed]))
+
+
+def select_voxel_points(records):
+    # Returns the indices of the kept points, one per occupied voxel
+    if len(records) == 0:
+        return np.empty(0, dtype=np.int64)
+    cells = get_cells(records, voxel_size)
+    indices = records['index']
+    if voxel_keep == 'max':
+        order = np.lexsort((indices, -records['value'], cells[:, 2], cells[:, 1], cells[:, 0]))
+        return indices[order[get_group_starts(cells[order])]]
+
+    order = np.lexsort((indices, cells[:, 2], cells[:, 1], cells[:, 0]))
+    starts = get_group_starts(cells[order])
+    if voxel_keep == 'centroid':
+        counts = np.diff(np.append(starts, len(order)))
+        groups = np.repeat(np.arange(len(starts)), counts)
+        distances = np.zeros(len(order))
+        for axis in ('x', 'y', 'z'):
+            values = records[axis][order]
+            centroids = np.add.reduceat(values, starts) / counts
+            distances += (values - centroids[groups]) ** 2
+        # Closest to the centroid first within each voxel, ties go to the earlier point
+        order = order[np.lexsort((indices[order], distances, groups))]
+    return indices[order[starts]]
+
+
+def select_min_spacing(records, kept_xyz):
+    # Returns the positions in "records" (points of cells of one round) of the points to keep. Points closer than
+    # "min_spacing" to an already kept point are dropped first, then every cell keeps its earliest point and drops the
+    # points too close to it until no points are left. Cells of one round are at least "min_spacing" apart.
+    from scipy.spatial import cKDTree
+
+    xyz = np.column_stack([records['x'], records['y'], records['z']])
+    candidates = np.arange(len(records))
+    if len(kept_xyz) and len(candidates):
+        distances, _ = cKDTree(kept_xyz).query(xyz, distance_upper_bound=min_spacing)
+        candidates = candidates[distances >= min_spacing]
+
+    cells = get_cells(records, min_spacing)
+    candidates = candidates[np.lexsort((records['index'][candidates], cells[candidates, 2], cells[candidates, 1],
+                                        cells[candidates, 0]))]
+    accepted = []
+    while len(candidates):
+        starts = get_group_starts(cells[candidates])
+        groups = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(candidates))))
+        accepted.append(candidates[starts])
+        distances = np.linalg.norm(xyz[candidates] - xyz[candidates[starts]][groups], axis=1)
+        remaining = distances >= min_spacing
+        remaining[starts] = False
+        candidates = candidates[remaining]
+    return np.concatenate(accepted) if accepted else np.empty(0, dtype=np.int64)
+
+
+def get_colors(records):
+    return (get_cells(records, min_spacing) & 1) @ COLOR_WEIGHTS
+
+
+def thin_in_memory(points, mask, origin):
+    records = make_thinning_records(points, mask, 0, origin)
+    keep = np.zeros(len(points), dtype=bool)
+    if thinning == 'voxel':
+        keep[select_voxel_points(records)] = True
+        return keep
+
+    colors = get_colors(records)
+    kept_xyz = np.empty((0, 3))
+    for color in range(8):
+        color_records = records[colors == color]
+        accepted = color_records[select_min_spacing(color_records, kept_xyz)]
+        keep[accepted['index']] = True
+        kept_xyz = np.concatenate([kept_xyz, np.column_stack([accepted['x'], accepted['y'], accepted['z']])])
+    return keep
+
+
+def append_grouped(records, keys, directory, suffix):
+    # Appends the records to one file per key row, e.g. "<bucket x>_<bucket y>_<suffix>.bin"
+    if len(records) == 0:
+        return set()
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    starts = np.searchsorted(inverse.ravel()[order], np.arange(len(unique_keys)))
+    for key, group in zip(unique_keys, np.split(order, starts[1:])):
+        name = '_'.join(str(value) for value in key)
+        with open(os.path.join(directory, f"{name}_{suffix}.bin"), 'ab') as f:
+            records[group].tofile(f)
+    return {tuple(int(value) for value in key) for key in unique_keys}
+
+
+def bucket_points(reader, evaluate, chunk_size, directory, metrics):
+    cells_per_bucket = max(int(bucket_size // get_cell_size()), 1)
+    origin = reader.header.mins
+    buckets = set()
+    start = 0
+    for points in metrics.timed(reader.chunk_iterator(chunk_size)):
+        with metrics.stage('bucket'):
+            records = make_thinning_records(points, evaluate(points), start, origin)
+            cells = get_cells(records, get_cell_size())
+            keys = cells[:, :2] // cells_per_bucket
+            if thinning == 'min_spacing':
+                keys = np.column_stack([keys, (cells & 1) @ COLOR_WEIGHTS])
+            else:
+                keys = np.column_stack([keys, np.zeros(len(keys), dtype=np.int64)])
+            buckets |= append_grouped(records, keys, directory, 'points')
+        start += len(points)
+    return buckets
+
+
+def thin_min_spacing_buckets(buckets, directory, keep):
+    cells_per_bucket = max(int(bucket_size // min_spacing), 1)
+    bucket_xy = sorted({(bx, by) for bx, by, color in buckets})
+    for color in range(8):
+        for bx, by in bucket_xy:
+            points_path = os.path.join(directory, f"{bx}_{by}_{color}_points.bin")
+            if not os.path.exists(points_path):
+                continue
+            records = np.fromfile(points_path, dtype=THINNING_RECORD)
+            kept_path = os.path.join(directory, f"{bx}_{by}_kept.bin")
+            kept = np.fromfile(kept_path, dtype=KEPT_RECORD) if os.path.exists(kept_path) else np.empty(0, KEPT_RECORD)
+            # Only the points kept in earlier rounds, as in a run over the whole file
+            kept = kept[kept['round'] < color]
+            accepted = records[select_min_spacing(records, np.column_stack([kept['x'], kept['y'], kept['z']]))]
+            keep[accepted['index']] = True
+
+            # Every kept point goes to the kept file of its own bucket and of the buckets of its neighbouring cells
+            kept_records = np.empty(len(accepted), dtype=KEPT_RECORD)
+            for axis in ('x', 'y', 'z'):
+                kept_records[axis] = accepted[axis]
+            kept_records['round'] = color
+            cells = get_cells(accepted, min_spacing)
+            targets = np.concatenate([
+                np.column_stack([np.arange(len(accepted)), (cells[:, 0] + dx) // cells_per_bucket,
+                                 (cells[:, 1] + dy) // cells_per_bucket])
+                for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+            ])
+            targets = np.unique(targets, axis=0)
+            append_grouped(kept_records[targets[:, 0]], targets[:, 1:], directory, 'kept')
+
+
+def make_keep_evaluator(keep):
+    # Evaluates the chunks of a chunk iterator in order against the keep flags of the whole file
+    position = [0]
+
+    def evaluate(points):
+        start = position[0]
+        position[0] += len(points)
+        return np.asarray(keep[start:position[0]])
+
+    return evaluate
+
+
+def thin_points_chunked(input_file, output_file, evaluate, chunk_size, metrics):
+    with tempfile.TemporaryDirectory(dir=temp_dir) as directory:
+        with open_las(input_file) as reader:
+            point_count = reader.header.point_count
+            buckets = bucket_points(reader, evaluate, chunk_size, directory, metrics)
+
+        keep = np.memmap(os.path.join(directory, 'keep.bin'), dtype=bool, mode='w+', shape=(max(point_count, 1),))
+        with metrics.stage('thin'):
+            if thinning == 'voxel':
+                for bx, by, color in buckets:
+                    records = np.fromfile(os.path.join(directory, f"{bx}_{by}_{color}_points.bin"), dtype=THINNING_RECORD)
+                    keep[select_voxel_points(records)] = True
+            else:
+                thin_min_spacing_buckets(buckets, directory, keep)
+
+        result = filter_points_chunked(input_file, output_file, make_keep_evaluator(keep), chunk_size, metrics)
+        # The memory map has to be closed before the temporary directory can be removed on Windows
+        del keep
+    return result
+
 
 def filter_laz_by_dimension(input_dir, output_dir, dimension_name, min_value, max_value):
-    
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    
+
+    expression = filter_expression
+    if expression is None:
+        expression = f"{min_value!r} <= {dimension_name} <= {max_value!r}"
+    evaluate, required_dimensions = compile_filter_expression(expression)
+    settings = {'expression': expression}
+    if thinning is not None:
+        if thinning not in ('voxel', 'min_spacing'):
+            raise ValueError(f"Unknown thinning '{thinning}'")
+        if voxel_keep not in ('first', 'centroid', 'max'):
+            raise ValueError(f"Unknown voxel_keep '{voxel_keep}'")
+        if thinning == 'voxel' and voxel_keep == 'max':
+            required_dimensions = required_dimensions | {voxel_keep_dimension}
+        settings['thinning'] = {'thinning': thinning, 'voxel_size': voxel_size, 'voxel_keep': voxel_keep,
+                                'voxel_keep_dimension': voxel_keep_dimension, 'min_spacing': min_spacing}
+    manifest = ProcessingManifest(output_dir, __file__, settings, incremental or watch)
+
+    total_kept = 0
+    total_dropped = 0
     for filename in os.listdir(input_dir):
         if filename.endswith('.las') or filename.endswith('.laz'):
             input_file = os.path.join(input_dir, filename)
             output_file = os.path.join(output_dir, filename)
-            
+            if not manifest.needs_processing(input_file):
+                continue
+
             print(f"Processing {filename}...")
-            
-            las = laspy.read(input_file)
-            
-            if dimension_name not in las.point_format.dimension_names:
-                print(f"Dimension '{dimension_name}' not found in {filename}. Skipping file.")
+
+            with laspy.open(input_file) as reader:
+                available_dimensions = set(reader.header.point_format.dimension_names) | {'x', 'y', 'z'}
+            missing_dimensions = required_dimensions - available_dimensions
+            if missing_dimensions:
+                print(f"Dimensions {sorted(missing_dimensions)} not found in {filename}. Skipping file.")
                 continue
-            
-            dimension_values = getattr(las, dimension_name)
-            
-            within_range_indices = np.where((dimension_values >= min_value) & (dimension_values <= max_value))[0]
-            
-            if len(within_range_indices) > 0:
-                filtered_points = las[within_range_indices]
-                
-                filtered_points.write(output_file)
-                
+
+            metrics = FileMetrics(__file__, input_file, output_file)
+            if chunk_size is not None and thinning is not None:
+                kept_count, dropped_count = thin_points_chunked(input_file, output_file, evaluate, chunk_size, metrics)
+            elif chunk_size is not None:
+                kept_count, dropped_count = filter_points_chunked(input_file, output_file, evaluate, chunk_size, metrics)
+            else:
+                with metrics.stage('read'):
+                    las = read_las(input_file)
+                with metrics.stage('transform'):
+                    mask = evaluate(las.points)
+                    if thinning is not None:
+                        mask = thin_in_memory(las.points, mask, las.header.mins)
+                kept_count = int(np.count_nonzero(mask))
+                dropped_count = len(mask) - kept_count
+                if kept_count > 0:
+                    with metrics.stage('write'):
+                        write_las(las[mask], output_file)
+                metrics.count(points=len(mask), points_kept=kept_count)
+            metrics.finish()
+            manifest.record(input_file, [output_file] if kept_count > 0 else [])
+
+            total_kept += kept_count
+            total_dropped += dropped_count
+            print(f"{filename}: kept {kept_count} points, dropped {dropped_count} points.")
+            if kept_count > 0:
                 print(f"Filtered point cloud saved to {output_file}.")
             else:
-                print(f"No points within the specified range for {dimension_name} in {filename}. Skipping file.")
+                print(f"No points match '{expression}' in {filename}. Skipping file.")
+
+    print(f"Kept {total_kept} points, dropped {total_dropped} points in total.")
 
 
-filter_laz_by_dimension(input_dir, output_dir, dimension_name, min_value, max_value)
+if __name__ == '__main__':
+    if watch:
+        watch_inputs(lambda: filter_laz_by_dimension(input_dir, output_dir, dimension_name, min_value, max_value), watch_interval)
+    else:
+        filter_laz_by_dimension(input_dir, output_dir, dimension_name, min_value, max_value)
@@ -1,16 +1,47 @@
 # Generates tiles along a polyline from the input SHP file.
 # Define the "buffer_width" - the width of the tile in meters - and "distance_between_points" - the approximate length of the tile along the polyline - in code below.
 # Note that if the polyline is very twisty then theresults will need to be checked manually.
+# The 'linear' tiling engine walks every part of the (Multi)LineString once: the stations and their segments are found
+# from the cumulative segment lengths and every station gets one cutting line, perpendicular to the line or along the
+# bisector when the station is on a bend vertex. The whole buffer is split along all cutting lines at once, so the
+# tiles that meet at a station share its cutting line and the first and last tile keep the round ends of the buffer.
+# The 'split' engine is the original approach of splitting the buffer with one cutting line after another, which gets
+# slow on long routes.
+# The tiles are numbered with an "FID" field, which tile_pointclouds_based_on_SHP_boundaries.py uses for the tile names.
+# With "tile_sizing" set to 'density' the linear engine picks every tile length so the tile holds about
+# "target_points_per_tile" points, between "min_tile_length" and "max_tile_length" meters. The point density along the
+# corridor comes from the LAZ headers in "laz_dir" (the extent index shared with the tiler, see laz_extent_index.py) and
+# a coarse density grid of "density_cell_size" meters, built from "density_sample_size" points read from each file
+# that touches the corridor. The density is summed across the corridor every "density_step" meters along and across it.
+# The run's stage timings are written as a JSON line when PROCESSING_METRICS_PATH is set, see processing_metrics.py.
 
 
 import geopandas as gpd
+import shapely
 from shapely.geometry import LineString, Point, MultiLineString, Polygon
 from shapely.ops import unary_union, split
 import numpy as np
+import logging
+import os
 
-line_gdf = gpd.read_file('polyline.shp')
-buffer_width = 60  
+from processing_metrics import FileMetrics
+from laz_io import open_las
+from laz_extent_index import update_extent_index, get_las_bbox
+
+input_path = 'polyline.shp'
+output_path = 'tiled_multipolygons.shp'
+buffer_width = 60
 distance_between_points = 600
+tiling_engine = 'linear'  # 'linear' or 'split'
+tile_sizing = 'fixed'  # 'fixed' or 'density', only used by the 'linear' engine
+laz_dir = 'laz_tiles'
+target_points_per_tile = 50_000_000
+min_tile_length = 100
+max_tile_length = 2000
+density_cell_size = 100
+density_sample_size = 20_000  # Points sampled from each LAZ file
+density_sample_batches = 20  # The sampled points are read in this many evenly spaced batches
+density_step = 10  # Spacing in meters of the density profile along the line
 
 # Function to create a perpendicular line to the line at the point
 def create_perpendicular_line(line, point, length):
@@ -34,7 +65,7 @@ def create_perpendicular_line(line, point, length):
         segment = LineString([line_coords[i], line_coords[i+1]])
         if segment.distance(point) < 1e-8:
             # Calculate the angle of the line
-            angle = np.arctan2(segment.coords[1][1] - segment.coords[0][1], 
+            angle = np.arctan2(segment.coords[1][1] - segment.coords[0][1],
                                segment.coords[1][0] - segment.coords[0][0])
             # Create a perpendicular angle
             perp_angle = angle + np.pi / 2
@@ -46,45 +77,260 @@ def create_perpendicular_line(line, point, length):
             return LineString([p1, p2])
 
 
-# Buffer the line to create the area polygon
-line = line_gdf.unary_union
-buffer_polygon = line.buffer(buffer_width)
-
-# Create points along the line at equal intervals of its total length
-num_points = int(line.length / distance_between_points) + 1
-points_along_line = [line.interpolate(float(n)/num_points, normalized=True) for n in range(num_points)]
-
-# Create perpendicular cutting lines
-cutting_lines = [create_perpendicular_line(line, point, buffer_width * 2) for point in points_along_line]
-
-# Use the cutting lines to split the buffer polygon
-split_polygons = [buffer_polygon]
-for cutting_line in cutting_lines:
-    new_split_polygons = []
-    for poly in split_polygons:
-        # Perform the split operation
-        split_result = split(poly, cutting_line)
-        # Check if the split result is not empty and is a GeometryCollection
-        if split_result.is_empty:
-            continue
-        if "GeometryCollection" in split_result.geom_type:
-            # Iterate over each geometry in the GeometryCollection
-            for geom in split_result.geoms:
-                if isinstance(geom, Polygon):  
-                    new_split_polygons.append(geom)
+def split_buffer_into_tiles(line, buffer_width, distance_between_points):
+    # Buffer the line to create the area polygon
+    buffer_polygon = line.buffer(buffer_width)
+
+    # Create points along the line at equal intervals of its total length
+    num_points = int(line.length / distance_between_points) + 1
+    points_along_line = [line.interpolate(float(n)/num_points, normalized=True) for n in range(num_points)]
+
+    # Create perpendicular cutting lines
+    cutting_lines = [create_perpendicular_line(line, point, buffer_width * 2) for point in points_along_line]
+
+    # Use the cutting lines to split the buffer polygon
+    split_polygons = [buffer_polygon]
+    for cutting_line in cutting_lines:
+        new_split_polygons = []
+        for poly in split_polygons:
+            # Perform the split operation
+            split_result = split(poly, cutting_line)
+            # Check if the split result is not empty and is a GeometryCollection
+            if split_result.is_empty:
+                continue
+            if "GeometryCollection" in split_result.geom_type:
+                # Iterate over each geometry in the GeometryCollection
+                for geom in split_result.geoms:
+                    if isinstance(geom, Polygon):
+                        new_split_polygons.append(geom)
+            else:
+                # If split_result is not a GeometryCollection (it's a single geometry), handle it directly
+                if isinstance(split_result, Polygon):
+                    new_split_polygons.append(split_result)
+
+        split_polygons = new_split_polygons
+
+    # Filter out small erroneous pieces
+    return [poly for poly in split_polygons if poly.area > buffer_width * distance_between_points / 2]
+
+
+def get_line_parts(geometry):
+    # Joins touching parts of a MultiLineString, so tiles continue across part boundaries where possible
+    if isinstance(geometry, MultiLineString):
+        geometry = shapely.line_merge(geometry)
+    if isinstance(geometry, MultiLineString):
+        return [part for part in geometry.geoms if part.length > 0]
+    return [geometry]
+
+
+def get_fixed_stations(length, distance_between_points):
+    # Same spacing as the 'split' engine: equal tiles of approximately "distance_between_points"
+    num_tiles = int(length / distance_between_points) + 1
+    return np.linspace(0, length, num_tiles + 1)
+
+
+def get_station_cuts(coords, cumulative_lengths, stations, buffer_width):
+    # One cutting line per station, shared by the two tiles that meet there. On a segment it is perpendicular to the
+    # segment, on a bend vertex it follows the bisector of the bend, so the tiles on both sides are cut along it.
+    directions = np.diff(coords, axis=0)
+    directions /= np.hypot(*directions.T)[:, None]
+    segment_indices = np.clip(np.searchsorted(cumulative_lengths, stations, side='right') - 1, 0, len(directions) - 1)
+    fractions = (stations - cumulative_lengths[segment_indices]) / (cumulative_lengths[segment_indices + 1] - cumulative_lengths[segment_indices])
+    points = coords[segment_indices] + fractions[:, None] * (coords[segment_indices + 1] - coords[segment_indices])
+    tangents = directions[segment_indices]
+    half_lengths = np.full(len(stations), buffer_width * 1.01)
+
+    nearest_vertices = np.clip(np.searchsorted(cumulative_lengths, stations), 1, len(cumulative_lengths) - 1)
+    nearest_vertices -= np.abs(cumulative_lengths[nearest_vertices - 1] - stations) < np.abs(cumulative_lengths[nearest_vertices] - stations)
+    on_vertex = ((np.abs(cumulative_lengths[nearest_vertices] - stations) < 1e-9 * cumulative_lengths[-1])
+                 & (nearest_vertices > 0) & (nearest_vertices < len(directions)))
+    if on_vertex.any():
+        incoming = directions[nearest_vertices[on_vertex] - 1]
+        outgoing = directions[nearest_vertices[on_vertex]]
+        bisectors = incoming + outgoing
+        bisector_lengths = np.hypot(*bisectors.T)
+        # A line that turns straight back has no bisector, the incoming segment is used instead
+        turned_back = bisector_lengths < 1e-9
+        bisectors[turned_back] = incoming[turned_back]
+        bisector_lengths[turned_back] = 1
+        tangents[on_vertex] = bisectors / bisector_lengths[:, None]
+        points[on_vertex] = coords[nearest_vertices[on_vertex]]
+        # The buffer edge on the inside of the bend is further away along the bisector: buffer / cos(half the turn)
+        half_angle_cosines = np.einsum('ni,ni->n', tangents[on_vertex], incoming)
+        half_lengths[on_vertex] /= np.maximum(half_angle_cosines, 0.25)
+    return points, tangents, half_lengths
+
+
+def locate_points(coords, cumulative_lengths, points):
+    # Distance along the line of the nearest line position of every point, the nearest segments come from a search
+    # tree as projecting onto the whole line point by point gets slow on long routes
+    segments = shapely.linestrings(np.stack([coords[:-1], coords[1:]], axis=1))
+    point_indices, segment_indices = shapely.STRtree(segments).query_nearest(points)
+    first = np.unique(point_indices, return_index=True)[1]
+    segment_indices = segment_indices[first]
+    offsets = shapely.line_locate_point(segments[segment_indices], points)
+    return cumulative_lengths[segment_indices] + offsets
+
+
+def build_tiles_between_stations(line, stations, buffer_width):
+    coords = np.asarray(line.coords)[:, :2]
+    segment_lengths = np.hypot(*np.diff(coords, axis=0).T)
+    # Zero length segments have no direction, drop their duplicate vertices
+    keep = np.concatenate([[True], segment_lengths > 0])
+    coords = coords[keep]
+    segment_lengths = segment_lengths[segment_lengths > 0]
+    cumulative_lengths = np.concatenate([[0], np.cumsum(segment_lengths)])
+    stations = np.asarray(stations, dtype=np.float64)
+    tile_count = len(stations) - 1
+
+    # The whole buffer, with round ends for the first and last tile, is split along the cutting lines of the inner
+    # stations in one go: the noded outline and cutting lines are polygonized into faces, cut line ends outside the
+    # buffer are left dangling and dropped
+    buffer_polygon = line.buffer(buffer_width)
+    points, tangents, half_lengths = get_station_cuts(coords, cumulative_lengths, stations, buffer_width)
+    normals = np.column_stack([-tangents[:, 1], tangents[:, 0]]) * half_lengths[:, None]
+    cut_lines = shapely.linestrings(np.stack([points - normals, points + normals], axis=1)[1:-1])
+    linework = shapely.union_all(np.concatenate([[shapely.boundary(buffer_polygon)], cut_lines]))
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(linework)))
+    face_points = shapely.point_on_surface(faces)
+    shapely.prepare(buffer_polygon)
+    inside = shapely.contains(buffer_polygon, face_points)
+    faces = faces[inside]
+    face_points = face_points[inside]
+
+    # Every face belongs to the tile its position along the line falls in. Faces on the outside of a bend vertex are
+    # all at the vertex's position, their side of the station's cutting line decides between the two tiles.
+    face_stations = locate_points(coords, cumulative_lengths, face_points)
+    face_points = shapely.get_coordinates(face_points)
+    face_tiles = np.clip(np.searchsorted(stations, face_stations, side='right') - 1, 0, tile_count - 1)
+    tolerance = 1e-6 * cumulative_lengths[-1]
+    at_start = (face_tiles > 0) & (np.abs(face_stations - stations[face_tiles]) < tolerance)
+    behind = at_start & (np.einsum('ni,ni->n', face_points - points[face_tiles], tangents[face_tiles]) < 0)
+    face_tiles[behind] -= 1
+    at_end = (face_tiles < tile_count - 1) & (np.abs(face_stations - stations[face_tiles + 1]) < tolerance)
+    ahead = at_end & (np.einsum('ni,ni->n', face_points - points[face_tiles + 1], tangents[face_tiles + 1]) > 0)
+    face_tiles[ahead] += 1
+
+    tiles = [shapely.union_all(faces[face_tiles == tile]) for tile in range(tile_count)]
+    return [tile for tile in tiles if not tile.is_empty]
+
+
+def sample_point_xy(laz_path, point_count):
+    # Reads a few evenly spaced batches instead of the whole file, every sampled point stands for
+    # point_count / sample size points
+    batch_size = max(density_sample_size // density_sample_batches, 1)
+    starts = np.linspace(0, max(point_count - batch_size, 0), density_sample_batches).astype(np.int64)
+    xs, ys = [], []
+    with open_las(laz_path) as reader:
+        for start in np.unique(starts):
+            reader.seek(int(start))
+            points = reader.read_points(batch_size)
+            xs.append(np.asarray(points.x))
+            ys.append(np.asarray(points.y))
+    return np.concatenate(xs), np.concatenate(ys)
+
+
+def build_density_grid(corridor):
+    extent_index = update_extent_index(laz_dir, os.path.join(laz_dir, 'laz_extent_index.json'))
+    extents = {laz_file: extent for laz_file, extent in extent_index.items()
+               if extent["point_count"] > 0 and get_las_bbox(extent).intersects(corridor)}
+
+    min_x, min_y, max_x, max_y = corridor.bounds
+    columns = int(np.ceil((max_x - min_x) / density_cell_size)) + 1
+    rows = int(np.ceil((max_y - min_y) / density_cell_size)) + 1
+    point_counts = np.zeros((rows, columns))
+
+    for laz_file, extent in extents.items():
+        logging.info(f"Sampling point density of {laz_file}")
+        x, y = sample_point_xy(os.path.join(laz_dir, laz_file), extent["point_count"])
+        column = np.floor((x - min_x) / density_cell_size).astype(np.int64)
+        row = np.floor((y - min_y) / density_cell_size).astype(np.int64)
+        inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+        np.add.at(point_counts, (row[inside], column[inside]), extent["point_count"] / len(x))
+
+    # Points per square meter
+    return point_counts / density_cell_size ** 2, min_x, min_y
+
+
+def get_point_profile(line, density_grid, buffer_width):
+    # Cumulative estimated point count inside the corridor along the line, every "density_step" meters. The density
+    # of every step is summed across the corridor from samples every "density_step" meters along the line's normal.
+    grid, min_x, min_y = density_grid
+    distances = np.linspace(0, line.length, max(int(np.ceil(line.length / density_step)), 1) + 1)
+    middles = (distances[:-1] + distances[1:]) / 2
+
+    coords = np.asarray(line.coords)[:, :2]
+    directions = np.diff(coords, axis=0)
+    segment_lengths = np.hypot(*directions.T)
+    directions = directions[segment_lengths > 0] / segment_lengths[segment_lengths > 0, None]
+    coords = coords[np.concatenate([[True], segment_lengths > 0])]
+    cumulative_lengths = np.concatenate([[0], np.cumsum(segment_lengths[segment_lengths > 0])])
+    segment_indices = np.clip(np.searchsorted(cumulative_lengths, middles, side='right') - 1, 0, len(directions) - 1)
+    midpoints = coords[segment_indices] + (middles - cumulative_lengths[segment_indices])[:, None] * directions[segment_indices]
+    normals = np.column_stack([-directions[segment_indices, 1], directions[segment_indices, 0]])
+
+    offset_count = max(int(np.ceil(2 * buffer_width / density_step)), 1)
+    offsets = (np.arange(offset_count) + 0.5) * 2 * buffer_width / offset_count - buffer_width
+    samples = midpoints[:, None, :] + offsets[None, :, None] * normals[:, None, :]
+    column = np.clip(np.floor((samples[..., 0] - min_x) / density_cell_size).astype(np.int64), 0, grid.shape[1] - 1)
+    row = np.clip(np.floor((samples[..., 1] - min_y) / density_cell_size).astype(np.int64), 0, grid.shape[0] - 1)
+    step_points = grid[row, column].sum(axis=1) * (2 * buffer_width / offset_count) * np.diff(distances)
+    return distances, np.concatenate([[0], np.cumsum(step_points)])
+
+
+def get_density_stations(line, density_grid, buffer_width):
+    distances, cumulative_points = get_point_profile(line, density_grid, buffer_width)
+    length = line.length
+    stations = [0.0]
+    while True:
+        target = np.interp(stations[-1], distances, cumulative_points) + target_points_per_tile
+        station = np.interp(target, cumulative_points, distances) if target < cumulative_points[-1] else length
+        station = min(max(station, stations[-1] + min_tile_length), stations[-1] + max_tile_length)
+        if station > length - min_tile_length:
+            # The rest is shorter than a maximum and a minimum length tile together. If it is too long for one tile it is
+            # split into two equal tiles, unless they would be shorter than the minimum (with "max_tile_length" below
+            # twice "min_tile_length"), then the rest stays one tile longer than the maximum.
+            if length - stations[-1] > max_tile_length and (length - stations[-1]) / 2 >= min_tile_length:
+                stations.append((stations[-1] + length) / 2)
+            break
+        stations.append(float(station))
+    stations.append(length)
+    return np.array(stations)
+
+
+def generate_linear_tiles(geometry, buffer_width, distance_between_points):
+    parts = get_line_parts(geometry)
+    if tile_sizing == 'density':
+        density_grid = build_density_grid(shapely.buffer(shapely.multilinestrings(parts), buffer_width))
+
+    tiles = []
+    for part in parts:
+        if tile_sizing == 'density':
+            stations = get_density_stations(part, density_grid, buffer_width)
         else:
-            # If split_result is not a GeometryCollection (it's a single geometry), handle it directly
-            if isinstance(split_result, Polygon):
-                new_split_polygons.append(split_result)
+            stations = get_fixed_stations(part.length, distance_between_points)
+        tiles.extend(build_tiles_between_stations(part, stations, buffer_width))
+    return tiles
 
-    split_polygons = new_split_polygons  
 
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics = FileMetrics(__file__, input_path, output_path)
+    with metrics.stage('read'):
+        line_gdf = gpd.read_file(input_path)
+        line = line_gdf.unary_union
 
-# Filter out small erroneous pieces
-split_polygons = [poly for poly in split_polygons if poly.area > buffer_width * distance_between_points / 2]
+    with metrics.stage('transform'):
+        if tiling_engine == 'split':
+            tiles = split_buffer_into_tiles(line, buffer_width, distance_between_points)
+        else:
+            tiles = generate_linear_tiles(line, buffer_width, distance_between_points)
 
-# Convert the polygons to a GeoDataFrame
-multi_gdf = gpd.GeoDataFrame({'geometry': split_polygons}, crs=line_gdf.crs)
+    # Convert the polygons to a GeoDataFrame
+    multi_gdf = gpd.GeoDataFrame({'FID': np.arange(len(tiles)), 'geometry': tiles}, crs=line_gdf.crs)
 
-# Save the result to a shapefile
-multi_gdf.to_file('tiled_multipolygons.shp')
+    # Save the result to a shapefile
+    with metrics.stage('write'):
+        multi_gdf.to_file(output_path)
+    metrics.count(tiles=len(tiles))
+    metrics.finish(engine=tiling_engine, line_length_m=line.length)
@@ -0,0 +1,61 @@
+# Shared conversion of EH2000 (normal) heights to ellipsoidal heights with a geoid model grid: h = H + N.
+# The grid is read from a GTX file, the format PROJ uses for geoid models (e.g. the Land Board's EST-GEOID2017, other
+# grid formats can be converted with "gdal_translate -of GTX"). The file is memory-mapped, so only the grid cells
+# around the converted points are read from disk, and the undulations are bilinearly interpolated for whole arrays
+# of WGS84 longitudes and latitudes.
+# GTX layout: a big-endian header of the south-west cell centre latitude and longitude, the latitude and longitude
+# spacing (all degrees, doubles) and the row and column counts (int32), followed by the rows of big-endian float32
+# values from south to north.
+
+import functools
+import struct
+import numpy as np
+
+GTX_HEADER_SIZE = 40
+GTX_NODATA = -88.8888
+
+
+@functools.lru_cache(maxsize=None)
+def load_geoid_grid(path):
+    # Opened once per process and reused for every chunk and file
+    with open(path, 'rb') as f:
+        lat0, lon0, dlat, dlon, rows, cols = struct.unpack('>4d2i', f.read(GTX_HEADER_SIZE))
+    return {
+        "origin": (lon0, lat0),
+        "spacing": (dlon, dlat),
+        "values": np.memmap(path, dtype='>f4', mode='r', offset=GTX_HEADER_SIZE, shape=(rows, cols)),
+    }
+
+
+def interpolate_undulation(grid, lon, lat):
+    # Returns NaN outside the grid and next to cells without a value
+    values = grid["values"]
+    rows, cols = values.shape
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon_offset = lon - grid["origin"][0]
+    if grid["origin"][0] + grid["spacing"][0] * (cols - 1) > 180:
+        # Grids covering the whole world may use longitudes from 0 to 360
+        lon_offset = np.mod(lon_offset, 360.0)
+    col = lon_offset / grid["spacing"][0]
+    row = (lat - grid["origin"][1]) / grid["spacing"][1]
+    inside = (col >= 0) & (col <= cols - 1) & (row >= 0) & (row <= rows - 1)
+    col0 = np.clip(np.floor(col).astype(np.int64), 0, max(cols - 2, 0))
+    row0 = np.clip(np.floor(row).astype(np.int64), 0, max(rows - 2, 0))
+    tx = col - col0
+    ty = row - row0
+
+    corners = [values[row0, col0], values[row0, col0 + 1], values[row0 + 1, col0], values[row0 + 1, col0 + 1]]
+    corners = [corner.astype(np.float64) for corner in corners]
+    for corner in corners:
+        inside &= np.abs(corner - GTX_NODATA) > 1e-3
+    bottom = corners[0] * (1 - tx) + corners[1] * tx
+    top = corners[2] * (1 - tx) + corners[3] * tx
+    return np.where(inside, bottom * (1 - ty) + top * ty, np.nan)
+
+
+def get_ellipsoidal_heights(grid, lon, lat, heights):
+    undulation = interpolate_undulation(grid, lon, lat)
+    if np.isnan(undulation).any():
+        raise ValueError(f"{np.count_nonzero(np.isnan(undulation))} points are outside the geoid model")
+    return np.asarray(heights, dtype=np.float64) + undulation
@@ -0,0 +1,112 @@
+# Shared incremental processing for the scripts that process a directory of input files.
+# The manifest in the output directory records, for every processed input, its fingerprint (size and modification
+# time), a hash of the script settings that affect the output and the fingerprints of the outputs written from it.
+# With "incremental" enabled in a script, an input is only processed when it is new or changed, when the settings
+# changed or when one of its outputs is missing or was modified since. Inputs modified less than "settle_seconds" ago
+# are left for a later run, they may still be being copied.
+# With "watch" enabled a script keeps running and processes new inputs every "watch_interval" seconds.
+# The manifest is a JSON lines file with a line appended for every processed input, so an interrupted run loses
+# nothing that was already finished.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+MANIFEST_FILENAME = '.processing_manifest.jsonl'
+settle_seconds = 10
+
+
+def get_fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_settings_hash(script, settings):
+    text = json.dumps({'script': script, 'settings': settings}, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ProcessingManifest:
+    # Does nothing when not enabled: every input needs processing and nothing is recorded
+
+    def __init__(self, output_dir, script, settings, enabled=True):
+        self.enabled = enabled
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.settings_hash = get_settings_hash(os.path.splitext(os.path.basename(script))[0], settings)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if enabled:
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        line_count = 0
+        with open(self.path) as f:
+            for line in f:
+                line_count += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+                self.entries[entry['input_path']] = entry
+
+        # Later lines replace earlier ones, drop the replaced lines once they make up most of the file
+        if line_count > 2 * len(self.entries) + 100:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(temp_path, self.path)
+
+    def needs_processing(self, input_path):
+        if not self.enabled:
+            return True
+        input_path = os.path.abspath(input_path)
+        fingerprint = get_fingerprint(input_path)
+        if time.time() - fingerprint[1] / 1e9 < settle_seconds:
+            print(f"{os.path.basename(input_path)} was modified in the last {settle_seconds} seconds, leaving it for later.")
+            return False
+
+        entry = self.entries.get(input_path)
+        if entry is None or entry['input'] != fingerprint or entry['settings'] != self.settings_hash:
+            return True
+        for output_path, output_fingerprint in entry['outputs'].items():
+            if not os.path.exists(output_path) or get_fingerprint(output_path) != output_fingerprint:
+                return True
+        print(f"Skipping {os.path.basename(input_path)}, already processed with the same settings.")
+        return False
+
+    def record(self, input_path, output_paths):
+        # Outputs that were not written, e.g. when a filter kept no points, are left out
+        if not self.enabled:
+            return
+        input_path = os.path.abspath(input_path)
+        entry = {
+            'input_path': input_path,
+            'input': get_fingerprint(input_path),
+            'settings': self.settings_hash,
+            'outputs': {
+                os.path.abspath(output_path): get_fingerprint(output_path)
+                for output_path in output_paths if os.path.exists(output_path)
+            },
+        }
+        with self.lock:
+            self.entries[input_path] = entry
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+def watch(run, watch_interval):
+    # Runs "run" again every "watch_interval" seconds. A failed pass is reported and retried on the next one,
+    # the inputs it did finish are already in the manifest.
+    while True:
+        try:
+            run()
+        except Exception as e:
+            print(f"Processing failed: {e}")
+        print(f"Waiting {watch_interval} seconds for new inputs...")
+        time.sleep(watch_interval)
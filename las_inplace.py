@@ -0,0 +1,219 @@
+# Shared in-place editing of the coordinates of uncompressed LAS files, used instead of writing a corrected copy.
+# The point records are memory-mapped and the X/Y/Z integers rewritten chunk by chunk inside the mapped file, the
+# header bounds are patched at the end. Coordinate changes are rounded to whole scale steps, so they can be undone
+# exactly from the unchanged dimensions (e.g. gps_time).
+# A journal next to the file (<file>.inplace.json) records the settings, the number of finished chunks and the
+# original header values. Before a chunk is changed its original coordinates are saved in <file>.inplace_undo.npz.
+# After an interruption the file can be resumed (the unfinished chunk is restored and processing continues) or rolled
+# back to its original coordinates. Both files are removed once the file is finished.
+
+import json
+import os
+import struct
+import laspy
+import numpy as np
+
+from incremental_processing import get_settings_hash
+
+JOURNAL_SUFFIX = '.inplace.json'
+UNDO_SUFFIX = '.inplace_undo.npz'
+
+# Byte position of the x/y/z offsets in the LAS header, directly followed by max x, min x, max y, min y, max z, min z
+HEADER_OFFSETS_POSITION = 155
+INT32_RANGE = (np.iinfo(np.int32).min, np.iinfo(np.int32).max)
+
+
+def can_edit_in_place(path):
+    if not path.lower().endswith('.las'):
+        return False
+    with laspy.open(path) as reader:
+        return not reader.header.are_points_compressed
+
+
+def has_journal(path):
+    return os.path.exists(path + JOURNAL_SUFFIX)
+
+
+def save_journal(path, state):
+    journal_path = path + JOURNAL_SUFFIX
+    temp_path = journal_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, journal_path)
+
+
+def load_journal(path):
+    with open(path + JOURNAL_SUFFIX) as f:
+        return json.load(f)
+
+
+def read_header_values(path):
+    with open(path, 'rb') as f:
+        f.seek(HEADER_OFFSETS_POSITION)
+        return f.read(72).hex()
+
+
+def write_header_values(path, values):
+    with open(path, 'r+b') as f:
+        f.seek(HEADER_OFFSETS_POSITION)
+        f.write(bytes.fromhex(values))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def pack_header_values(offsets, mins, maxs):
+    return struct.pack('<9d', *offsets, maxs[0], mins[0], maxs[1], mins[1], maxs[2], mins[2]).hex()
+
+
+def map_points(path, header):
+    return np.memmap(path, dtype=header.point_format.dtype(), mode='r+',
+                     offset=header.offset_to_point_data, shape=(header.point_count,))
+
+
+def save_undo(path, points, start, stop, committed):
+    # "committed" tells whether the change of the chunk was finished: only an undo file written while the journal
+    # still has the same number of finished chunks belongs to an unfinished change
+    undo_path = path + UNDO_SUFFIX
+    temp_path = undo_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, start=start, committed=committed,
+                 xyz=np.column_stack([points['X'][start:stop], points['Y'][start:stop], points['Z'][start:stop]]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, undo_path)
+
+
+def restore_undo(path, points, state):
+    undo_path = path + UNDO_SUFFIX
+    if not os.path.exists(undo_path):
+        return
+    with np.load(undo_path) as undo:
+        if int(undo['committed']) != state['committed']:
+            return
+        start = int(undo['start'])
+        xyz = undo['xyz']
+    print(f"Restoring the unfinished chunk {start // state['chunk_size']} of {os.path.basename(path)}.")
+    stop = start + len(xyz)
+    points['X'][start:stop] = xyz[:, 0]
+    points['Y'][start:stop] = xyz[:, 1]
+    points['Z'][start:stop] = xyz[:, 2]
+    points.flush()
+
+
+def apply_chunk(points, start, stop, deltas):
+    xyz = np.column_stack([points['X'][start:stop], points['Y'][start:stop], points['Z'][start:stop]]).astype(np.int64)
+    xyz += deltas
+    if xyz.size and (xyz.min() < INT32_RANGE[0] or xyz.max() > INT32_RANGE[1]):
+        raise ValueError("Shifted coordinates do not fit the scale and offset of the file")
+    points['X'][start:stop] = xyz[:, 0]
+    points['Y'][start:stop] = xyz[:, 1]
+    points['Z'][start:stop] = xyz[:, 2]
+    points.flush()
+    return xyz
+
+
+def get_step_deltas(shifts, scales):
+    # Shifts in coordinate units as whole scale steps
+    return np.round(np.asarray(shifts, dtype=np.float64) / scales).astype(np.int64)
+
+
+def finish(path, state):
+    write_header_values(path, state['target_header'])
+    if os.path.exists(path + UNDO_SUFFIX):
+        os.remove(path + UNDO_SUFFIX)
+    os.remove(path + JOURNAL_SUFFIX)
+
+
+def edit_in_place(path, script, settings, get_deltas, chunk_size, metrics, header_shifts=None):
+    # "get_deltas" returns the (points, 3) integer steps to add to X/Y/Z of a chunk of the mapped point records.
+    # With "header_shifts" the shift is applied to the header offsets only, no points are changed.
+    with laspy.open(path) as reader:
+        header = reader.header
+    settings_hash = get_settings_hash(os.path.splitext(os.path.basename(script))[0], settings)
+
+    if has_journal(path):
+        state = load_journal(path)
+        if state['settings'] != settings_hash:
+            raise ValueError(f"{path} was interrupted while being processed with other settings, roll it back first")
+        print(f"Resuming {os.path.basename(path)} from chunk {state['committed']}.")
+    else:
+        state = {
+            'settings': settings_hash,
+            'mode': 'header' if header_shifts is not None else 'points',
+            'chunk_size': chunk_size,
+            'committed': 0,
+            'mins': None,
+            'maxs': None,
+            'original_header': read_header_values(path),
+        }
+        if header_shifts is not None:
+            shifts = np.asarray(header_shifts, dtype=np.float64)
+            state['target_header'] = pack_header_values(header.offsets + shifts, header.mins + shifts, header.maxs + shifts)
+        save_journal(path, state)
+
+    if state['mode'] == 'points':
+        points = map_points(path, header)
+        restore_undo(path, points, state)
+        chunk_size = state['chunk_size']
+        for start in range(state['committed'] * chunk_size, header.point_count, chunk_size):
+            stop = min(start + chunk_size, header.point_count)
+            with metrics.stage('transform'):
+                deltas = get_deltas(points[start:stop])
+            with metrics.stage('journal'):
+                save_undo(path, points, start, stop, state['committed'])
+            with metrics.stage('write'):
+                xyz = apply_chunk(points, start, stop, deltas)
+            if len(xyz):
+                mins = xyz.min(axis=0)
+                maxs = xyz.max(axis=0)
+                if state['mins'] is not None:
+                    mins = np.minimum(mins, state['mins'])
+                    maxs = np.maximum(maxs, state['maxs'])
+                state['mins'] = mins.tolist()
+                state['maxs'] = maxs.tolist()
+            state['committed'] += 1
+            with metrics.stage('journal'):
+                save_journal(path, state)
+            metrics.count(points=stop - start)
+        del points
+
+        if 'target_header' not in state:
+            if state['mins'] is None:
+                mins, maxs = header.mins, header.maxs
+            else:
+                mins = np.asarray(state['mins']) * header.scales + header.offsets
+                maxs = np.asarray(state['maxs']) * header.scales + header.offsets
+            state['target_header'] = pack_header_values(header.offsets, mins, maxs)
+            save_journal(path, state)
+    else:
+        metrics.count(points=header.point_count)
+
+    with metrics.stage('write'):
+        finish(path, state)
+
+
+def rollback_in_place(path, get_deltas):
+    # Undoes the finished chunks in reverse order, using the journal the same way as processing does
+    state = load_journal(path)
+    write_header_values(path, state['original_header'])
+    if state['mode'] == 'points':
+        with laspy.open(path) as reader:
+            header = reader.header
+        points = map_points(path, header)
+        restore_undo(path, points, state)
+        chunk_size = state['chunk_size']
+        while state['committed'] > 0:
+            chunk = state['committed'] - 1
+            start = chunk * chunk_size
+            stop = min(start + chunk_size, header.point_count)
+            save_undo(path, points, start, stop, state['committed'])
+            apply_chunk(points, start, stop, -get_deltas(points[start:stop]))
+            state['committed'] = chunk
+            save_journal(path, state)
+        del points
+    if os.path.exists(path + UNDO_SUFFIX):
+        os.remove(path + UNDO_SUFFIX)
+    os.remove(path + JOURNAL_SUFFIX)
+    print(f"Rolled back {os.path.basename(path)}.")
@@ -0,0 +1,62 @@
+# Shared index of the extents and point counts of the LAZ files in a folder, read from the LAS headers only and cached
+# in a sidecar JSON file next to the point clouds. Only files that were added or changed (size or modification time)
+# since the last run are re-read. Needs laspy only, so scripts that only look at the extents work without PDAL.
+
+import json
+import logging
+import os
+from shapely.geometry import box
+
+from laz_io import open_las
+
+
+def read_las_extent(las_path):
+    # Opening the file only parses the header, no points are decompressed
+    with open_las(las_path) as reader:
+        header = reader.header
+        min_pt = header.mins
+        max_pt = header.maxs
+        point_count = header.point_count
+    stat = os.stat(las_path)
+    return {
+        "mins": [float(v) for v in min_pt],
+        "maxs": [float(v) for v in max_pt],
+        "point_count": int(point_count),
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+    }
+
+
+def update_extent_index(laz_dir, index_path):
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    updated_index = {}
+    changed = False
+    for laz_file in sorted(os.listdir(laz_dir)):
+        if not laz_file.endswith('.laz'):
+            continue
+        laz_path = os.path.join(laz_dir, laz_file)
+        stat = os.stat(laz_path)
+        entry = index.get(laz_file)
+        if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            logging.info(f"Reading header of {laz_file}")
+            entry = read_las_extent(laz_path)
+            changed = True
+        updated_index[laz_file] = entry
+
+    if changed or updated_index.keys() != index.keys():
+        temp_path = index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(updated_index, f, indent=2)
+        os.replace(temp_path, index_path)
+
+    return updated_index
+
+
+def get_las_bbox(extent):
+    min_pt = extent["mins"]
+    max_pt = extent["maxs"]
+    return box(min_pt[0], min_pt[1], max_pt[0], max_pt[1])
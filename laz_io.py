@@ -0,0 +1,93 @@
+# Shared LAZ reading and writing for the laspy based scripts.
+# "laz_backend" (or the LAZ_BACKEND environment variable) selects laspy's LAZ codec:
+#   'lazrs_parallel' - compresses and decompresses the chunks of a LAZ file on all cores ("pip install lazrs"),
+#                      the number of threads can be limited with the RAYON_NUM_THREADS environment variable
+#   'lazrs'          - single-threaded lazrs
+#   'laszip'         - single-threaded LASzip ("pip install laspy[laszip]")
+#   'auto'           - 'lazrs_parallel' when installed, otherwise whatever laspy finds
+# The parallel codec works on whole LAZ chunks (usually 50 000 points), so it needs reads and writes of many chunks
+# at a time, like the "chunk_size" of 1 000 000 points the scripts use.
+# COPC (Cloud-Optimized Point Cloud) files are written with PDAL's writers.copc, laspy can only read them.
+
+import json
+import os
+import laspy
+
+try:
+    import pdal
+except ImportError:
+    pdal = None
+
+laz_backend = os.environ.get('LAZ_BACKEND', 'auto')
+
+LAZ_BACKENDS = {
+    'lazrs_parallel': laspy.LazBackend.LazrsParallel,
+    'lazrs': laspy.LazBackend.Lazrs,
+    'laszip': laspy.LazBackend.Laszip,
+}
+COPC_EXTENSION = '.copc.laz'
+
+
+def get_laz_backend():
+    if laz_backend == 'auto':
+        if laspy.LazBackend.LazrsParallel.is_available():
+            return laspy.LazBackend.LazrsParallel
+        # Let laspy pick from the installed backends
+        return None
+    if laz_backend not in LAZ_BACKENDS:
+        raise ValueError(f"Unknown LAZ backend '{laz_backend}', expected 'auto' or one of {sorted(LAZ_BACKENDS)}")
+    backend = LAZ_BACKENDS[laz_backend]
+    if not backend.is_available():
+        raise ImportError(f"The '{laz_backend}' LAZ backend is not installed")
+    return backend
+
+
+def open_las(path, mode='r', header=None):
+    if mode == 'r':
+        return laspy.open(path, laz_backend=get_laz_backend())
+    return laspy.open(path, mode=mode, header=header, laz_backend=get_laz_backend())
+
+
+def read_las(path):
+    return laspy.read(path, laz_backend=get_laz_backend())
+
+
+def write_las(las, path):
+    las.write(path, laz_backend=get_laz_backend())
+
+
+def get_copc_filename(path):
+    # tile.laz -> tile.copc.laz
+    if path.endswith(COPC_EXTENSION):
+        return path
+    return os.path.splitext(path)[0] + COPC_EXTENSION
+
+
+def require_pdal_for_copc():
+    if pdal is None:
+        raise ImportError("PDAL is needed for COPC output: 'conda install -c conda-forge python-pdal'")
+
+
+def create_copc_writer(filename, scales=None, offsets=None):
+    # PDAL pipeline stage writing a COPC file, with the same precision options as writers.las
+    writer = {"type": "writers.copc", "filename": filename}
+    if scales is not None:
+        writer.update({"scale_x": scales[0], "scale_y": scales[1], "scale_z": scales[2]})
+    if offsets is not None:
+        writer.update({"offset_x": offsets[0], "offset_y": offsets[1], "offset_z": offsets[2]})
+    return writer
+
+
+def convert_to_copc(input_path, output_path, remove_input=True):
+    # Rewrites a LAS/LAZ file as COPC, keeping its scales, offsets, CRS and extra dimensions
+    require_pdal_for_copc()
+    pipeline = pdal.Pipeline(json.dumps({
+        "pipeline": [
+            {"type": "readers.las", "filename": input_path},
+            {**create_copc_writer(output_path), "forward": "all", "extra_dims": "all"},
+        ]
+    }))
+    point_count = pipeline.execute()
+    if remove_input:
+        os.remove(input_path)
+    return point_count
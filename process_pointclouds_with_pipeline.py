@@ -0,0 +1,228 @@
+# Runs several point cloud operations on all LAS/LAZ files in a directory in a single read/write pass.
+# The stages are defined in a JSON config file, see pointcloud_pipeline.json. Available stage types:
+#   "filter"                    - keeps points matching "expression" (see filter_pointclouds_by_dimension.py)
+#   "interpolated_corrections"  - applies gps_time based corrections from "corrections_file" or inline "corrections"
+#                                 with "interpolation" (see apply_interpolated_corrections_to_pointclouds.py)
+#   "xyz_shift"                 - adds "x_shift", "y_shift" and "z_shift" (see apply_xyz_shift_to_pointclouds.py)
+#   "reprojection"              - transforms from "src_epsg_code" to "tgt_epsg_code" (see convert_pointcloud_to_wgs.py)
+# The stages run in the order they are listed. Each chunk of points is read and decompressed once, passed through all
+# stages in memory with full double precision coordinates and compressed and written once.
+# Per-file timings of reading, every stage and writing are written as JSON lines when PROCESSING_METRICS_PATH is set,
+# see processing_metrics.py.
+# With "incremental": true in the config, only new or changed files and files processed with other stages (or a changed
+# corrections file) are processed. "watch": true keeps processing new files every "watch_interval" seconds and rereads
+# the config for every pass, see incremental_processing.py.
+# Usage: python process_pointclouds_with_pipeline.py [config.json]
+
+import json
+import laspy
+import numpy as np
+import os
+import sys
+
+from filter_pointclouds_by_dimension import compile_filter_expression
+from apply_interpolated_corrections_to_pointclouds import (
+    load_corrections, build_correction_model, find_intervals, find_intervals_sorted, interpolate_shifts
+)
+from convert_pointcloud_to_wgs import get_transformer, create_wgs84_header
+from processing_metrics import FileMetrics
+from laz_io import open_las
+from incremental_processing import ProcessingManifest, get_fingerprint, watch as watch_inputs
+
+config_path = 'pointcloud_pipeline.json'
+
+
+class ChunkView:
+    # Lets filter expressions see the coordinates as changed by the earlier stages
+
+    def __init__(self, points, xyz):
+        self.points = points
+        self.xyz = xyz
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getattr__(self, name):
+        if name in ('x', 'y', 'z'):
+            return self.xyz[:, 'xyz'.index(name)]
+        return getattr(self.points, name)
+
+
+def build_filter_stage(stage_config):
+    evaluate, required_dimensions = compile_filter_expression(stage_config['expression'])
+
+    def process(points, xyz, state):
+        mask = evaluate(ChunkView(points, xyz))
+        return points[mask], xyz[mask]
+
+    return process, None, required_dimensions - {'x', 'y', 'z'}
+
+
+def build_corrections_stage(stage_config):
+    if 'corrections_file' in stage_config:
+        corrections = load_corrections(stage_config['corrections_file'])
+    else:
+        corrections = stage_config['corrections']
+    model = build_correction_model(corrections, stage_config.get('interpolation', 'linear'))
+    breakpoints = model[0]
+
+    def process(points, xyz, state):
+        if len(points) == 0:
+            return points, xyz
+        gps_times = np.asarray(points.gps_time)
+        interval = state.get('interval', 0)
+        if gps_times[0] >= state.get('last_time', -np.inf) and np.all(gps_times[1:] >= gps_times[:-1]):
+            intervals = find_intervals_sorted(breakpoints, gps_times, interval)
+        else:
+            intervals = find_intervals(breakpoints, gps_times)
+        state['interval'] = intervals[-1]
+        state['last_time'] = gps_times[-1]
+        xyz += interpolate_shifts(model, gps_times, intervals)
+        return points, xyz
+
+    return process, None, {'gps_time'}
+
+
+def build_shift_stage(stage_config):
+    shifts = np.array([stage_config.get('x_shift', 0), stage_config.get('y_shift', 0), stage_config.get('z_shift', 0)],
+                      dtype=np.float64)
+
+    def process(points, xyz, state):
+        xyz += shifts
+        return points, xyz
+
+    return process, None, set()
+
+
+def build_reprojection_stage(stage_config):
+    src_epsg_code = stage_config.get('src_epsg_code', 'EPSG:3301')
+    tgt_epsg_code = stage_config.get('tgt_epsg_code', 'EPSG:4326')
+    transformer = get_transformer(src_epsg_code, tgt_epsg_code)
+
+    def process(points, xyz, state):
+        x, y, z = transformer.transform(xyz[:, 0], xyz[:, 1], xyz[:, 2])
+        xyz[:, 0] = x
+        xyz[:, 1] = y
+        xyz[:, 2] = z
+        return points, xyz
+
+    def update_header(header):
+        return create_wgs84_header(header, tgt_epsg_code)
+
+    return process, update_header, set()
+
+
+STAGE_BUILDERS = {
+    'filter': build_filter_stage,
+    'interpolated_corrections': build_corrections_stage,
+    'xyz_shift': build_shift_stage,
+    'reprojection': build_reprojection_stage,
+}
+
+
+def build_stages(stage_configs):
+    stages = []
+    for stage_config in stage_configs:
+        stage_type = stage_config['type']
+        if stage_type not in STAGE_BUILDERS:
+            raise ValueError(f"Unknown stage type '{stage_type}', expected one of {sorted(STAGE_BUILDERS)}")
+        stages.append(STAGE_BUILDERS[stage_type](stage_config))
+    return stages
+
+
+def process_file(input_file, output_file, stages, stage_names, chunk_size, metrics):
+    kept_count = 0
+    writer = None
+    states = [{} for _ in stages]
+    with open_las(input_file) as reader:
+        header = reader.header
+        for process, update_header, required_dimensions in stages:
+            if update_header is not None:
+                header = update_header(header)
+
+        try:
+            for points in metrics.timed(reader.chunk_iterator(chunk_size)):
+                metrics.count(points=len(points))
+                xyz = np.column_stack([points.x, points.y, points.z])
+                for (process, update_header, required_dimensions), state, stage_name in zip(stages, states, stage_names):
+                    with metrics.stage(stage_name):
+                        points, xyz = process(points, xyz, state)
+                if len(points) == 0:
+                    continue
+
+                with metrics.stage('write'):
+                    output_points = laspy.ScaleAwarePointRecord(points.array, points.point_format, header.scales, header.offsets)
+                    output_points.x = xyz[:, 0]
+                    output_points.y = xyz[:, 1]
+                    output_points.z = xyz[:, 2]
+
+                    if writer is None:
+                        writer = open_las(output_file, mode='w', header=header)
+                    writer.write_points(output_points)
+                kept_count += len(output_points)
+        finally:
+            if writer is not None:
+                with metrics.stage('write'):
+                    writer.close()
+    metrics.count(points_kept=kept_count)
+    return kept_count
+
+
+def run_pipeline(config):
+    input_dir = config['input_dir']
+    output_dir = config['output_dir']
+    chunk_size = config.get('chunk_size', 1_000_000)
+    stages = build_stages(config['stages'])
+    stage_names = [stage_config['type'] for stage_config in config['stages']]
+    required_dimensions = set().union(*(stage[2] for stage in stages))
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # A changed corrections file changes the output as much as changed stages
+    settings = {
+        'stages': config['stages'],
+        'files': [get_fingerprint(stage_config['corrections_file'])
+                  for stage_config in config['stages'] if 'corrections_file' in stage_config],
+    }
+    manifest = ProcessingManifest(output_dir, __file__, settings, config.get('incremental', False) or config.get('watch', False))
+
+    for filename in os.listdir(input_dir):
+        if filename.endswith('.las') or filename.endswith('.laz'):
+            input_file = os.path.join(input_dir, filename)
+            output_file = os.path.join(output_dir, filename)
+            if not manifest.needs_processing(input_file):
+                continue
+
+            print(f"Processing {filename}...")
+
+            with laspy.open(input_file) as reader:
+                point_count = reader.header.point_count
+                missing_dimensions = required_dimensions - set(reader.header.point_format.dimension_names)
+            if missing_dimensions:
+                print(f"Dimensions {sorted(missing_dimensions)} not found in {filename}. Skipping file.")
+                continue
+
+            metrics = FileMetrics(__file__, input_file, output_file)
+            kept_count = process_file(input_file, output_file, stages, stage_names, chunk_size, metrics)
+            metrics.finish()
+            manifest.record(input_file, [output_file] if kept_count > 0 else [])
+            if kept_count > 0:
+                print(f"{filename}: wrote {kept_count} of {point_count} points to {output_file}.")
+            else:
+                print(f"{filename}: no points left after the pipeline. Skipping file.")
+
+
+def load_config(config_path):
+    with open(config_path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        config_path = sys.argv[1]
+    config = load_config(config_path)
+    if config.get('watch', False):
+        watch_inputs(lambda: run_pipeline(load_config(config_path)), config.get('watch_interval', 60))
+    else:
+        run_pipeline(config)
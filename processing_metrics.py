@@ -0,0 +1,120 @@
+# Shared timing and resource metrics for the processing scripts.
+# Set the PROCESSING_METRICS_PATH environment variable (or "metrics_path" below) to a file and every script appends
+# one JSON line per processed file: the script, the input and output files, the wall time of the whole file and of
+# each stage (read/decompress, transform, compress/write, ...), the processed points or pixels, the input and output
+# bytes and the peak memory (RSS) of the process so far. Lines from one run share the same "run" value.
+# Without a path the metrics are still collected but not written anywhere.
+
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+metrics_path = os.environ.get('PROCESSING_METRICS_PATH')
+run_id = f"{datetime.datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+write_lock = threading.Lock()
+
+
+def get_peak_rss_mb():
+    # Includes finished child processes, e.g. PDAL workers
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # Kilobytes on Linux, bytes on macOS
+        return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+
+def get_size(paths):
+    # Total size of the existing files and directories, a single path or a list of them
+    if paths is None:
+        return 0
+    if isinstance(paths, str):
+        paths = [paths]
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        elif os.path.isdir(path):
+            size += sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(path) for name in names)
+    return size
+
+
+def write_record(record):
+    if metrics_path is None:
+        return
+    line = json.dumps(record) + '\n'
+    # One write per line, so lines from parallel processes appending to the same file don't interleave
+    with write_lock, open(metrics_path, 'a') as f:
+        f.write(line)
+
+
+class FileMetrics:
+    # Collects the metrics of one input file. Stage times and counts can be added from several threads.
+
+    def __init__(self, script, input_path, output_path=None):
+        self.script = os.path.splitext(os.path.basename(script))[0]
+        self.input_path = input_path
+        self.output_path = output_path
+        self.stages = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start_time)
+
+    def timed(self, iterable, stage='read'):
+        # Times getting every item, e.g. reading and decompressing the chunks of a chunk iterator
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start_time)
+                return
+            self.add_time(stage, time.perf_counter() - start_time)
+            yield item
+
+    def count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def finish(self, **fields):
+        record = {
+            'run': run_id,
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'script': self.script,
+            'input': self.input_path,
+            'output': self.output_path,
+            'wall_s': round(time.perf_counter() - self.start_time, 4),
+            'stages_s': {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+            **self.counts,
+            'bytes_in': get_size(self.input_path),
+            'bytes_out': get_size(self.output_path),
+            'peak_rss_mb': get_peak_rss_mb(),
+            **fields,
+        }
+        write_record(record)
+        return record
@@ -2,87 +2,359 @@
 # The tile filename is based on multypolygon "FID".
 # It is possible to define the precision (scale) and the offset in LAS header for the output point clouds.
 # PDAL probably needs a conda environment to install properly: "conda install -c conda-forge python-pdal".
+# The 'streaming' mode only needs laspy and shapely, PDAL is needed for the 'pipeline' mode and COPC output.
+# Source file extents are read from the LAS headers only and cached in a sidecar index file next to the point clouds,
+# see laz_extent_index.py.
+# Set "tiling_mode" to 'streaming' to read every source file only once in chunks of "chunk_size" points instead of
+# running one PDAL pipeline per tile. Each chunk is assigned to the tile polygons with a vectorized point-in-polygon
+# test and appended to the open writer of each tile, so memory use depends on the chunk size only.
+# In 'pipeline' mode the tiles can be written in parallel by "worker_count" processes. With "memory_budget_mb" set,
+# tiles are scheduled largest first by their estimated input point count and only started while the estimated memory
+# use of the running tiles fits in the budget.
+# Finished tiles are recorded in a completion manifest. A rerun skips tiles whose output still matches the manifest
+# and whose source files have not changed.
+# With PROCESSING_METRICS_PATH set, the stage timings of every source file (streaming) or tile (pipeline) are written as
+# JSON lines, see processing_metrics.py.
+# Set "output_format" to 'copc' to write the tiles as Cloud-Optimized Point Clouds (<FID>.copc.laz) with PDAL's
+# writers.copc. Streaming mode writes each tile as LAZ first and converts it once the tile is complete.
+# The LAZ codec used by laspy (streaming mode, headers) is chosen in laz_io.py.
 
 import geopandas as gpd
 import json
 import os
-from pdal import Pipeline
 import time
 import logging
+import copy
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import laspy
-from laspy.file import File
+import numpy as np
+import shapely
 from shapely.geometry import box
+from shapely.strtree import STRtree
+
+from processing_metrics import FileMetrics
+from laz_io import open_las, require_pdal_for_copc, create_copc_writer, convert_to_copc, COPC_EXTENSION
+from laz_extent_index import update_extent_index, get_las_bbox
+try:
+    import pdal
+except ImportError:
+    pdal = None
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 laz_dir = 'laz_tiles'
 shp_path = 'tiled_multipolygons.shp'
-tiles_gdf = gpd.read_file(shp_path)
+extent_index_path = os.path.join(laz_dir, 'laz_extent_index.json')
+tiling_mode = 'pipeline'  # 'pipeline' or 'streaming'
+chunk_size = 1_000_000  # Points read per chunk in streaming mode
+output_scales = [0.001, 0.001, 0.001]
+output_offsets = [400000, 4560000, 0]
+worker_count = 1  # Number of tiles written in parallel in pipeline mode
+memory_budget_mb = None  # E.g. 64000, None disables the memory budget
+pdal_bytes_per_point = 100  # Rough PDAL memory use per input point, used for the memory budget
+manifest_path = 'tile_manifest.json'
+output_format = 'laz'  # 'laz' or 'copc'
+
 
-pipelines = {}
+def get_tile_filename(tile_fid):
+    if output_format == 'copc':
+        return f"{tile_fid}{COPC_EXTENSION}"
+    return f"{tile_fid}.laz"
 
 
 def create_initial_pipeline_dict(polygon, output_filename):
+    if output_format == 'copc':
+        writer = create_copc_writer(output_filename, output_scales, output_offsets)
+    else:
+        writer = {
+            "type": "writers.las",
+            "filename": output_filename,
+            "scale_x": output_scales[0],
+            "scale_y": output_scales[1],
+            "scale_z": output_scales[2],
+            "offset_x": output_offsets[0],
+            "offset_y": output_offsets[1],
+            "offset_z": output_offsets[2],
+        }
     pipeline_json = {
         "pipeline": [
             {
                 "type": "filters.crop",
                 "polygon": polygon.wkt
             },
-            {
-                "type": "writers.las",
-                "filename": output_filename,
-                "scale_x": 0.001,  
-                "scale_y": 0.001,  
-                "scale_z": 0.001,  
-                "offset_x": 400000,
-                "offset_y": 4560000,  
-                "offset_z": 0,  
-            }
+            writer
         ]
     }
     return pipeline_json
 
 
-def get_las_bbox(las_path):
-    las = laspy.read(las_path)
-    min_pt = las.header.mins
-    max_pt = las.header.maxs
-    return box(min_pt[0], min_pt[1], max_pt[0], max_pt[1])
+def get_tile_inputs(tile_polygon, laz_files, laz_tree, extent_index):
+    # The size and modification time of every source file overlapping the tile bounding box
+    tile_inputs = {}
+    for file_idx in sorted(laz_tree.query(tile_polygon.envelope, predicate='intersects')):
+        laz_file = laz_files[file_idx]
+        tile_inputs[laz_file] = [extent_index[laz_file]["size"], extent_index[laz_file]["mtime"]]
+    return tile_inputs
+
+
+def load_tile_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def record_tile(manifest, tile_fid, output_filename, point_count, tile_inputs):
+    stat = os.stat(output_filename)
+    manifest[str(tile_fid)] = {
+        "filename": output_filename,
+        "point_count": int(point_count),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "inputs": tile_inputs,
+    }
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def is_tile_complete(manifest, tile_fid, tile_inputs):
+    entry = manifest.get(str(tile_fid))
+    # A tile written in another output format is written again
+    if entry is None or entry["inputs"] != tile_inputs or entry["filename"] != get_tile_filename(tile_fid):
+        return False
+    output_filename = entry["filename"]
+    if not os.path.exists(output_filename):
+        return False
+    stat = os.stat(output_filename)
+    if stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]:
+        return False
+    try:
+        with open_las(output_filename) as reader:
+            return reader.header.point_count == entry["point_count"]
+    except Exception as e:
+        logging.warning(f"Unable to validate tile {tile_fid}: {e}")
+        return False
+
+
+def match_point_format(points, header):
+    # Source files with a different point format are copied dimension by dimension into the tile's format
+    if points.point_format == header.point_format:
+        return points
+    matched = laspy.ScaleAwarePointRecord.zeros(len(points), header=header)
+    source_dimensions = set(points.point_format.dimension_names)
+    for dimension_name in matched.point_format.dimension_names:
+        if dimension_name in source_dimensions and dimension_name not in ('X', 'Y', 'Z'):
+            matched[dimension_name] = points[dimension_name]
+    matched.x = points.x
+    matched.y = points.y
+    matched.z = points.z
+    return matched
+
+
+def create_tile_writer(output_filename, source_header):
+    header = copy.deepcopy(source_header)
+    header.scales = np.array(output_scales, dtype=np.float64)
+    header.offsets = np.array(output_offsets, dtype=np.float64)
+    return open_las(output_filename, mode='w', header=header)
+
+
+def stream_tiles(tiles_gdf, laz_dir, laz_files, extent_index, chunk_size, manifest, tile_inputs):
+    tile_fids = list(tiles_gdf['FID'])
+    tile_polygons = list(tiles_gdf['geometry'])
+    for polygon in tile_polygons:
+        shapely.prepare(polygon)
+    tile_bounds = [polygon.bounds for polygon in tile_polygons]
+    tile_tree = STRtree(tile_polygons)
+
+    # Count the source files that still have to be read for every tile, so a tile's writer can be closed
+    # as soon as its last source file has been processed
+    file_tiles = {}
+    remaining_files = {}
+    for laz_file in laz_files:
+        tile_indices = tile_tree.query(get_las_bbox(extent_index[laz_file]), predicate='intersects')
+        file_tiles[laz_file] = tile_indices
+        for tile_idx in tile_indices:
+            remaining_files[tile_idx] = remaining_files.get(tile_idx, 0) + 1
+
+    writers = {}
+    try:
+        for laz_file in laz_files:
+            if len(file_tiles[laz_file]) == 0:
+                continue
+            laz_path = os.path.join(laz_dir, laz_file)
+            logging.info(f"Streaming file: {laz_file} into {len(file_tiles[laz_file])} tiles")
+            start_time = time.time()
+            metrics = FileMetrics(__file__, laz_path)
+
+            with open_las(laz_path) as reader:
+                for points in metrics.timed(reader.chunk_iterator(chunk_size)):
+                    metrics.count(points=len(points))
+                    x = np.asarray(points.x)
+                    y = np.asarray(points.y)
+                    chunk_bbox = box(x.min(), y.min(), x.max(), y.max())
+                    for tile_idx in tile_tree.query(chunk_bbox, predicate='intersects'):
+                        with metrics.stage('transform'):
+                            minx, miny, maxx, maxy = tile_bounds[tile_idx]
+                            inside = (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
+                            if inside.any():
+                                inside[inside] = shapely.intersects_xy(tile_polygons[tile_idx], x[inside], y[inside])
+                        if not inside.any():
+                            continue
+
+                        with metrics.stage('write'):
+                            writer = writers.get(tile_idx)
+                            if writer is None:
+                                writer = create_tile_writer(f"{tile_fids[tile_idx]}.laz", reader.header)
+                                writers[tile_idx] = writer
+                            writer.write_points(match_point_format(points[inside], writer.header))
+                        metrics.count(points_written=np.count_nonzero(inside))
 
+            for tile_idx in file_tiles[laz_file]:
+                remaining_files[tile_idx] -= 1
+                if remaining_files[tile_idx] == 0 and tile_idx in writers:
+                    writer = writers.pop(tile_idx)
+                    with metrics.stage('write'):
+                        writer.close()
+                    tile_fid = tile_fids[tile_idx]
+                    point_count = writer.header.point_count
+                    if output_format == 'copc':
+                        with metrics.stage('copc'):
+                            point_count = convert_to_copc(f"{tile_fid}.laz", get_tile_filename(tile_fid))
+                    record_tile(manifest, tile_fid, get_tile_filename(tile_fid), point_count, tile_inputs[tile_fid])
+                    logging.info(f"Finished writing tile {tile_fid}")
 
-for idx, tile in tiles_gdf.iterrows():
-    tile_fid = tile['FID']
-    polygon = tile['geometry']
-    output_filename = f"{tile_fid}.laz"
-    pipelines[tile_fid] = create_initial_pipeline_dict(polygon, output_filename)
+            metrics.finish(mode='streaming', tiles=len(file_tiles[laz_file]))
+            logging.info(f"Finished streaming {laz_file}. Time taken: {time.time() - start_time:.2f} seconds.")
+    finally:
+        for writer in writers.values():
+            writer.close()
 
 
-for tile_fid, pipeline_dict in pipelines.items():
-    tile_polygon = tiles_gdf[tiles_gdf['FID'] == tile_fid].iloc[0]['geometry']  # Get the tile polygon based on FID
-    tile_bbox = tile_polygon.envelope  # Get the bounding box of the tile
-    for laz_file in os.listdir(laz_dir):
-        if laz_file.endswith('.laz'):
+def build_tile_pipelines(tiles_gdf, laz_dir, laz_files, laz_tree):
+    pipelines = {}
+    for idx, tile in tiles_gdf.iterrows():
+        tile_fid = tile['FID']
+        polygon = tile['geometry']
+        output_filename = get_tile_filename(tile_fid)
+        pipelines[tile_fid] = create_initial_pipeline_dict(polygon, output_filename)
+
+    for tile_fid, pipeline_dict in pipelines.items():
+        tile_polygon = tiles_gdf[tiles_gdf['FID'] == tile_fid].iloc[0]['geometry']  # Get the tile polygon based on FID
+        tile_bbox = tile_polygon.envelope  # Get the bounding box of the tile
+        for file_idx in sorted(laz_tree.query(tile_bbox, predicate='intersects')):
+            laz_file = laz_files[file_idx]
             laz_path = os.path.join(laz_dir, laz_file)
-            laz_bbox = get_las_bbox(laz_path) 
-            if laz_bbox.intersects(tile_bbox):
-                logging.info(f"Processing file: {laz_file} for tile number {tile_fid}")
-                reader = {
-                    "type": "readers.las",
-                    "filename": laz_path
-                }
-                pipeline_dict["pipeline"].insert(0, reader)
-
-for tile_fid, pipeline_dict in pipelines.items():
-    logging.info(f"Writing tile number {tile_fid}")
+            logging.info(f"Processing file: {laz_file} for tile number {tile_fid}")
+            reader = {
+                "type": "readers.las",
+                "filename": laz_path
+            }
+            pipeline_dict["pipeline"].insert(0, reader)
+    return pipelines
+
+
+def execute_tile_pipeline(tile_fid, pipeline_dict):
     start_time = time.time()
-    
-    pipeline = Pipeline(json.dumps(pipeline_dict))
-    pipeline.execute()
-    
-    end_time = time.time()
-    logging.info(f"Finished writing tile {tile_fid}. Time taken: {end_time - start_time:.2f} seconds.")
+    stages = pipeline_dict["pipeline"]
+    metrics = FileMetrics(__file__, [stage["filename"] for stage in stages[:-1] if stage["type"] == "readers.las"],
+                          stages[-1]["filename"])
+    pipeline = pdal.Pipeline(json.dumps(pipeline_dict))
+    # PDAL reads, crops and writes in one call
+    with metrics.stage('pdal'):
+        point_count = pipeline.execute()
+    metrics.count(points_written=point_count)
+    metrics.finish(mode='pipeline', tile=str(tile_fid))
+    return point_count, time.time() - start_time
+
+
+def execute_tile_pipelines(pipelines, manifest, tile_inputs, tile_estimates, worker_count, memory_budget_mb):
+    failed_tiles = []
+
+    if worker_count <= 1:
+        for tile_fid, pipeline_dict in pipelines.items():
+            logging.info(f"Writing tile number {tile_fid}")
+            point_count, elapsed = execute_tile_pipeline(tile_fid, pipeline_dict)
+            record_tile(manifest, tile_fid, pipeline_dict["pipeline"][-1]["filename"], point_count, tile_inputs[tile_fid])
+            logging.info(f"Finished writing tile {tile_fid}. Time taken: {elapsed:.2f} seconds.")
+        return failed_tiles
+
+    # Largest tiles first, so the longest running tiles don't end up last on an otherwise idle pool
+    queued_tiles = sorted(pipelines, key=lambda tile_fid: tile_estimates[tile_fid], reverse=True)
+    memory_budget = None if memory_budget_mb is None else memory_budget_mb * 1024 * 1024
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=worker_count) as executor:
+        while queued_tiles or running:
+            reserved = sum(tile_estimates[tile_fid] * pdal_bytes_per_point for tile_fid in running.values())
+            while queued_tiles and len(running) < worker_count:
+                # Take the largest queued tile that still fits in the budget. A single tile is always allowed to
+                # run on its own, even when its estimate exceeds the budget.
+                tile_fid = next(
+                    (fid for fid in queued_tiles
+                     if memory_budget is None or not running
+                     or reserved + tile_estimates[fid] * pdal_bytes_per_point <= memory_budget),
+                    None
+                )
+                if tile_fid is None:
+                    break
+                queued_tiles.remove(tile_fid)
+                logging.info(f"Writing tile number {tile_fid} (estimated {tile_estimates[tile_fid]} input points)")
+                running[executor.submit(execute_tile_pipeline, tile_fid, pipelines[tile_fid])] = tile_fid
+                reserved += tile_estimates[tile_fid] * pdal_bytes_per_point
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile_fid = running.pop(future)
+                try:
+                    point_count, elapsed = future.result()
+                except Exception as e:
+                    logging.error(f"Writing tile {tile_fid} failed: {e}")
+                    failed_tiles.append(tile_fid)
+                    continue
+                record_tile(manifest, tile_fid, pipelines[tile_fid]["pipeline"][-1]["filename"], point_count, tile_inputs[tile_fid])
+                logging.info(f"Finished writing tile {tile_fid}. Time taken: {elapsed:.2f} seconds.")
+
+    return failed_tiles
+
+
+def tile_pointclouds(laz_dir, shp_path, extent_index_path):
+    if tiling_mode != 'streaming' and pdal is None:
+        raise ImportError("PDAL is needed for the 'pipeline' mode: 'conda install -c conda-forge python-pdal'")
+    if output_format == 'copc':
+        require_pdal_for_copc()
+    tiles_gdf = gpd.read_file(shp_path)
+    extent_index = update_extent_index(laz_dir, extent_index_path)
+    laz_files = list(extent_index.keys())
+    laz_tree = STRtree([get_las_bbox(extent_index[laz_file]) for laz_file in laz_files])
+
+    manifest = load_tile_manifest(manifest_path)
+    tile_inputs = {
+        tile['FID']: get_tile_inputs(tile['geometry'], laz_files, laz_tree, extent_index)
+        for idx, tile in tiles_gdf.iterrows()
+    }
+    completed = [tile_fid for tile_fid in tile_inputs if is_tile_complete(manifest, tile_fid, tile_inputs[tile_fid])]
+    if completed:
+        logging.info(f"Skipping {len(completed)} tiles that are already written")
+        tiles_gdf = tiles_gdf[~tiles_gdf['FID'].isin(completed)]
+
+    failed_tiles = []
+    if tiling_mode == 'streaming':
+        stream_tiles(tiles_gdf, laz_dir, laz_files, extent_index, chunk_size, manifest, tile_inputs)
+    else:
+        pipelines = build_tile_pipelines(tiles_gdf, laz_dir, laz_files, laz_tree)
+        tile_estimates = {
+            tile_fid: sum(extent_index[laz_file]["point_count"] for laz_file in tile_inputs[tile_fid])
+            for tile_fid in pipelines
+        }
+        failed_tiles = execute_tile_pipelines(pipelines, manifest, tile_inputs, tile_estimates, worker_count, memory_budget_mb)
 
+    if failed_tiles:
+        logging.error(f"{len(failed_tiles)} tiles failed: {failed_tiles}. Run the script again to retry them.")
+    else:
+        logging.info("Point cloud tiling complete for all tiles.")
 
-logging.info("Point cloud tiling complete for all tiles.")
 
+if __name__ == '__main__':
+    tile_pointclouds(laz_dir, shp_path, extent_index_path)